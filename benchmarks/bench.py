@@ -0,0 +1,580 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import argparse
+import functools
+import importlib
+import inspect
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from bisect import bisect_right
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional, Sequence
+
+import cv2 as cv
+
+from synthetic import SyntheticScene, VideoSpec
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+FUNCTION_OBJECTS = "objects"
+FUNCTION_SUMMARY = "summary"
+FUNCTION_DIRS = {
+    FUNCTION_OBJECTS: REPO_ROOT / "gcf_object_tracking" / "gcf2_render_objects",
+    FUNCTION_SUMMARY: REPO_ROOT / "gcf_video_summary" / "gcf2_generate_summary",
+}
+# Buckets (subdirectories of the work dir)
+VIDEO_BUCKET = "videos"
+ANNOTATION_BUCKETS = {
+    FUNCTION_OBJECTS: "object_annotations",
+    FUNCTION_SUMMARY: "shot_annotations",
+}
+THUMBNAIL_CACHE_DIR = "thumbnail_cache"  # In the work dir, kept between runs
+SIZE_4K = (3840, 2160)
+DECODE_WORKERS = 4  # Capped by the available CPUs and memory
+# OpenCV seeks (FFmpeg backend) decode from the keyframe preceding the target
+# minus this many frames (same value as in frame_extractor.py)
+SEEK_PREROLL_FRAMES = 16
+
+PHASES = ("download", "parse", "seek/decode", "compose", "encode", "upload")
+PHASE_OTHER = "other"
+# Instrumented functions: (module, class.function, phase)
+INSTRUMENTED = {
+    FUNCTION_OBJECTS: [
+        ("video_source", "DownloadedVideo.__enter__", "download"),
+        ("storage_helper", "StorageHelper.get_object_tracks", "parse"),
+        ("object_tracks", "TrackIndex.__init__", "parse"),
+        ("video_processor", "VideoProcessor.open_video", "seek/decode"),
+        ("frame_extractor", "FrameExtractor.gen_frames", "seek/decode"),
+        ("frame_extractor", "ParallelFrameExtractor.gen_frames", "seek/decode"),
+        ("video_processor", "VideoProcessor.cell_image", "compose"),
+        ("video_processor", "VideoProcessor.render_object_summary", "compose"),
+        ("video_processor", "VideoProcessor.gen_animations", "compose"),
+        ("video_processor", "VideoProcessor.get_frame_with_overlay", "compose"),
+        ("video_processor", "VideoProcessor.encode_images", "encode"),
+        ("storage_helper", "StorageHelper.get_video_shots", "parse"),
+        ("shot_summary", "ShotSummary.add_frame", "compose"),
+        ("shot_summary", "ShotSummary.encode", "encode"),
+        ("storage_helper", "StorageHelper.upload_image", "upload"),
+        ("storage_helper", "StorageHelper.upload_shot_summary", "upload"),
+        ("upload_pipeline", "UploadPipeline.join", "upload"),
+    ],
+    FUNCTION_SUMMARY: [
+        ("video_source", "DownloadedVideo.__enter__", "download"),
+        ("storage_helper", "StorageHelper.get_video_shots", "parse"),
+        ("thumbnail_cache", "ThumbnailCache.__enter__", "download"),
+        ("frame_extractor", "FrameExtractor.gen_frames", "seek/decode"),
+        ("frame_extractor", "ParallelFrameExtractor.gen_frames", "seek/decode"),
+        ("video_processor", "VideoProcessor.fill_cached_cells", "compose"),
+        ("video_processor", "VideoProcessor.resize_into", "compose"),
+        ("video_processor", "VideoProcessor.render_summaries", "compose"),
+        ("video_processor", "VideoProcessor.upload_summaries", "encode"),
+        ("video_processor", "VideoProcessor.upload_storyboard_sheets", "encode"),
+        ("storage_helper", "StorageHelper.upload_summary", "upload"),
+        ("storage_helper", "StorageHelper.upload_storyboard_sheet", "upload"),
+        ("storage_helper", "StorageHelper.upload_storyboard_track", "upload"),
+        ("upload_pipeline", "UploadPipeline.join", "upload"),
+        ("thumbnail_cache", "ThumbnailCache.__exit__", "upload"),
+    ],
+}
+
+
+class Scenario(NamedTuple):
+    name: str
+    function: str
+    duration_s: float
+    shots: int
+    objects: int
+    animated: bool = False
+    streamed: bool = False
+    options: dict = {}  # Other RenderOptions fields | generate_summary parameters
+    size: Optional[tuple[int, int]] = None  # Video size (default: --size)
+    baseline: str = ""  # Scenario to compare with (speedup)
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in [
+        Scenario("objects_still", FUNCTION_OBJECTS, 60, 10, 40),
+        Scenario("objects_anim", FUNCTION_OBJECTS, 60, 10, 40, animated=True),
+        Scenario(
+            "objects_anim_cropped",
+            FUNCTION_OBJECTS,
+            60,
+            10,
+            40,
+            animated=True,
+            options=dict(cropped=True),
+        ),
+        Scenario(
+            "objects_anim_parallel",
+            FUNCTION_OBJECTS,
+            60,
+            10,
+            40,
+            animated=True,
+            options=dict(parallel=True),
+        ),
+        Scenario("objects_many", FUNCTION_OBJECTS, 300, 50, 400, animated=True),
+        Scenario(
+            "objects_combined",
+            FUNCTION_OBJECTS,
+            60,
+            10,
+            40,
+            options=dict(shot_annotation_bucket=ANNOTATION_BUCKETS[FUNCTION_SUMMARY]),
+        ),
+        # Shot summary frames decoded by the rendering workers (no decoding here)
+        Scenario(
+            "objects_combined_parallel",
+            FUNCTION_OBJECTS,
+            60,
+            10,
+            40,
+            animated=True,
+            options=dict(
+                parallel=True,
+                shot_annotation_bucket=ANNOTATION_BUCKETS[FUNCTION_SUMMARY],
+            ),
+        ),
+        Scenario("summary_objects_video", FUNCTION_SUMMARY, 60, 10, 40),
+        Scenario("summary_still", FUNCTION_SUMMARY, 60, 30, 0),
+        Scenario("summary_anim", FUNCTION_SUMMARY, 60, 30, 0, animated=True),
+        Scenario("summary_streamed", FUNCTION_SUMMARY, 60, 30, 0, streamed=True),
+        Scenario("summary_many_shots", FUNCTION_SUMMARY, 300, 300, 0, animated=True),
+        # Sparse thumbnails (seeks): exact frames vs nearest fast-seek frames
+        Scenario("summary_exact_seek", FUNCTION_SUMMARY, 600, 30, 0),
+        Scenario(
+            "summary_approx_seek",
+            FUNCTION_SUMMARY,
+            600,
+            30,
+            0,
+            options=dict(seek_tolerance_ms=1000),
+            baseline="summary_exact_seek",
+        ),
+        Scenario(
+            "summary_paginated",
+            FUNCTION_SUMMARY,
+            600,
+            600,
+            0,
+            animated=True,
+            options=dict(paginated=True),
+        ),
+        Scenario(
+            "summary_cached",
+            FUNCTION_SUMMARY,
+            60,
+            30,
+            0,
+            animated=True,
+            options=dict(thumbnail_cache=THUMBNAIL_CACHE_DIR),
+        ),
+        # Summary + seek-preview storyboard from the same decoding pass
+        Scenario(
+            "summary_storyboard",
+            FUNCTION_SUMMARY,
+            60,
+            30,
+            0,
+            options=dict(storyboard_interval_s=5.0),
+        ),
+        # Long 4K sources: single capture vs segment-parallel decoding
+        Scenario("objects_4k", FUNCTION_OBJECTS, 300, 20, 80, size=SIZE_4K),
+        Scenario(
+            "objects_4k_decode_workers",
+            FUNCTION_OBJECTS,
+            300,
+            20,
+            80,
+            options=dict(decode_workers=DECODE_WORKERS),
+            size=SIZE_4K,
+            baseline="objects_4k",
+        ),
+        Scenario("summary_4k", FUNCTION_SUMMARY, 300, 100, 0, size=SIZE_4K),
+        Scenario(
+            "summary_4k_decode_workers",
+            FUNCTION_SUMMARY,
+            300,
+            100,
+            0,
+            options=dict(decode_workers=DECODE_WORKERS),
+            size=SIZE_4K,
+            baseline="summary_4k",
+        ),
+    ]
+}
+
+
+class PhaseTimer:
+    """Accumulates the time spent in each phase
+
+    Nested phases are exclusive: their time is subtracted from the outer phase.
+    """
+
+    def __init__(self):
+        self.seconds: dict[str, float] = defaultdict(float)
+        self.calls: dict[str, int] = defaultdict(int)
+        self.child_seconds: list[float] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        self.child_seconds.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] += elapsed - self.child_seconds.pop()
+            self.calls[name] += 1
+            if self.child_seconds:
+                self.child_seconds[-1] += elapsed
+
+    def timed(self, name: str, func: Callable) -> Callable:
+        """Wraps a function (or each step of a generator) in a phase"""
+        if inspect.isgeneratorfunction(func):
+
+            @functools.wraps(func)
+            def timed_generator(*args, **kwargs):
+                generator = func(*args, **kwargs)
+                while True:
+                    with self.phase(name):
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                    yield item
+
+            return timed_generator
+
+        @functools.wraps(func)
+        def timed_function(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+
+        return timed_function
+
+
+class DecodeCounter:
+    """Counts the frames decoded by the video captures of this process
+
+    - Grabbed and read frames are decoded one by one
+    - A seek to a frame decodes the frames from the keyframe preceding the
+      target minus SEEK_PREROLL_FRAMES, up to the frame before the target
+    - Keyframes are read from the container (MP4/MOV), every frame is
+      considered a keyframe otherwise
+    - Frames decoded in worker processes are not counted
+    """
+
+    def __init__(self, keyframes: Optional[Sequence[int]]):
+        self.keyframes = keyframes
+        self.frames = 0
+
+    def seek_start(self, index: int) -> int:
+        start = max(index - SEEK_PREROLL_FRAMES, 0)
+        if not self.keyframes:
+            return start
+        keyframe_idx = bisect_right(self.keyframes, start) - 1
+        return self.keyframes[keyframe_idx] if 0 <= keyframe_idx else 0
+
+    def capture_class(self) -> type:
+        """Drop-in replacement of cv.VideoCapture (wrapper, not a subclass)"""
+        counter = self
+        video_capture = cv.VideoCapture
+
+        class CountingCapture:
+            def __init__(self, *args):
+                self.capture = video_capture(*args)
+
+            def __getattr__(self, name: str):
+                return getattr(self.capture, name)
+
+            def grab(self):
+                counter.frames += 1
+                return self.capture.grab()
+
+            def read(self, *args):
+                counter.frames += 1
+                return self.capture.read(*args)
+
+            def set(self, prop_id, value):
+                if prop_id == cv.CAP_PROP_POS_FRAMES:
+                    index = int(value)
+                    counter.frames += index - counter.seek_start(index)
+                return self.capture.set(prop_id, value)
+
+        return CountingCapture
+
+
+def read_file_keyframes(path: Path) -> Optional[Sequence[int]]:
+    """Keyframes of a video file, read with the summary function module"""
+    sys.path.append(str(FUNCTION_DIRS[FUNCTION_SUMMARY]))  # After the function
+    from keyframes import read_keyframe_indexes
+
+    with open(path, "rb") as file:
+
+        def read_range(start: int, end: int) -> bytes:
+            file.seek(start)
+            return file.read(end - start + 1)
+
+        return read_keyframe_indexes(read_range, path.stat().st_size)
+
+
+def instrument(timer: PhaseTimer, function: str):
+    for module_name, qualified_name, phase in INSTRUMENTED[function]:
+        module = importlib.import_module(module_name)
+        class_name, func_name = qualified_name.split(".")
+        cls = getattr(module, class_name)
+        func = cls.__dict__[func_name]  # Fails loudly if the function was renamed
+        setattr(cls, func_name, timer.timed(phase, func))
+
+
+def video_name(scene: SyntheticScene, shots: int, objects: int, seed: int) -> str:
+    spec = scene.spec
+    w, h = spec.size
+    dims = f"{w}x{h}_{spec.fps:g}fps_{spec.duration_s:g}s"
+    return f"synthetic_{dims}_{shots}sh_{objects}obj_seed{seed}{spec.extension}"
+
+
+def file_video_spec(path: Path) -> VideoSpec:
+    """Spec of an existing video (its annotations are synthesized to match)"""
+    video = cv.VideoCapture(str(path))
+    if not video.isOpened():
+        raise RuntimeError(f"Could not open video <{path}>")
+    fps = video.get(cv.CAP_PROP_FPS)
+    frame_count = int(video.get(cv.CAP_PROP_FRAME_COUNT))
+    w = int(video.get(cv.CAP_PROP_FRAME_WIDTH))
+    h = int(video.get(cv.CAP_PROP_FRAME_HEIGHT))
+    video.release()
+    return VideoSpec(frame_count / fps, (w, h), fps)
+
+
+def prepare_inputs(
+    scenario: Scenario,
+    spec: VideoSpec,
+    seed: int,
+    work_dir: Path,
+    video_file: Optional[Path] = None,
+):
+    """Synthesizes the video (or links the video file) and its annotations
+    (cached in the work dir)"""
+    scene = SyntheticScene.generate(spec, scenario.shots, scenario.objects, seed)
+    if video_file is None:
+        name = video_name(scene, scenario.shots, scenario.objects, seed)
+    else:
+        name = f"{video_file.stem}_{scenario.shots}sh_{scenario.objects}obj_seed{seed}"
+        name += video_file.suffix
+    video_path = work_dir / VIDEO_BUCKET / name
+    if video_file is not None and not video_path.exists():
+        video_path.parent.mkdir(parents=True, exist_ok=True)
+        video_path.symlink_to(video_file.resolve())
+    if not video_path.exists():
+        start = time.perf_counter()
+        scene.write_video(video_path)
+        elapsed = time.perf_counter() - start
+        print(f"Synthesized <{video_path.name}> in {elapsed:.1f} s")
+    functions = [scenario.function]
+    if "shot_annotation_bucket" in scenario.options:  # Combined mode
+        functions.append(FUNCTION_SUMMARY)
+    for function in functions:
+        annot_bucket = ANNOTATION_BUCKETS[function]
+        annot_path = work_dir / annot_bucket / VIDEO_BUCKET / f"{name}.json"
+        if annot_path.exists():
+            continue
+        input_uri = f"/{VIDEO_BUCKET}/{name}"
+        if function == FUNCTION_OBJECTS:
+            annotations = scene.object_annotations(input_uri)
+        else:
+            annotations = scene.shot_annotations(input_uri)
+        annot_path.parent.mkdir(parents=True, exist_ok=True)
+        annot_path.write_text(json.dumps(annotations))
+    annot_bucket = ANNOTATION_BUCKETS[scenario.function]
+    return f"gs://{annot_bucket}/{VIDEO_BUCKET}/{name}.json"
+
+
+def run_scenario(scenario: Scenario, annot_uri: str, work_dir: Path) -> dict:
+    """Runs a rendering function in this process (with the function modules)"""
+    sys.path.insert(0, str(FUNCTION_DIRS[scenario.function]))
+    # Buckets are subdirectories of the work dir (local storage backend)
+    os.environ["LOCAL_STORAGE_ROOT"] = str(work_dir)
+    # Span records are not printed (phases are timed by the benchmark)
+    os.environ.setdefault("TRACING", "0")
+    import video_processor
+
+    timer = PhaseTimer()
+    instrument(timer, scenario.function)
+    video_path = work_dir / VIDEO_BUCKET / Path(annot_uri).stem  # name.json
+    decode_counter = DecodeCounter(read_file_keyframes(video_path))
+    cv.VideoCapture = decode_counter.capture_class()  # Captures of the functions
+
+    output_bucket = scenario.name
+    output_dir = work_dir / output_bucket
+    shutil.rmtree(output_dir, ignore_errors=True)
+    start = time.perf_counter()
+    if scenario.function == FUNCTION_OBJECTS:
+        options = scenario.options.copy()
+        if "shot_annotation_bucket" in options:
+            options["summary_bucket"] = output_bucket  # Outputs counted together
+        options = video_processor.RenderOptions(
+            animated=scenario.animated, streamed=scenario.streamed, **options
+        )
+        video_processor.VideoProcessor.render_objects(annot_uri, output_bucket, options)
+    else:
+        options = scenario.options.copy()
+        if "thumbnail_cache" in options:
+            options["thumbnail_cache"] = str(work_dir / options["thumbnail_cache"])
+        video_processor.VideoProcessor.generate_summary(
+            annot_uri,
+            output_bucket,
+            scenario.animated,
+            scenario.streamed,
+            **options,
+        )
+    total_s = time.perf_counter() - start
+
+    outputs = [p for p in output_dir.rglob("*") if p.is_file()]
+    if not outputs:
+        raise RuntimeError(f"No rendered images in <{output_dir}>")
+    seconds = {phase: timer.seconds.get(phase, 0.0) for phase in PHASES}
+    seconds[PHASE_OTHER] = max(total_s - sum(seconds.values()), 0.0)
+    max_rss_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return dict(
+        scenario=scenario.name,
+        total_s=total_s,
+        seconds=seconds,
+        calls=dict(timer.calls),
+        outputs=len(outputs),
+        output_bytes=sum(p.stat().st_size for p in outputs),
+        max_rss_mb=max_rss_kb / 2 ** 10,
+        decoded_frames=decode_counter.frames,
+    )
+
+
+def run_in_subprocess(name: str, args: argparse.Namespace) -> dict:
+    """Each run gets its own process: both functions have same-named modules"""
+    work_dir: Path = args.work_dir
+    result_path = work_dir / f"{name}.result.json"
+    log_path = work_dir / f"{name}.log"
+    command = [sys.executable, __file__, name, "--worker"]
+    command += ["--work-dir", str(work_dir), "--size", args.size]
+    command += ["--fps", str(args.fps), "--codec", args.codec, "--seed", str(args.seed)]
+    if args.duration is not None:
+        command += ["--duration", str(args.duration)]
+    if args.video is not None:
+        command += ["--video", str(args.video)]
+    result_path.unlink(missing_ok=True)
+    with open(log_path, "w") as log:
+        process = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+    if process.returncode != 0:
+        log_tail = log_path.read_text().splitlines()[-20:]
+        print("\n".join(log_tail), file=sys.stderr)
+        raise RuntimeError(f"Scenario <{name}> failed (see <{log_path}>)")
+    return json.loads(result_path.read_text())
+
+
+def print_results(results: list[dict]):
+    columns = [*PHASES, PHASE_OTHER]
+    header = f"{'scenario':<24}{'total':>9}" + "".join(f"{c:>12}" for c in columns)
+    header += f"{'outputs':>9}{'MB out':>9}{'RSS MB':>9}{'decoded':>9}"
+    print(header)
+    for result in results:
+        row = f"{result['scenario']:<24}{result['total_s']:>8.2f}s"
+        row += "".join(f"{result['seconds'][c]:>11.2f}s" for c in columns)
+        row += f"{result['outputs']:>9}{result['output_bytes'] / 2 ** 20:>9.1f}"
+        row += f"{result['max_rss_mb']:>9.0f}{result['decoded_frames']:>9}"
+        print(row)
+    by_name = {result["scenario"]: result for result in results}
+    for name, result in by_name.items():
+        baseline_name = SCENARIOS[name].baseline
+        if baseline := by_name.get(baseline_name):
+            speedup = baseline["total_s"] / result["total_s"]
+            decoded = f"{result['decoded_frames']} vs {baseline['decoded_frames']}"
+            print(f"{name}: {speedup:.2f}x speedup (vs {baseline_name})")
+            print(f"{name}: {decoded} decoded frames (vs {baseline_name})")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of the video rendering functions"
+    )
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"default: all ({', '.join(SCENARIOS)})"
+    )
+    parser.add_argument("--duration", type=float, help="video duration override (s)")
+    parser.add_argument("--size", default="1280x720", help="video size (WxH)")
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--codec", default="mp4v", help="OpenCV FourCC")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--video", type=Path, help="existing video instead of the synthetic ones"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="keeps the best run")
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=Path(tempfile.gettempdir(), "cherry_on_py_bench"),
+        help="synthetic inputs (cached) and rendered outputs",
+    )
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    names = args.scenarios or list(SCENARIOS)
+    if unknown := [name for name in names if name not in SCENARIOS]:
+        parser.error(f"Unknown scenario(s): {', '.join(unknown)}")
+    w, h = (int(dim) for dim in args.size.lower().split("x"))
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+
+    def video_spec(scenario: Scenario) -> VideoSpec:
+        if args.video is not None:
+            return file_video_spec(args.video)
+        duration_s = args.duration or scenario.duration_s
+        return VideoSpec(duration_s, scenario.size or (w, h), args.fps, args.codec)
+
+    if args.worker:
+        [name] = names
+        scenario = SCENARIOS[name]
+        spec = video_spec(scenario)
+        annot_uri = prepare_inputs(scenario, spec, args.seed, args.work_dir, args.video)
+        result = run_scenario(scenario, annot_uri, args.work_dir)
+        result_path = args.work_dir / f"{name}.result.json"
+        result_path.write_text(json.dumps(result))
+        return
+
+    results = []
+    for name in names:
+        scenario = SCENARIOS[name]
+        spec = video_spec(scenario)
+        prepare_inputs(scenario, spec, args.seed, args.work_dir, args.video)
+        runs = [run_in_subprocess(name, args) for _ in range(args.repeat)]
+        best = min(runs, key=lambda result: result["total_s"])
+        print(f"{name}: {best['total_s']:.2f} s")
+        results.append(best)
+    print()
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
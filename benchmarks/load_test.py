@@ -0,0 +1,320 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+FACE_SAMPLES = REPO_ROOT / "gae_face_detection" / "demo" / "www" / "static" / "samples"
+READY_TIMEOUT_S = 60  # Server start (imports, workers)
+REQUEST_TIMEOUT_S = 120
+
+
+class WebApp(NamedTuple):
+    name: str
+    app_dir: Path
+    baseline_args: tuple[str, ...]  # Serving command before gunicorn.conf.py
+
+
+class ServingConfig(NamedTuple):
+    name: str
+    gunicorn_args: tuple[str, ...]  # Empty: the app baseline
+    env: dict[str, str]
+
+
+class Request(NamedTuple):
+    path: str
+    fields: dict[str, str]
+    files: dict[str, tuple[str, bytes]]  # name -> (filename, data)
+
+
+WEB_APPS = {
+    web_app.name: web_app
+    for web_app in [
+        WebApp(
+            "coloring",
+            REPO_ROOT / "cr_image_processing" / "demo",
+            ("--workers", "1", "--threads", "8", "--timeout", "0"),
+        ),
+        # App Engine default entrypoint (gunicorn defaults: 1 sync worker)
+        WebApp("faces", REPO_ROOT / "gae_face_detection" / "demo", ()),
+    ]
+}
+NO_CACHE = dict(SHARED_CACHE_MAX_MB="0")
+CONFIGS = {
+    config.name: config
+    for config in [
+        ServingConfig("baseline", (), NO_CACHE),
+        ServingConfig("tuned", ("--config", "gunicorn.conf.py"), NO_CACHE),
+        ServingConfig(
+            "tuned_no_preload",
+            ("--config", "gunicorn.conf.py"),
+            NO_CACHE | dict(WEB_PRELOAD="0"),
+        ),
+        ServingConfig("tuned_cached", ("--config", "gunicorn.conf.py"), {}),
+    ]
+}
+# Rendering options of the faces requests (cycled with the samples)
+FACE_OPTIONS = [
+    {"stache": "1"},
+    {"landmarks": "1", "image-format": "webp"},
+    {"anonymize": "1", "stache": "1"},
+    {"animated": "1", "oscillating": "1", "image-format": "webp"},
+]
+
+
+def sample_images() -> list[Path]:
+    return sorted(FACE_SAMPLES.glob("*.jpg"))
+
+
+def coloring_requests(distinct: int) -> list[Request]:
+    """Distinct inputs: samples, then padded copies (trailing bytes are ignored
+    by JPEG decoders but change the cache keys)"""
+    samples = [(path.name, path.read_bytes()) for path in sample_images()]
+    requests = []
+    for index in range(distinct):
+        padding, sample_idx = divmod(index, len(samples))
+        name, data = samples[sample_idx]
+        files = {"input-image": (name, data + b"\0" * padding)}
+        requests.append(Request("/api/coloring-page", {}, files))
+    return requests
+
+
+def face_requests(base_url: str, distinct: int) -> list[Request]:
+    """Renderings of the samples (annotations from their cached JSON files, no
+    Vision API calls), with various options"""
+    annotations = {}
+    for path in sample_images():
+        fields = {"file_name": path.name}
+        response = send(base_url, Request("/analyze-image", fields, {}))
+        annotations[path.name] = json.loads(response)["annotations"]
+    combinations = itertools.product(FACE_OPTIONS, annotations.items())
+    requests = []
+    for options, (file_name, base64_annotations) in combinations:
+        fields = {"file_name": file_name, "annotations": base64_annotations}
+        requests.append(Request("/process-image", fields | options, {}))
+    return requests[:distinct]
+
+
+def multipart_body(request: Request) -> tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in request.fields.items():
+        header = f'Content-Disposition: form-data; name="{name}"'
+        parts.append(f"--{boundary}\r\n{header}\r\n\r\n{value}\r\n".encode())
+    for name, (filename, data) in request.files.items():
+        header = f'Content-Disposition: form-data; name="{name}"; filename="{filename}"'
+        part_header = f"--{boundary}\r\n{header}\r\n"
+        part_header += "Content-Type: application/octet-stream\r\n\r\n"
+        parts.append(part_header.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def send(base_url: str, request: Request) -> bytes:
+    body, content_type = multipart_body(request)
+    http_request = urllib.request.Request(
+        f"{base_url}{request.path}", body, {"Content-Type": content_type}
+    )
+    with urllib.request.urlopen(http_request, timeout=REQUEST_TIMEOUT_S) as response:
+        return response.read()
+
+
+@contextmanager
+def serve(
+    web_app: WebApp, config: ServingConfig, port: int, work_dir: Path
+) -> Iterator[tuple[subprocess.Popen, float]]:
+    """Starts the app with gunicorn, yields its process and startup time"""
+    cache_dir = work_dir / f"{web_app.name}_{config.name}_cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)  # Cold cache
+    env = os.environ | config.env | dict(SHARED_CACHE_DIR=str(cache_dir))
+    gunicorn_args = config.gunicorn_args or web_app.baseline_args
+    command = [sys.executable, "-m", "gunicorn", *gunicorn_args]
+    command += ["--bind", f"127.0.0.1:{port}", "main:app"]  # Overrides the config
+    log_path = work_dir / f"{web_app.name}_{config.name}.log"
+    with open(log_path, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command, cwd=web_app.app_dir, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        try:
+            wait_until_ready(f"http://127.0.0.1:{port}/", process, log_path)
+            yield process, time.perf_counter() - start
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, log_path: Path):
+    deadline = time.perf_counter() + READY_TIMEOUT_S
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited (see <{log_path}>)")
+        try:
+            with urllib.request.urlopen(url, timeout=5):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError(f"Server not ready after {READY_TIMEOUT_S} s")
+
+
+def run_load(
+    base_url: str, requests: list[Request], clients: int, duration_s: float
+) -> tuple[list[float], int]:
+    """Clients send the requests in turn until the deadline: (latencies, errors)"""
+    counter = itertools.count()
+    counter_lock = threading.Lock()
+    deadline = time.perf_counter() + duration_s
+
+    def client() -> tuple[list[float], int]:
+        latencies, errors = [], 0
+        while time.perf_counter() < deadline:
+            with counter_lock:
+                request = requests[next(counter) % len(requests)]
+            start = time.perf_counter()
+            try:
+                send(base_url, request)
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        return latencies, errors
+
+    with ThreadPoolExecutor(clients) as executor:
+        results = list(executor.map(lambda _: client(), range(clients)))
+    latencies = [latency for latencies, _ in results for latency in latencies]
+    return latencies, sum(errors for _, errors in results)
+
+
+def server_pss_mb(pid: int) -> float:
+    """Memory of the master and its workers (PSS: shared pages counted once)"""
+    pids = [pid]
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat_path.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:  # Parent pid
+            pids.append(int(stat_path.parent.name))
+    pss_kb = 0
+    for process_pid in pids:
+        try:
+            lines = Path(f"/proc/{process_pid}/smaps_rollup").read_text().splitlines()
+        except OSError:
+            continue
+        pss_kb += sum(int(line.split()[1]) for line in lines if line.startswith("Pss:"))
+    return pss_kb / 2 ** 10
+
+
+def run_config(
+    web_app: WebApp, config: ServingConfig, args: argparse.Namespace
+) -> dict:
+    base_url = f"http://127.0.0.1:{args.port}"
+    with serve(web_app, config, args.port, args.work_dir) as (process, startup_s):
+        if web_app.name == "faces":
+            requests = face_requests(base_url, args.distinct)
+        else:
+            requests = coloring_requests(args.distinct)
+        run_load(base_url, requests, args.clients, args.warmup)
+        latencies, errors = run_load(base_url, requests, args.clients, args.duration)
+        pss_mb = server_pss_mb(process.pid)
+    percentiles = [0.0] * 99
+    if 2 <= len(latencies):
+        percentiles = statistics.quantiles(latencies, n=100)
+    return dict(
+        config=config.name,
+        requests=len(latencies),
+        throughput=len(latencies) / args.duration,
+        p50_ms=percentiles[49] * 1000,
+        p95_ms=percentiles[94] * 1000,
+        errors=errors,
+        startup_s=startup_s,
+        pss_mb=pss_mb,
+    )
+
+
+def print_results(results: list[dict]):
+    header = f"{'config':<20}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+    header += f"{'errors':>8}{'start s':>9}{'PSS MB':>9}"
+    print(header)
+    for result in results:
+        row = f"{result['config']:<20}{result['throughput']:>9.2f}"
+        row += f"{result['p50_ms']:>9.0f}{result['p95_ms']:>9.0f}"
+        row += f"{result['errors']:>8}{result['startup_s']:>9.2f}"
+        row += f"{result['pss_mb']:>9.0f}"
+        print(row)
+    throughputs = {result["config"]: result["throughput"] for result in results}
+    baseline = throughputs.get("baseline")
+    for name, throughput in throughputs.items():
+        if baseline and name != "baseline":
+            print(f"{name}: {throughput / baseline:.2f}x throughput (vs baseline)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test of a web app under several serving configurations"
+    )
+    parser.add_argument("app", choices=list(WEB_APPS))
+    parser.add_argument(
+        "configs", nargs="*", help=f"default: all ({', '.join(CONFIGS)})"
+    )
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="seconds")
+    parser.add_argument(
+        "--distinct", type=int, default=8, help="distinct requests (cache keys)"
+    )
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=Path(tempfile.gettempdir(), "cherry_on_py_load"),
+        help="server logs and shared caches",
+    )
+    args = parser.parse_args()
+
+    names = args.configs or list(CONFIGS)
+    if unknown := [name for name in names if name not in CONFIGS]:
+        parser.error(f"Unknown config(s): {', '.join(unknown)}")
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    web_app = WEB_APPS[args.app]
+
+    results = []
+    for name in names:
+        result = run_config(web_app, CONFIGS[name], args)
+        print(f"{name}: {result['throughput']:.2f} req/s")
+        results.append(result)
+    print()
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import math
+from bisect import bisect_right
+from pathlib import Path
+from typing import NamedTuple
+
+import cv2 as cv
+import numpy as np
+
+# Video containers matching the OpenCV FourCC codes (default: AVI)
+CODEC_EXTENSIONS = {
+    "mp4v": ".mp4",
+    "avc1": ".mp4",
+    "MJPG": ".avi",
+    "XVID": ".avi",
+    "VP80": ".webm",
+    "VP90": ".webm",
+}
+ENTITIES = ("person", "dog", "cat", "car", "bicycle", "bird", "ball", "tree")
+OBJECT_MIN_S, OBJECT_MAX_S = 1.0, 10.0  # Duration of the tracked objects
+OBJECT_MIN_CONFIDENCE = 0.7  # Synthetic objects pass the rendering filters
+BOX_MIN_SIZE, BOX_MAX_SIZE = 0.1, 0.4  # Normalized size of the bounding boxes
+
+
+class VideoSpec(NamedTuple):
+    duration_s: float = 60.0
+    size: tuple[int, int] = (1280, 720)
+    fps: float = 30.0
+    codec: str = "mp4v"  # OpenCV FourCC
+
+    @property
+    def frame_count(self) -> int:
+        return max(int(self.duration_s * self.fps), 1)
+
+    @property
+    def extension(self) -> str:
+        return CODEC_EXTENSIONS.get(self.codec, ".avi")
+
+
+class SyntheticObject(NamedTuple):
+    """Rectangle moving linearly from box1 to box2 (normalized l/t/r/b boxes)"""
+
+    entity: str
+    confidence: float
+    first_frame: int
+    last_frame: int
+    box1: np.ndarray
+    box2: np.ndarray
+    color: tuple[int, int, int]
+
+    def box_at(self, frame: int) -> np.ndarray:
+        span = max(self.last_frame - self.first_frame, 1)
+        t = (frame - self.first_frame) / span
+        return self.box1 + t * (self.box2 - self.box1)
+
+
+class SyntheticScene(NamedTuple):
+    """Video content and matching Video Intelligence annotations
+
+    - Each shot has its own background color
+    - Each object is a plain rectangle, tracked on every frame
+    - Frames are numbered (visual check of the extracted frames)
+    """
+
+    spec: VideoSpec
+    shot_frames: list[int]  # First frame of each shot
+    objects: list[SyntheticObject]
+
+    @classmethod
+    def generate(
+        cls, spec: VideoSpec, shot_count: int, object_count: int, seed: int = 0
+    ) -> "SyntheticScene":
+        rng = np.random.default_rng(seed)
+        frame_count = spec.frame_count
+        shot_count = min(max(shot_count, 1), frame_count)
+        cuts = rng.choice(np.arange(1, frame_count), shot_count - 1, replace=False)
+        shot_frames = [0] + sorted(cuts.tolist())
+
+        objects = []
+        min_frames = min(int(OBJECT_MIN_S * spec.fps), frame_count)
+        max_frames = min(int(OBJECT_MAX_S * spec.fps), frame_count)
+        for _ in range(object_count):
+            length = int(rng.integers(min_frames, max_frames + 1))
+            first_frame = int(rng.integers(0, frame_count - length + 1))
+            boxes = []
+            for _ in range(2):
+                w, h = rng.uniform(BOX_MIN_SIZE, BOX_MAX_SIZE, 2)
+                left, top = rng.uniform(0, 1 - w), rng.uniform(0, 1 - h)
+                boxes.append(np.array([left, top, left + w, top + h]))
+            objects.append(
+                SyntheticObject(
+                    entity=str(rng.choice(ENTITIES)),
+                    confidence=float(rng.uniform(OBJECT_MIN_CONFIDENCE, 1.0)),
+                    first_frame=first_frame,
+                    last_frame=first_frame + length - 1,
+                    box1=boxes[0],
+                    box2=boxes[1],
+                    color=tuple(int(c) for c in rng.integers(0, 256, 3)),
+                )
+            )
+        return cls(spec, shot_frames, objects)
+
+    def write_video(self, path: Path):
+        w, h = self.spec.size
+        fourcc = cv.VideoWriter_fourcc(*self.spec.codec)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        writer = cv.VideoWriter(str(path), fourcc, self.spec.fps, (w, h))
+        if not writer.isOpened():
+            raise RuntimeError(f"Could not write <{path}> with codec {self.spec.codec}")
+
+        rng = np.random.default_rng(len(self.shot_frames))
+        shot_colors = rng.integers(0, 192, (len(self.shot_frames), 3), dtype=np.uint8)
+        # Horizontal gradient: frames are not trivially compressible
+        gradient = np.linspace(0, 63, w, dtype=np.uint8)[None, :, None]
+        first_frames = np.array([obj.first_frame for obj in self.objects], dtype=int)
+        last_frames = np.array([obj.last_frame for obj in self.objects], dtype=int)
+        box_scale = (w, h, w, h)
+        frame = np.empty((h, w, 3), dtype=np.uint8)
+        font_scale = h / 360
+        for frame_idx in range(self.spec.frame_count):
+            shot_idx = bisect_right(self.shot_frames, frame_idx) - 1
+            frame[:] = shot_colors[shot_idx]
+            frame += gradient
+            visible = (first_frames <= frame_idx) & (frame_idx <= last_frames)
+            for obj_idx in np.flatnonzero(visible):
+                obj = self.objects[obj_idx]
+                box = (obj.box_at(frame_idx) * box_scale).astype(int)
+                left, top, right, bottom = box.tolist()
+                cv.rectangle(frame, (left, top), (right, bottom), obj.color, cv.FILLED)
+            text_pos = (int(10 * font_scale), h - int(10 * font_scale))
+            font = cv.FONT_HERSHEY_SIMPLEX
+            cv.putText(frame, f"{frame_idx}", text_pos, font, font_scale, (255,) * 3, 2)
+            writer.write(frame)
+        writer.release()
+
+    def time_offset(self, frame: int) -> dict:
+        # Rounded up: the frame position maps back to the same frame index
+        total_nanos = math.ceil(frame * 10 ** 9 / self.spec.fps)
+        seconds, nanos = divmod(total_nanos, 10 ** 9)
+        return dict(seconds=seconds, nanos=nanos)
+
+    def segment(self, first_frame: int, last_frame: int) -> dict:
+        return dict(
+            start_time_offset=self.time_offset(first_frame),
+            end_time_offset=self.time_offset(last_frame),
+        )
+
+    def object_annotations(self, input_uri: str) -> dict:
+        """Object tracking results (same JSON structure as the API output)"""
+
+        def object_annotation(obj: SyntheticObject) -> dict:
+            frames = []
+            for frame in range(obj.first_frame, obj.last_frame + 1):
+                left, top, right, bottom = obj.box_at(frame).round(6).tolist()
+                box = dict(left=left, top=top, right=right, bottom=bottom)
+                time_offset = self.time_offset(frame)
+                frame_dict = dict(normalized_bounding_box=box, time_offset=time_offset)
+                frames.append(frame_dict)
+            return dict(
+                entity=dict(
+                    entity_id=f"/synthetic/{obj.entity}",
+                    description=obj.entity,
+                    language_code="en-US",
+                ),
+                confidence=round(obj.confidence, 6),
+                frames=frames,
+                segment=self.segment(obj.first_frame, obj.last_frame),
+            )
+
+        annotations = [object_annotation(obj) for obj in self.objects]
+        return self.annotation_results(input_uri, object_annotations=annotations)
+
+    def shot_annotations(self, input_uri: str) -> dict:
+        """Shot change detection results (same JSON structure as the API output)"""
+        next_shot_frames = self.shot_frames[1:] + [self.spec.frame_count]
+        annotations = [
+            self.segment(first_frame, next_first_frame - 1)
+            for first_frame, next_first_frame in zip(self.shot_frames, next_shot_frames)
+        ]
+        return self.annotation_results(input_uri, shot_annotations=annotations)
+
+    def annotation_results(self, input_uri: str, **annotations: list) -> dict:
+        segment = self.segment(0, self.spec.frame_count - 1)
+        results = dict(input_uri=input_uri, segment=segment) | annotations
+        return dict(annotation_results=[results])
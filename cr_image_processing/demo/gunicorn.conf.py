@@ -0,0 +1,27 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+
+# Production serving: gunicorn --config gunicorn.conf.py main:app (see Procfile)
+# Coloring pages are CPU-bound (NumPy/scikit-image): one worker per CPU, with a
+# few threads to overlap uploads/downloads and the parts releasing the GIL
+bind = f":{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_WORKERS", "0")) or len(os.sched_getaffinity(0))
+threads = int(os.getenv("WEB_THREADS", "2"))
+timeout = 0  # Request timeouts are handled by Cloud Run
+# The app (NumPy, scikit-image, Pillow) is imported once in the master process
+# and shared by the forked workers (copy-on-write): faster starts, less memory
+preload_app = os.getenv("WEB_PRELOAD", "1") == "1"
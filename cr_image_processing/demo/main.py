@@ -19,10 +19,20 @@ import os
 import flask
 import numpy as np
 import skimage
+
+# Imported explicitly (not on first request): with gunicorn preload_app, the
+# master imports them once and the forked workers share them (copy-on-write)
+import skimage.exposure
+import skimage.filters
+import skimage.restoration
+import skimage.util
 from PIL import Image, ImageOps
 from PIL.Image import Image as PilImage
 
+from shared_cache import SharedCache, digest
+
 app = flask.Flask(__name__, static_url_path="")
+cache = SharedCache()  # Coloring pages shared by the workers (same inputs)
 
 
 @app.get("/")
@@ -36,14 +46,18 @@ def coloring_page():
     if file is None:
         return "Missing input-image parameter", 400
 
-    input_image = Image.open(file.stream)
-    output_image = generate_coloring_page(input_image)
-
-    image_io = io.BytesIO()
+    input_bytes = file.read()
     output_format = "png"
-    output_image.save(image_io, format=output_format)
-    image_io.seek(0)
-
+    cache_key = f"coloring-page/{digest(input_bytes)}.{output_format}"
+    if (output_bytes := cache.get(cache_key)) is None:
+        input_image = Image.open(io.BytesIO(input_bytes))
+        output_image = generate_coloring_page(input_image)
+        image_io = io.BytesIO()
+        output_image.save(image_io, format=output_format)
+        output_bytes = image_io.getvalue()
+        cache.put(cache_key, output_bytes)
+
+    image_io = io.BytesIO(output_bytes)
     return flask.send_file(image_io, mimetype=f"image/{output_format}")
 
 
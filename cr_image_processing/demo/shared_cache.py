@@ -0,0 +1,103 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Optional
+
+# Cache shared by the worker processes of an instance: one file per entry in a
+# local directory (in memory on App Engine and Cloud Run, where /tmp is a RAM disk)
+SHARED_CACHE_DIR = os.getenv("SHARED_CACHE_DIR", "") or str(
+    Path(tempfile.gettempdir(), "shared_cache")
+)
+SHARED_CACHE_MAX_MB = int(os.getenv("SHARED_CACHE_MAX_MB", "64"))  # 0: no cache
+SHARED_CACHE_EVICTION_RATIO = 0.75  # Oldest entries evicted down to this ratio
+
+
+class SharedCache:
+    """Cache shared by the worker processes (and threads) of an instance
+
+    - Entries are files named after a hash of their key, written atomically
+      (temp file + rename): workers never read partial entries
+    - Data is shared through the file system (page cache), not duplicated
+      in every worker
+    - Hits refresh the entry time, the least recently used entries are
+      evicted once the cache exceeds its size
+    - Errors are not fatal: the cache is bypassed
+    """
+
+    root: Path
+    max_bytes: int
+
+    def __init__(self, root: str = SHARED_CACHE_DIR, max_mb: int = SHARED_CACHE_MAX_MB):
+        self.root = Path(root)
+        self.max_bytes = max_mb * 2 ** 20
+
+    @property
+    def enabled(self) -> bool:
+        return 0 < self.max_bytes
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:  # Missing (or just evicted) entry
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        if not self.enabled or self.max_bytes < len(data):
+            return
+        path = self.path(key)
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            temp_suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+            temp_path = path.with_name(f"{path.name}.{temp_suffix}")
+            temp_path.write_bytes(data)
+            os.replace(temp_path, path)  # Atomic
+            self.evict()
+        except OSError as error:
+            print(f"Could not cache <{key}>: {error!r}")
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        if total_bytes <= self.max_bytes:
+            return
+        target_bytes = self.max_bytes * SHARED_CACHE_EVICTION_RATIO
+        for _, size, path in sorted(entries):
+            if total_bytes <= target_bytes:
+                break
+            Path(path).unlink(missing_ok=True)  # Maybe evicted by another worker
+            total_bytes -= size
+
+    def path(self, key: str) -> Path:
+        return self.root / hashlib.sha256(key.encode()).hexdigest()
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
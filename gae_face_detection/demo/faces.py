@@ -13,10 +13,14 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import hashlib
+import threading
+from collections import OrderedDict
 from io import BytesIO
 from math import atan2, ceil, cos, fabs, sin, sqrt
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 
+import numpy as np
 from google.cloud import vision_v1 as vision
 from PIL import Image, ImageDraw, ImageOps
 
@@ -42,6 +46,8 @@ EYE_R = LandmarkType.RIGHT_EYE
 ANNOTATION_COLOR = "#00FF00"
 ANNOTATION_LANDMARK_DIM_PERMIL = 8
 ANNOTATION_LANDMARK_DIM_MIN = 4
+# Landmark overlays reused by renders of the same image (0: no cache)
+OVERLAY_CACHE_SIZE = 16
 ANONYMIZATION_PIXELS = 13
 ANIM_ANGLES = (0.0, -0.2, +0.2, -0.1, +0.1, -0.05, +0.05)
 ANIM_SCALES = (1.0, 1.2, 0.8, 1.1, 0.9, 1.05, 0.95)
@@ -52,8 +58,33 @@ ANIM_FRAME1_DUR_MS = 50
 CROP_MARGIN_PERCENT = 10
 
 
+# Vision client created on first use in each worker process (gRPC channels must
+# not be created before forking), reused by the next requests
+vision_client: Optional[vision.ImageAnnotatorClient] = None
+vision_client_lock = threading.Lock()
+
+
+def get_vision_client() -> vision.ImageAnnotatorClient:
+    global vision_client
+    with vision_client_lock:
+        if vision_client is None:
+            vision_client = vision.ImageAnnotatorClient()
+    return vision_client
+
+
+def load_stache() -> PilImage:
+    """Loads the reference moustache: decoded once, at import time (with gunicorn
+    preload_app, in the master process, shared by the forked workers)"""
+    stache = Image.open(REF_STACHE)
+    stache.load()
+    return stache
+
+
+REF_STACHE_IMAGE = load_stache()
+
+
 def detect_faces(image_bytes: bytes) -> Annotations:
-    client = vision.ImageAnnotatorClient()
+    client = get_vision_client()
     api_image = vision.Image(content=image_bytes)
     return client.face_detection(api_image, max_results=MAX_DETECTED_FACES)
 
@@ -73,22 +104,79 @@ class ResultOptions(NamedTuple):
     bouncing: bool = False
 
 
+Overlay = tuple[PilImage, tuple[int, int]]  # Mask ("1" mode), position in image
+overlay_cache: OrderedDict[tuple[bytes, tuple[int, int]], Overlay] = OrderedDict()
+overlay_cache_lock = threading.Lock()
+
+
 def draw_face_landmarks(image: PilImage, annotations: Annotations):
-    r_half = min(image.size) * ANNOTATION_LANDMARK_DIM_PERMIL // 1000
+    """Draws the face boxes and landmarks, composited once (overlay mask)"""
+    overlay = get_landmark_overlay(annotations, image.size)
+    if overlay is None:
+        return
+    mask, position = overlay
+    ImageDraw.Draw(image).bitmap(position, mask, fill=ANNOTATION_COLOR)
+
+
+def get_landmark_overlay(
+    annotations: Annotations, image_size: tuple[int, int]
+) -> Optional[Overlay]:
+    """Returns the landmark overlay, cached by annotations and image size (LRU)"""
+    if OVERLAY_CACHE_SIZE < 1:
+        return render_landmark_overlay(annotations, image_size)
+    digest = hashlib.sha256(Annotations.serialize(annotations)).digest()
+    key = (digest, image_size)
+    with overlay_cache_lock:
+        if key in overlay_cache:
+            overlay_cache.move_to_end(key)
+            return overlay_cache[key]
+    overlay = render_landmark_overlay(annotations, image_size)
+    with overlay_cache_lock:
+        overlay_cache[key] = overlay
+        while OVERLAY_CACHE_SIZE < len(overlay_cache):
+            overlay_cache.popitem(last=False)
+    return overlay
+
+
+def render_landmark_overlay(
+    annotations: Annotations, image_size: tuple[int, int]
+) -> Optional[Overlay]:
+    """Returns the outlines of the face boxes and landmarks (None if no faces)
+
+    - Box coordinates are computed as NumPy arrays, from the raw protobuf
+      message (much faster to read than the proto-plus wrappers)
+    - The mask only covers the extent of the boxes (smaller composition)
+    """
+    r_half = min(image_size) * ANNOTATION_LANDMARK_DIM_PERMIL // 1000
     r_half = max(r_half, ANNOTATION_LANDMARK_DIM_MIN) // 2
     border = max(r_half // 2, 1)
 
-    draw = ImageDraw.Draw(image)
-    for face in annotations.face_annotations:
-        v = face.bounding_poly.vertices
-        r = (v[0].x, v[0].y, v[2].x + 1, v[2].y + 1)
-        draw.rectangle(r, outline=ANNOTATION_COLOR, width=border)
-
-        for landmark in face.landmarks:
-            x = int(landmark.position.x + 0.5)
-            y = int(landmark.position.y + 0.5)
-            r = (x - r_half, y - r_half, x + r_half + 1, y + r_half + 1)
-            draw.rectangle(r, outline=ANNOTATION_COLOR, width=border)
+    faces = Annotations.pb(annotations).face_annotations
+    face_corners = [
+        (v[0].x, v[0].y, v[2].x, v[2].y)
+        for v in (face.bounding_poly.vertices for face in faces)
+    ]
+    positions = [
+        (landmark.position.x, landmark.position.y)
+        for face in faces
+        for landmark in face.landmarks
+    ]
+    face_boxes = np.array(face_corners, dtype=np.int64).reshape(-1, 4) + (0, 0, 1, 1)
+    centers = np.trunc(np.array(positions).reshape(-1, 2) + 0.5).astype(np.int64)
+    landmark_offsets = (-r_half, -r_half, r_half + 1, r_half + 1)
+    landmark_boxes = np.tile(centers, 2) + landmark_offsets
+    boxes = np.concatenate([face_boxes, landmark_boxes])  # (x1, y1, x2, y2) rows
+
+    image_w, image_h = image_size
+    x1, y1 = np.maximum(boxes[:, :2].min(axis=0, initial=image_w), 0)
+    x2, y2 = np.minimum(boxes[:, 2:].max(axis=0, initial=0) + 1, image_size)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    mask = Image.new("1", (int(x2 - x1), int(y2 - y1)))
+    draw = ImageDraw.Draw(mask)
+    for box in (boxes - (x1, y1, x1, y1)).tolist():
+        draw.rectangle(box, outline=1, width=border)
+    return mask, (int(x1), int(y1))
 
 
 def anonymize_faces(image: PilImage, annotations: Annotations):
@@ -219,7 +307,7 @@ def render_result(
 
     has_faces = 1 <= len(annotations.face_annotations)
     transparent_gif = options.image_format == "gif" and options.crop_faces and has_faces
-    stache = Image.open(REF_STACHE)
+    stache = REF_STACHE_IMAGE  # Read only (transformed copies)
     if options.animated and has_faces:
         angles = ANIM_ANGLES if options.oscillating else [0.0] * ANIM_FRAME_NB
         scales = ANIM_SCALES if options.bouncing else [1.0] * ANIM_FRAME_NB
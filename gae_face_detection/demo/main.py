@@ -15,12 +15,14 @@ limitations under the License.
 """
 import base64
 import datetime
+import io
 from pathlib import Path
 
 import flask
 from PIL import Image
 
 import faces
+from shared_cache import SharedCache, digest
 
 Annotations = faces.Annotations
 Options = faces.ResultOptions
@@ -30,6 +32,8 @@ DIR_STATIC = "www/static"
 app = flask.Flask(__name__, static_folder=DIR_STATIC, template_folder="www/templates")
 app.config["SEND_FILE_MAX_AGE_DEFAULT"] = datetime.timedelta(minutes=10)
 demo_samples = Path(DIR_STATIC, "samples")
+# Detections (uploaded images) and results shared by the workers of an instance
+cache = SharedCache()
 
 
 @app.get("/")
@@ -40,7 +44,7 @@ def index():
 @app.post("/analyze-image")
 def analyze_image():
     if (image_file := flask.request.files.get("image")) is not None:
-        annotations = faces.detect_faces(image_file.read())
+        annotations = get_image_annotations(image_file.read())
     elif (file_name := flask.request.form.get("file_name")) is not None:
         sample_path = demo_samples.joinpath(file_name)
         annotations = get_local_image_annotations(sample_path)
@@ -62,14 +66,20 @@ def process_image():
         return "Could not decode annotations", 400
 
     if (image_file := flask.request.files.get("image")) is not None:
-        image = Image.open(image_file)
+        image_bytes = image_file.read()
+        image_source, image_id = io.BytesIO(image_bytes), digest(image_bytes)
     elif (file_name := flask.request.form.get("file_name")) is not None:
-        image = Image.open(demo_samples.joinpath(file_name))
+        image_source, image_id = demo_samples.joinpath(file_name), file_name
     else:
         return "Could not open input image in /process-image", 400
 
     options = options_from_request_form()
-    image_io = faces.render_result(image, annotations, options)
+    cache_key = f"result/{image_id}/{digest(base64_annotations.encode())}/{options}"
+    if (result_bytes := cache.get(cache_key)) is None:
+        image_io = faces.render_result(Image.open(image_source), annotations, options)
+        result_bytes = image_io.getvalue()
+        cache.put(cache_key, result_bytes)
+    image_io = io.BytesIO(result_bytes)
     return flask.send_file(image_io, mimetype=f"image/{options.image_format}")
 
 
@@ -78,6 +88,16 @@ def local_images():
     return (p.name for p in demo_samples.glob("*") if p.suffix.lower() in suffixes)
 
 
+def get_image_annotations(image_bytes: bytes) -> Annotations:
+    """Detects the faces once per uploaded image (shared cache)"""
+    cache_key = f"annotations/{digest(image_bytes)}"
+    if (binary_data := cache.get(cache_key)) is not None:
+        return Annotations(Annotations.deserialize(binary_data))
+    annotations = faces.detect_faces(image_bytes)
+    cache.put(cache_key, Annotations.serialize(annotations))
+    return annotations
+
+
 def get_local_image_annotations(sample_path: Path) -> Annotations:
     json_path = sample_path.with_suffix(f"{sample_path.suffix}.json")
     if json_path.is_file():
@@ -14,34 +14,42 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import os
+from typing import Optional
 
-from google.cloud import storage, videointelligence
+from google.cloud import videointelligence
+
+import tracing
+from batch_launcher import BatchLauncher
 
 ANNOTATION_BUCKET = os.getenv("ANNOTATION_BUCKET", "")
 assert ANNOTATION_BUCKET, "Undefined ANNOTATION_BUCKET environment variable"
+EXECUTION_ID_HEADER = "Function-Execution-Id"  # Correlates the traces of a request
+
+launcher: Optional[BatchLauncher] = None  # Reused by warm invocations
+
 
+def get_launcher() -> BatchLauncher:
+    global launcher
+    if launcher is None:
+        launcher = BatchLauncher(videointelligence.Feature.OBJECT_TRACKING)
+    return launcher
 
-def launch_object_tracking(video_uri: str, annot_bucket: str):
+
+def launch_object_tracking(video_uri: str, annot_bucket: str) -> str:
     """Detect and track video objects (asynchronously)
 
     Results will be stored in <annot_uri> with this naming convention:
     - video_uri: gs://video_bucket/path/to/video.ext
     - annot_uri: gs://annot_bucket/video_bucket/path/to/video.ext.json
-    """
-    print(f"Launching object tracking for <{video_uri}>...")
-    features = [videointelligence.Feature.OBJECT_TRACKING]
-    video_blob = storage.Blob.from_string(video_uri)
-    video_bucket = video_blob.bucket.name
-    path_to_video = video_blob.name
-    annot_uri = f"gs://{annot_bucket}/{video_bucket}/{path_to_video}.json"
-    request = dict(features=features, input_uri=video_uri, output_uri=annot_uri)
 
-    video_client = videointelligence.VideoIntelligenceServiceClient()
-    video_client.annotate_video(request)
+    Videos with an up-to-date annotation are skipped (status returned).
+    """
+    return get_launcher().launch(video_uri, annot_bucket)
 
 
 def gcf_track_objects(data, context):
     """Cloud Function triggered by a new Cloud Storage object"""
+    tracing.start_invocation(context.event_id)
     video_bucket = data["bucket"]
     path_to_video = data["name"]
     video_uri = f"gs://{video_bucket}/{path_to_video}"
@@ -50,13 +58,34 @@ def gcf_track_objects(data, context):
 
 def gcf_track_objects_http(request):
     """Cloud Function triggered by an HTTP GET request"""
+    tracing.start_invocation(request.headers.get(EXECUTION_ID_HEADER, ""))
     if request.method != "GET":
         return ("Please use a GET request", 403)
     if not request.args or "video_uri" not in request.args:
         return ('Please specify a "video_uri" parameter', 400)
     video_uri = request.args["video_uri"]
-    launch_object_tracking(video_uri, ANNOTATION_BUCKET)
-    return f"Launched object tracking for <{video_uri}>"
+    status = launch_object_tracking(video_uri, ANNOTATION_BUCKET)
+    return f"Object tracking for <{video_uri}>: {status}"
+
+
+def gcf_track_objects_batch_http(request):
+    """Cloud Function triggered by an HTTP request with multiple videos
+
+    - GET: one or more "video_uri" parameters
+    - POST: JSON body {"video_uris": [...]}
+    """
+    tracing.start_invocation(request.headers.get(EXECUTION_ID_HEADER, ""))
+    if request.method == "GET":
+        video_uris = request.args.getlist("video_uri")
+    elif request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        video_uris = body.get("video_uris", [])
+    else:
+        return ("Please use a GET or POST request", 403)
+    if not video_uris:
+        return ('Please specify "video_uri" parameters or "video_uris"', 400)
+    results = get_launcher().launch_batch(video_uris, ANNOTATION_BUCKET)
+    return dict(results=[result._asdict() for result in results])
 
 
 if __name__ == "__main__":
@@ -65,7 +94,8 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "video_uri", type=str, help="gs://video_bucket/path/to/video.ext"
+        "video_uris", type=str, nargs="+", help="gs://video_bucket/path/to/video.ext"
     )
     args = parser.parse_args()
-    launch_object_tracking(args.video_uri, ANNOTATION_BUCKET)
+    for result in get_launcher().launch_batch(args.video_uris, ANNOTATION_BUCKET):
+        print(f"{result.status:>10} <{result.video_uri}>")
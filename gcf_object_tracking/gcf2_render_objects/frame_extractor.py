@@ -0,0 +1,369 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import multiprocessing
+import os
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Generic, Iterable, Iterator, Optional, Sequence, TypeVar
+
+import cv2 as cv
+import numpy as np
+
+CvFrame = np.ndarray  # BGR frame, as decoded by OpenCV
+T = TypeVar("T")
+
+# Beyond this gap, seeking (decoding from the previous keyframe) is cheaper
+# than grabbing every intermediate frame (keyframes unknown)
+GRAB_MAX_GAP_FRAMES = 250
+# OpenCV seeks (FFmpeg backend) aim this many frames before the target and
+# decode from the keyframe preceding that position
+SEEK_PREROLL_FRAMES = 16
+DECODE_WORKER_BASE_MB = 128  # Estimated memory of a decoding worker without frames
+DECODE_SEGMENTS_PER_WORKER = 3  # More segments balance the load between workers
+DECODE_PENDING_SEGMENTS_PER_WORKER = 2  # Decoding or buffered in this process
+# Decoded segments per worker in memory: its pending segments and a copy in
+# transit (pickled in the worker, received here)
+DECODE_SEGMENT_COPIES = DECODE_PENDING_SEGMENTS_PER_WORKER + 1
+
+
+class FrameExtractor:
+    """Extracts video frames in a single forward decoding pass
+
+    - Frame indexes are sorted and de-duplicated before decoding
+    - Skipped frames are only grabbed (no BGR conversion)
+    - Backward moves always seek (the capture may be ahead, e.g. after a
+      previous call)
+    - Forward gaps seek when it decodes fewer frames than grabbing: with known
+      keyframes, a seek decodes from the keyframe preceding the target by more
+      than SEEK_PREROLL_FRAMES (a whole GOP when seeking to a keyframe),
+      otherwise gaps beyond GRAB_MAX_GAP_FRAMES seek
+    """
+
+    video: cv.VideoCapture
+    fps: float
+    frame_count: int
+    keyframes: Optional[Sequence[int]]  # Sorted keyframe indexes, if known
+
+    def __init__(
+        self, video: cv.VideoCapture, keyframes: Optional[Sequence[int]] = None
+    ):
+        self.video = video
+        self.fps = video.get(cv.CAP_PROP_FPS)
+        self.frame_count = int(video.get(cv.CAP_PROP_FRAME_COUNT))
+        self.keyframes = keyframes
+
+    def __enter__(self) -> "FrameExtractor":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def frame_index(self, pos_ms: float) -> int:
+        # Same rounding as OpenCV when seeking with CAP_PROP_POS_MSEC
+        index = int(pos_ms * self.fps / 1000)
+        if 0 < self.frame_count:
+            index = min(index, self.frame_count - 1)
+        return max(index, 0)
+
+    def gen_frames(self, frame_indexes: Iterable[int]) -> Iterator[tuple[int, CvFrame]]:
+        video = self.video
+        pos = int(video.get(cv.CAP_PROP_POS_FRAMES))
+        for index in sorted(set(frame_indexes)):
+            if index < pos or self.decode_cost(pos, index) < index - pos + 1:
+                video.set(cv.CAP_PROP_POS_FRAMES, index)
+                pos = index
+            while pos < index and video.grab():
+                pos += 1
+            ok, cv_frame = video.read()
+            if not ok:
+                return  # End of video
+            pos += 1
+            yield index, cv_frame
+
+    def decode_cost(self, pos: int, index: int) -> int:
+        """Frames decoded to read a frame from a position (grabbing forward or
+        seeking, the cheaper)"""
+        seek_start = self.keyframe_at(max(index - SEEK_PREROLL_FRAMES, 0))
+        if seek_start < 0:  # Unknown keyframes
+            seek_cost = GRAB_MAX_GAP_FRAMES + 1
+        else:
+            seek_cost = index - seek_start + 1
+        gap = index - pos
+        return seek_cost if gap < 0 else min(gap + 1, seek_cost)
+
+    def keyframe_at(self, index: int) -> int:
+        """Index of the keyframe starting the GOP of a frame (-1 if unknown)"""
+        if not self.keyframes:
+            return -1
+        keyframe_idx = bisect_right(self.keyframes, index) - 1
+        return self.keyframes[keyframe_idx] if 0 <= keyframe_idx else -1
+
+
+class ParallelFrameExtractor(FrameExtractor):
+    """Extracts video frames in worker processes, segment by segment
+
+    - Sorted frame indexes are split into contiguous segments of similar
+      decoding cost (frames to decode, a seek for large gaps)
+    - Each worker decodes its segments with its own capture, reused across
+      segments in any order (a segment behind the capture position seeks back)
+    - Frames are downscaled in the workers (less data sent back) and yielded
+      in order, with a bounded number of segments in flight
+    - Segments are bounded so that the segments in flight fit in the memory
+      per worker (decoded in the worker, buffered in this process, in transit)
+    - Workers are started on first use and stopped on exit
+    """
+
+    uri: str
+    worker_count: int
+    frame_size: Optional[tuple[int, int]]  # Size of the yielded frames
+    segment_max_frames: int
+    executor: Optional[ProcessPoolExecutor] = None
+
+    def __init__(
+        self,
+        video: cv.VideoCapture,
+        uri: str,
+        worker_count: int,
+        worker_mb: int,
+        frame_size: Optional[tuple[int, int]] = None,
+        keyframes: Optional[Sequence[int]] = None,
+    ):
+        super().__init__(video, keyframes)
+        self.uri = uri
+        self.worker_count = worker_count
+        video_w = int(video.get(cv.CAP_PROP_FRAME_WIDTH))
+        video_h = int(video.get(cv.CAP_PROP_FRAME_HEIGHT))
+        if frame_size is not None and video_w <= frame_size[0]:
+            frame_size = None  # Frames are not upscaled
+        self.frame_size = frame_size
+        frame_w, frame_h = frame_size or (video_w, video_h)
+        frame_bytes = max(3 * frame_w * frame_h, 1)
+        segment_bytes = worker_mb * 2 ** 20 // DECODE_SEGMENT_COPIES
+        self.segment_max_frames = max(segment_bytes // frame_bytes, 1)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def gen_frames(self, frame_indexes: Iterable[int]) -> Iterator[tuple[int, CvFrame]]:
+        segments = self.split_segments(sorted(set(frame_indexes)))
+        if not segments:
+            return
+        if self.executor is None:
+            print(f"Decoding with {self.worker_count} workers")
+            # Forked workers inherit the keyframes (nothing to serialize)
+            mp_context = multiprocessing.get_context("fork")
+            init_args = (self.uri, self.keyframes, self.frame_size)
+            self.executor = ProcessPoolExecutor(
+                self.worker_count, mp_context, init_decode_worker, init_args
+            )
+        max_pending = DECODE_PENDING_SEGMENTS_PER_WORKER * self.worker_count
+        pending: deque[Future] = deque()
+        for segment in segments:
+            pending.append(self.executor.submit(decode_segment, segment))
+            if len(pending) == max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+    def split_segments(self, indexes: list[int]) -> list[list[int]]:
+        if not indexes:
+            return []
+        # Decoding cost of each step: frames to grab or to decode after a seek
+        steps = [self.decode_cost(a + 1, b) for a, b in zip(indexes, indexes[1:])]
+        segment_count = self.worker_count * DECODE_SEGMENTS_PER_WORKER
+        segment_cost = (sum(steps) + 1) / segment_count
+        segments, segment, cost = [], [indexes[0]], 0
+        for index, step in zip(indexes[1:], steps):
+            cost += step
+            if segment_cost < cost or self.segment_max_frames <= len(segment):
+                segments.append(segment)
+                segment, cost = [], 0
+            segment.append(index)
+        segments.append(segment)
+        return segments
+
+
+class TappedFrameExtractor(FrameExtractor):
+    """Extractor whose decoding passes also feed another consumer (the tap)
+
+    - Tap frames are decoded in the first pass reaching them (passes are
+      requested in time order), the remaining ones on flush
+    - Frames only needed by the tap are passed to it, not yielded
+    - Frames needed by both are decoded once
+    """
+
+    extractor: FrameExtractor
+    tap: Callable[[int, CvFrame], None]
+    tap_indexes: set[int]  # Not decoded yet
+
+    def __init__(
+        self,
+        extractor: FrameExtractor,
+        tap_indexes: Iterable[int],
+        tap: Callable[[int, CvFrame], None],
+    ):
+        self.extractor = extractor
+        self.video = extractor.video
+        self.fps = extractor.fps
+        self.frame_count = extractor.frame_count
+        self.keyframes = extractor.keyframes
+        self.tap = tap
+        self.tap_indexes = set(tap_indexes)
+
+    def gen_frames(self, frame_indexes: Iterable[int]) -> Iterator[tuple[int, CvFrame]]:
+        indexes = set(frame_indexes)
+        last_index = max(indexes, default=-1)
+        tapped = {index for index in self.tap_indexes if index <= last_index}
+        self.tap_indexes -= tapped
+        for index, cv_frame in self.extractor.gen_frames(indexes | tapped):
+            if index in tapped:
+                self.tap(index, cv_frame)
+            if index in indexes:
+                yield index, cv_frame
+
+    def flush(self):
+        """Decodes the remaining tap frames"""
+        tapped, self.tap_indexes = self.tap_indexes, set()
+        if not tapped:
+            return  # Nothing to decode (the capture may be released)
+        for index, cv_frame in self.extractor.gen_frames(tapped):
+            self.tap(index, cv_frame)
+
+
+class FrameCache(Generic[T]):
+    """Bounded cache of converted frames, shared by all the frame sets needing them
+
+    - Frame sets are grouped into batches fitting in the cache
+    - Each batch is decoded in a single forward pass
+    - Batches are ordered by time, frame sets keep their original indexes
+    """
+
+    extractor: FrameExtractor
+    convert: Callable[[CvFrame], T]
+    max_frames: int
+
+    def __init__(
+        self,
+        extractor: FrameExtractor,
+        convert: Callable[[CvFrame], T],
+        max_frames: int,
+    ):
+        self.extractor = extractor
+        self.convert = convert
+        self.max_frames = max(max_frames, 1)
+
+    def gen_frame_sets(
+        self, pos_ms_sets: Sequence[Sequence[float]]
+    ) -> Iterator[tuple[int, list[Optional[T]]]]:
+        """Yields (set_index, frames), a frame being None if it couldn't be decoded"""
+        index_sets = [
+            [self.extractor.frame_index(pos_ms) for pos_ms in pos_ms_set]
+            for pos_ms_set in pos_ms_sets
+        ]
+        for batch in self.gen_batches(index_sets):
+            needed = set().union(*(index_sets[set_idx] for set_idx in batch))
+            cache = {
+                index: self.convert(cv_frame)
+                for index, cv_frame in self.extractor.gen_frames(needed)
+            }
+            for set_idx in batch:
+                yield set_idx, [cache.get(index) for index in index_sets[set_idx]]
+
+    def gen_batches(self, index_sets: list[list[int]]) -> Iterator[list[int]]:
+        """Yields batches of set indexes, sorted by the first frame of each set
+
+        - A set larger than the cache gets a batch of its own (decoded at once)
+        - Overlapping sets make a batch start behind the last decoded frame:
+          this relies on gen_frames seeking backward
+        """
+
+        def first_index(set_idx: int) -> int:
+            return min(index_sets[set_idx], default=0)
+
+        batch: list[int] = []
+        batch_indexes: set[int] = set()
+        for set_idx in sorted(range(len(index_sets)), key=first_index):
+            set_indexes = set(index_sets[set_idx])
+            if batch and self.max_frames < len(batch_indexes | set_indexes):
+                yield batch
+                batch, batch_indexes = [], set()
+            batch.append(set_idx)
+            batch_indexes |= set_indexes
+        if batch:
+            yield batch
+
+
+# Decoding worker state (forked process with its own capture)
+worker_extractor: Optional[FrameExtractor] = None
+worker_frame_size: Optional[tuple[int, int]] = None
+
+
+def init_decode_worker(
+    uri: str,
+    keyframes: Optional[Sequence[int]],
+    frame_size: Optional[tuple[int, int]],
+):
+    global worker_extractor, worker_frame_size
+    video = cv.VideoCapture(uri)
+    if not video.isOpened():
+        raise RuntimeError(f"Could not open video <{uri}>")
+    worker_extractor = FrameExtractor(video, keyframes)
+    worker_frame_size = frame_size
+
+
+def decode_segment(frame_indexes: list[int]) -> list[tuple[int, CvFrame]]:
+    frames = []
+    for index, cv_frame in worker_extractor.gen_frames(frame_indexes):
+        if worker_frame_size is not None:
+            size, interpolation = worker_frame_size, cv.INTER_AREA
+            cv_frame = cv.resize(cv_frame, size, interpolation=interpolation)
+        frames.append((index, cv_frame))
+    return frames
+
+
+def decode_worker_count(requested: int, worker_mb: int) -> int:
+    """Number of decoding workers fitting in the available CPUs and memory
+
+    - worker_mb covers all the decoded frames of a worker in flight (see
+      ParallelFrameExtractor), including the ones buffered in this process
+    """
+    cpu_count = len(os.sched_getaffinity(0))
+    memory_count = available_memory() // 2 ** 20 // (DECODE_WORKER_BASE_MB + worker_mb)
+    return max(1, min(requested, cpu_count, memory_count))
+
+
+def available_memory() -> int:
+    """Memory available to the instance in bytes (cgroup limit if any)"""
+    cgroup_files = [
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        (
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        ),
+    ]
+    physical = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    for limit_path, usage_path in cgroup_files:
+        try:
+            limit = int(Path(limit_path).read_text())
+            usage = int(Path(usage_path).read_text())
+        except (OSError, ValueError):  # Missing file or "max" (no limit)
+            continue
+        return max(min(limit - usage, physical), 0)
+    return physical
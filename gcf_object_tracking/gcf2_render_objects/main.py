@@ -15,19 +15,44 @@ limitations under the License.
 """
 import os
 
-from video_processor import VideoProcessor
+import tracing
+from video_processor import RenderOptions, VideoProcessor
 
 OBJECT_BUCKET = os.getenv("OBJECT_BUCKET", "")
 assert OBJECT_BUCKET, "Undefined OBJECT_BUCKET environment variable"
 ANIMATED = os.getenv("ANIMATED", "0") == "1"
+PARALLEL = os.getenv("PARALLEL", "0") == "1"
+STREAMED = os.getenv("STREAMED", "0") == "1"
+# Comma-separated formats, e.g. "gif,webp,png" for animations (default: jpeg|gif)
+OUTPUT_FORMATS = tuple(f for f in os.getenv("OUTPUT_FORMATS", "").split(",") if f)
+CROPPED = os.getenv("CROPPED", "0") == "1"
+# Frames decoded by segments in worker processes (0: in the function process)
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "0"))
+DECODE_WORKER_MB = int(os.getenv("DECODE_WORKER_MB", "256"))
+# Combined mode: shot summaries also rendered (gcf_video_summary buckets)
+SHOT_ANNOTATION_BUCKET = os.getenv("SHOT_ANNOTATION_BUCKET", "")
+SUMMARY_BUCKET = os.getenv("SUMMARY_BUCKET", "")
+assert SUMMARY_BUCKET or not SHOT_ANNOTATION_BUCKET, "Undefined SUMMARY_BUCKET"
+OPTIONS = RenderOptions(
+    animated=ANIMATED,
+    parallel=PARALLEL,
+    streamed=STREAMED,
+    output_formats=OUTPUT_FORMATS,
+    cropped=CROPPED,
+    decode_workers=DECODE_WORKERS,
+    decode_worker_mb=DECODE_WORKER_MB,
+    shot_annotation_bucket=SHOT_ANNOTATION_BUCKET,
+    summary_bucket=SUMMARY_BUCKET,
+)
 
 
 def gcf_render_objects(data, context):
     """Cloud Function triggered by a new Cloud Storage object"""
+    tracing.start_invocation(context.event_id)
     annotation_bucket = data["bucket"]
     path_to_annotation = data["name"]
     annot_uri = f"gs://{annotation_bucket}/{path_to_annotation}"
-    VideoProcessor.render_objects(annot_uri, OBJECT_BUCKET, ANIMATED)
+    VideoProcessor.render_objects(annot_uri, OBJECT_BUCKET, OPTIONS)
 
 
 if __name__ == "__main__":
@@ -39,4 +64,4 @@ if __name__ == "__main__":
         "annot_uri", type=str, help="gs://annotation_bucket/path/to/video.ext.json"
     )
     args = parser.parse_args()
-    VideoProcessor.render_objects(args.annot_uri, OBJECT_BUCKET, ANIMATED)
+    VideoProcessor.render_objects(args.annot_uri, OBJECT_BUCKET, OPTIONS)
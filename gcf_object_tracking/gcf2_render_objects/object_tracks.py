@@ -0,0 +1,181 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+from typing import Iterator, NamedTuple, Optional, TextIO
+
+import numpy as np
+
+READ_CHUNK_CHARS = 2 ** 20
+BOX_KEYS = ("left", "top", "right", "bottom")
+
+
+class ObjectTrack(NamedTuple):
+    """Tracked object, with one row per tracked frame
+
+    - times_ms: frame positions in milliseconds (float64)
+    - boxes: normalized bounding boxes (float32, left/top/right/bottom columns)
+    """
+
+    entity: str
+    confidence: float
+    times_ms: np.ndarray
+    boxes: np.ndarray
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.times_ms)
+
+    @classmethod
+    def from_dict(cls, annotation: dict) -> "ObjectTrack":
+        def time_offset_in_ms(time_offset: dict) -> float:
+            seconds = int(time_offset.get("seconds", 0))
+            nanos = int(time_offset.get("nanos", 0))
+            return seconds * 1000 + nanos / 10 ** 6
+
+        frames: list = annotation.get("frames", [])
+        times_ms = np.array(
+            [time_offset_in_ms(frame.get("time_offset", {})) for frame in frames],
+            dtype=np.float64,
+        )
+        boxes = np.array(
+            [
+                [frame.get("normalized_bounding_box", {}).get(k, 0.0) for k in BOX_KEYS]
+                for frame in frames
+            ],
+            dtype=np.float32,
+        ).reshape(-1, len(BOX_KEYS))
+        entity = annotation.get("entity", {}).get("description", "")
+        confidence = float(annotation.get("confidence", 0.0))
+        return cls(entity, confidence, times_ms, boxes)
+
+
+class TrackIndex:
+    """Object tracks indexed once per video
+
+    - Tracks keep their annotation order (track_idx)
+    - Per-track columns: confidence, first/last frame positions
+    - Time lookup: tracks sorted by first position + their last positions
+    """
+
+    tracks: list[ObjectTrack]
+    confidences: np.ndarray
+    first_ms: np.ndarray
+    last_ms: np.ndarray
+    by_time: np.ndarray  # Track indexes sorted by first position
+    sorted_first_ms: np.ndarray
+    by_entity: dict[str, np.ndarray]
+
+    def __init__(self, tracks: list[ObjectTrack]):
+        self.tracks = tracks
+        self.confidences = np.array([t.confidence for t in tracks], dtype=np.float32)
+        self.first_ms = np.array([t.times_ms[0] for t in tracks], dtype=np.float64)
+        self.last_ms = np.array([t.times_ms[-1] for t in tracks], dtype=np.float64)
+        self.by_time = np.argsort(self.first_ms, kind="stable")
+        self.sorted_first_ms = self.first_ms[self.by_time]
+        entity_indexes: dict[str, list[int]] = {}
+        for track_idx, track in enumerate(tracks):
+            entity_indexes.setdefault(track.entity, []).append(track_idx)
+        self.by_entity = {e: np.array(i) for e, i in entity_indexes.items()}
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def __getitem__(self, track_idx: int) -> ObjectTrack:
+        return self.tracks[track_idx]
+
+    def tracks_at(self, pos_ms: float) -> np.ndarray:
+        """Indexes of the tracks visible at pos_ms"""
+        return self.query(start_ms=pos_ms, end_ms=pos_ms)
+
+    def query(
+        self,
+        entity: Optional[str] = None,
+        min_confidence: float = 0.0,
+        max_confidence: float = 1.0,
+        start_ms: float = -np.inf,
+        end_ms: float = np.inf,
+    ) -> np.ndarray:
+        """Indexes of the matching tracks overlapping [start_ms, end_ms], by time"""
+        candidate_count = np.searchsorted(self.sorted_first_ms, end_ms, side="right")
+        candidates = self.by_time[:candidate_count]
+        mask = start_ms <= self.last_ms[candidates]
+        confidences = self.confidences[candidates]
+        mask &= (min_confidence <= confidences) & (confidences <= max_confidence)
+        if entity is not None:
+            entity_indexes = self.by_entity.get(entity, np.array([], dtype=int))
+            mask &= np.isin(candidates, entity_indexes)
+        return candidates[mask]
+
+
+def parse_object_tracks(
+    json_stream: TextIO, min_confidence: float, min_frames: int
+) -> list[ObjectTrack]:
+    """Parses the annotations one object at a time, only keeping the filtered ones"""
+    tracks = []
+    for annotation in gen_json_array_items(json_stream, "object_annotations"):
+        confidence = annotation.get("confidence", 0.0)
+        frame_count = len(annotation.get("frames", []))
+        if min_confidence <= confidence and min_frames <= frame_count:
+            tracks.append(ObjectTrack.from_dict(annotation))
+    return tracks
+
+
+def gen_json_array_items(json_stream: TextIO, key: str) -> Iterator[dict]:
+    """Yields the items of the 1st array named <key>, decoding one item at a time
+
+    Only the current item (and a read chunk) is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos = "", 0
+
+    def read(size: int = READ_CHUNK_CHARS) -> bool:
+        nonlocal buffer, pos
+        chunk = json_stream.read(size)
+        buffer, pos = buffer[pos:] + chunk, 0
+        return bool(chunk)
+
+    # Skip everything up to the array start
+    marker = f'"{key}"'
+    while True:
+        key_pos = buffer.find(marker, pos)
+        if 0 <= key_pos:
+            array_pos = buffer.find("[", key_pos + len(marker))
+            if 0 <= array_pos:
+                pos = array_pos + 1
+                break
+            pos = key_pos
+        else:
+            pos = max(len(buffer) - len(marker), pos)  # Marker may be split
+        if not read():
+            return  # No such array
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if len(buffer) <= pos:
+            if not read():
+                raise ValueError(f"Unterminated JSON array <{key}>")
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Incomplete item: at least double the buffer (linear parsing time)
+            if not read(max(len(buffer) - pos, READ_CHUNK_CHARS)):
+                raise
+            continue
+        yield item
@@ -0,0 +1,112 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from io import BytesIO
+from typing import Callable, Iterable, Sequence
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+from frame_extractor import CvFrame
+from storage_helper import VideoShot
+from tracing import Span
+
+# Same grid and formats as gcf_video_summary (still summary, default options):
+# SUMMARY_MAX_W and SUMMARY_FORMATS mirror SUMMARY_MAX_SIZE.w and the image
+# formats of SUMMARY_STILL_FORMATS (checked by tests/test_combined_summary.py)
+SUMMARY_MAX_W = 1920
+RGB_BACKGROUND = (0x80, 0x80, 0x80)
+SUMMARY_FORMATS = {
+    "jpeg": dict(optimize=True, progressive=True),
+    "png": dict(optimize=True),
+    "webp": dict(lossless=False, quality=80, method=1),
+}
+
+
+class ShotSummary:
+    """Still summary of the video shots, rendered with the objects (combined mode)
+
+    - One cell per shot (frame in the middle of the shot), in a grid trying to
+      preserve the video aspect ratio
+    - Frames are fed by the object rendering passes (see TappedFrameExtractor)
+      and resized directly into their cells
+    """
+
+    cell_size: tuple[int, int]
+    grid: np.ndarray  # RGB
+    cell_routes: dict[int, list[np.ndarray]]  # frame_index -> [cell buffer]
+
+    def __init__(
+        self,
+        video_shots: Sequence[VideoShot],
+        frame_size: tuple[int, int],
+        frame_index: Callable[[float], int],
+    ):
+        shot_count = len(video_shots)
+        cols = int(shot_count ** 0.5 + 0.5)
+        if cols * cols < shot_count:
+            cols += 1
+        rows = -(-shot_count // cols)  # Rounded up
+        cell_w, cell_h = frame_size
+        if SUMMARY_MAX_W < cell_w * cols:
+            scale = SUMMARY_MAX_W / (cell_w * cols)
+            cell_w = int(scale * cell_w)
+            cell_h = int(scale * cell_h)
+        self.cell_size = (cell_w, cell_h)
+        self.grid = np.empty((cell_h * rows, cell_w * cols, 3), dtype=np.uint8)
+        self.grid[:] = RGB_BACKGROUND
+        self.cell_routes = {}
+        MS_IN_NS = 10 ** 6
+        for shot_idx, (pos1_ns, pos2_ns) in enumerate(video_shots):
+            pos_ms = (pos1_ns + 0.5 * (pos2_ns - pos1_ns)) / MS_IN_NS
+            row, col = divmod(shot_idx, cols)
+            x, y = col * cell_w, row * cell_h
+            cell = self.grid[y : y + cell_h, x : x + cell_w]
+            self.cell_routes.setdefault(frame_index(pos_ms), []).append(cell)
+
+    @property
+    def frame_indexes(self) -> Iterable[int]:
+        return self.cell_routes.keys()
+
+    def add_frame(self, frame_index: int, cv_frame: CvFrame):
+        """Resizes a BGR frame into its RGB cells (no full-size copy)"""
+        cell, *other_cells = self.cell_routes[frame_index]
+        cell_h, cell_w, _ = cell.shape
+        size = (cell_w, cell_h)
+        resized = cv.resize(cv_frame, size, cell, interpolation=cv.INTER_AREA)
+        if resized is not cell:  # Output not written in place
+            np.copyto(cell, resized)
+        cv.cvtColor(cell, cv.COLOR_BGR2RGB, cell)  # Channels swapped in the cell only
+        for other_cell in other_cells:
+            np.copyto(other_cell, cell)
+
+    def cell(self, frame_index: int) -> np.ndarray:
+        """RGB cell of a frame added in another process (view, pickled as a copy)"""
+        return self.cell_routes[frame_index][0]
+
+    def add_cell(self, frame_index: int, rgb_cell: np.ndarray):
+        """Copies an RGB cell (resized in another process) into its cells"""
+        for cell in self.cell_routes[frame_index]:
+            np.copyto(cell, rgb_cell)
+
+    def encode(self, image_type: str) -> BytesIO:
+        """Encoded summary in a memory buffer (uploaded as is, without a copy)"""
+        with Span("encode", format=image_type, frames=1) as span:
+            mem_file = BytesIO()
+            image = Image.fromarray(self.grid)
+            image.save(mem_file, format=image_type, **SUMMARY_FORMATS[image_type])
+            span.add(bytes=len(mem_file.getbuffer()))  # No copy
+        return mem_file
@@ -15,19 +15,56 @@ limitations under the License.
 """
 import json
 import tempfile
+from io import BytesIO
 from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
 
-from google.cloud import storage
-from google.cloud import videointelligence as vi
+from object_tracks import ObjectTrack, parse_object_tracks
+from storage_backend import StorageBackend, get_backend, split_uri
+from tracing import Span
+from upload_pipeline import UploadPipeline
+from video_source import DownloadedVideo, StreamedVideo, VideoSource
 
 ANNOT_EXT = ".json"
+# Shot summary metadata, as written by gcf_video_summary (default options): the
+# summary function skips the shot summaries rendered here as up to date
+SOURCE_GENERATION_KEY = "source_generation"
+ANNOTATION_GENERATION_KEY = "annotation_generation"
+RENDER_OPTIONS_KEY = "render_options"
+PAGE_COUNT_KEY = "page_count"
+# Render options of gcf_video_summary with its default arguments (combined mode
+# summaries skipped as up to date there), see tests/test_combined_summary.py
+SUMMARY_RENDER_OPTIONS = "seek_tolerance_ms=0,paginated=False"
+
+
+class VideoShot(NamedTuple):
+    """Video shot start/end positions in nanoseconds"""
+
+    pos1_ns: int
+    pos2_ns: int
+    NANOS_PER_SECOND = 10 ** 9
+
+    @classmethod
+    def from_dict(cls, annotation: dict) -> "VideoShot":
+        def time_offset_in_ns(time_offset) -> int:
+            seconds: int = time_offset.get("seconds", 0)
+            nanos: int = time_offset.get("nanos", 0)
+            return seconds * cls.NANOS_PER_SECOND + nanos
+
+        pos1_ns = time_offset_in_ns(annotation["start_time_offset"])
+        pos2_ns = time_offset_in_ns(annotation["end_time_offset"])
+        return cls(pos1_ns, pos2_ns)
 
 
 class StorageHelper:
     """Local+Cloud storage helper
 
-    - Uses a temp dir for local processing (e.g. video frame extraction)
-    - Paths are relative to this temp dir (named after the output bucket)
+    - Objects are read/written with the shared storage backend (storage_backend)
+    - Gives OpenCV access to the video (downloaded or streamed, see video_source)
+    - Downloads use a temp dir (named after the output bucket)
+    - Uploads run in the background and are awaited on exit
+    - Combined mode: also reads the shot annotations of the video and writes
+      its shot summary, named as by gcf_video_summary
 
     Naming convention:
     - video_uri:               gs://video_bucket/path/to/video.ext
@@ -35,56 +72,133 @@ class StorageHelper:
     - video_path:                   video_bucket/path/to/video.ext
     - image_path:                   video_bucket/path/to/video.ext.SUFFIX
     - image_uri: gs://output_bucket/video_bucket/path/to/video.ext.SUFFIX
+    - shot_annot_uri: gs://shot_annot_bucket/video_bucket/path/to/video.ext.json
+    - shot_summary_uri:  gs://summary_bucket/video_bucket/path/to/video.ext.SUFFIX
+      (SUFFIX: summaryNNN_still.EXT, NNN being the number of shots)
     """
 
-    client = storage.Client()
-    annotations: vi.AnnotateVideoResponse
+    backend: StorageBackend
+    annot_uri: str
     video_path: Path
-    video_local_path: Path
-    upload_bucket: storage.Bucket
-
-    def __init__(self, annot_uri: str, output_bucket: str):
+    video_generation: Optional[int] = None
+    video_source: VideoSource
+    video_shots: list[VideoShot]
+    shot_annotation_generation: Optional[int] = None
+    output_bucket: str
+    upload_pipeline: UploadPipeline
+
+    def __init__(self, annot_uri: str, output_bucket: str, streamed=False):
         if not annot_uri.endswith(ANNOT_EXT):
             raise RuntimeError(f"annot_uri must end with <{ANNOT_EXT}>")
-        self.annotations = self.get_annotations(annot_uri)
+        self.backend = get_backend()
+        self.annot_uri = annot_uri
         self.video_path = self.video_path_from_uri(annot_uri)
-        temp_root = Path(tempfile.gettempdir(), output_bucket)
-        temp_root.mkdir(parents=True, exist_ok=True)
-        self.video_local_path = temp_root.joinpath(self.video_path)
-        self.upload_bucket = self.client.bucket(output_bucket)
-
-    def get_annotations(self, annot_uri: str) -> vi.AnnotateVideoResponse:
-        json_blob = storage.Blob.from_string(annot_uri, self.client)
-        json_bytes = json_blob.download_as_bytes()
-        mapping = json.loads(json_bytes)
-        return vi.AnnotateVideoResponse(mapping)
+        video_uri = f"gs://{self.video_path.as_posix()}"
+        video = self.backend.get_info(video_uri)  # Before any download
+        if video is None:
+            raise RuntimeError(f"Video not found <{video_uri}>")
+        self.video_generation = video.generation
+        if streamed:
+            self.video_source = StreamedVideo.from_object(video)
+        else:
+            temp_root = Path(tempfile.gettempdir(), output_bucket)
+            video_local_path = temp_root.joinpath(self.video_path)
+            self.video_source = DownloadedVideo(
+                video_uri, video_local_path, video.generation
+            )
+        self.video_shots = []
+        self.output_bucket = output_bucket
+        self.upload_pipeline = UploadPipeline()
+
+    def get_object_tracks(
+        self, min_confidence: float, min_frames: int
+    ) -> list[ObjectTrack]:
+        """Streams the annotations, only keeping the filtered object tracks"""
+        with Span("annotation", uri=self.annot_uri) as span:
+            with self.backend.open_text(self.annot_uri) as json_stream:
+                tracks = parse_object_tracks(json_stream, min_confidence, min_frames)
+                span.add(bytes=json_stream.buffer.tell(), objects=len(tracks))
+        return tracks
+
+    def get_video_shots(self, shot_annot_bucket: str) -> list[VideoShot]:
+        """Shots of the video (combined mode), none if not annotated (yet)"""
+        shot_annot_uri = f"gs://{shot_annot_bucket}/{self.video_path.as_posix()}"
+        shot_annot_uri += ANNOT_EXT
+        with Span("annotation", uri=shot_annot_uri) as span:
+            annotation = self.backend.get_info(shot_annot_uri)
+            if annotation is None:
+                return []
+            self.shot_annotation_generation = annotation.generation
+            # Downloaded at the same generation
+            json_text = self.backend.read_text(shot_annot_uri, annotation.generation)
+            api_response: dict = json.loads(json_text)
+            single_video_results: dict = api_response["annotation_results"][0]
+            annotations: list = single_video_results["shot_annotations"]
+            self.video_shots = [VideoShot.from_dict(a) for a in annotations]
+            span.add(bytes=annotation.size, shots=len(self.video_shots))
+        return self.video_shots
 
     def __enter__(self):
-        self.download_video()
+        self.video_source.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.video_local_path.unlink()
+        self.video_source.__exit__(exc_type, exc_value, traceback)
+        failures = self.upload_pipeline.join()
+        if failures and exc_type is None:
+            raise RuntimeError(f"Could not upload {len(failures)} image(s)")
 
     def video_path_from_uri(self, annot_uri: str) -> Path:
-        annot_blob = storage.Blob.from_string(annot_uri)
-        return Path(annot_blob.name[: -len(ANNOT_EXT)])
-
-    def download_video(self):
-        video_uri = f"gs://{self.video_path.as_posix()}"
-        blob = storage.Blob.from_string(video_uri, self.client)
-        print(f"Downloading -> {self.video_local_path}")
-        self.video_local_path.parent.mkdir(parents=True, exist_ok=True)
-        blob.download_to_filename(self.video_local_path)
+        _, annot_name = split_uri(annot_uri)
+        return Path(annot_name[: -len(ANNOT_EXT)])
 
-    def upload_image(self, image_bytes: bytes, image_type: str, filename_suffix: str):
+    def upload_image(self, image_data: BytesIO, image_type: str, filename_suffix: str):
         path = self.image_path(image_type, filename_suffix)
-        blob = self.upload_bucket.blob(path.as_posix())
+        image_uri = f"gs://{self.output_bucket}/{path.as_posix()}"
         content_type = f"image/{image_type}"
-        print(f"Uploading -> {blob.name}")
-        blob.upload_from_string(image_bytes, content_type)
+        self.upload_pipeline.submit(image_uri, image_data, content_type)
 
     def image_path(self, image_type: str, filename_suffix) -> Path:
         video_name = self.video_path.name
         image_name = f"{video_name}.{filename_suffix}.{image_type}"
         return Path(self.video_path.parent, image_name)
+
+    def upload_shot_summary(
+        self, image_data: BytesIO, image_type: str, summary_bucket: str
+    ):
+        summary_uri = self.shot_summary_uri(summary_bucket, image_type)
+        content_type = f"image/{image_type}"
+        metadata = self.shot_summary_metadata()
+        self.upload_pipeline.submit(summary_uri, image_data, content_type, metadata)
+
+    def shot_summary_metadata(self) -> dict[str, str]:
+        return {
+            SOURCE_GENERATION_KEY: str(self.video_generation),
+            ANNOTATION_GENERATION_KEY: str(self.shot_annotation_generation),
+            RENDER_OPTIONS_KEY: SUMMARY_RENDER_OPTIONS,
+            PAGE_COUNT_KEY: "1",
+        }
+
+    def is_shot_summary_up_to_date(
+        self, summary_bucket: str, image_types: Iterable[str]
+    ) -> bool:
+        """Whether the shot summary exists in all formats, rendered from the same
+        video/annotation generations (by the summary function or here)"""
+        prefix_uri = self.shot_summary_uri(summary_bucket)
+        summaries = {info.uri: info for info in self.backend.list_infos(prefix_uri)}
+        expected_metadata = self.shot_summary_metadata()
+        for image_type in image_types:
+            summary = summaries.get(self.shot_summary_uri(summary_bucket, image_type))
+            if summary is None or summary.metadata != expected_metadata:
+                return False
+        return True
+
+    def shot_summary_uri(self, summary_bucket: str, image_type="") -> str:
+        """Summary URI (prefix without image type)"""
+        video_name = self.video_path.name
+        shot_count = len(self.video_shots)
+        summary_name = f"{video_name}.summary{shot_count:03d}_still"
+        if image_type:
+            summary_name = f"{summary_name}.{image_type}"
+        path = Path(self.video_path.parent, summary_name)
+        return f"gs://{summary_bucket}/{path.as_posix()}"
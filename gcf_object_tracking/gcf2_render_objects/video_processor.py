@@ -13,19 +13,41 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import bisect
+import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import BytesIO
-from typing import Iterator, NamedTuple, Optional, Union
+from typing import Iterator, NamedTuple, Optional, Sequence, Union
 
 import cv2 as cv
-from google.cloud import videointelligence as vi
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, features
 
+try:
+    import pillow_avif  # noqa: F401 (registers the AVIF plugin in Pillow)
+except ImportError:
+    pass  # Optional: the "avif" output format is skipped as unsupported
+
+from frame_extractor import (
+    CvFrame,
+    FrameCache,
+    FrameExtractor,
+    ParallelFrameExtractor,
+    TappedFrameExtractor,
+    available_memory,
+    decode_worker_count,
+)
+from object_tracks import ObjectTrack, TrackIndex
+from shot_summary import SUMMARY_FORMATS, ShotSummary
 from storage_helper import StorageHelper
+from tracing import Span
 
 PilImage = Image.Image
-PilFrames = Union[PilImage, Iterator[PilImage]]
+PilFrames = Union[PilImage, Sequence[PilImage]]
 ImageSize = NamedTuple("ImageSize", [("w", int), ("h", int)])
+ImageFormat = NamedTuple("ImageFormat", [("type", str), ("save_parameters", dict)])
 
 MIN_CONFIDENCE = 0.7  # Ignore objects with lower confidence
 MIN_FRAMES = 10  # Ignore objects with lower number of detected frames
@@ -41,61 +63,192 @@ FONT_BG_COLOR = "#00000040"
 IMAGE_MAX_SIZE = ImageSize(1920, 1080)
 ANIM_FIXED_DURATION_MS = 250
 ANIM_MAX_FRAMES = 12  # Max number of generated frames for animations
+CROP_TILE_SIZE = ImageSize(256, 256)  # Size of cropped animations
+CROP_MARGIN_RATIO = 0.2  # Margin around the object (ratio of its max size)
+CROP_SMOOTHING_FRAMES = 3  # Moving average of the framing (odd number)
+FRAME_CACHE_MAX_MB = 256  # Memory for decoded frames shared between objects
+RENDER_WORKER_BASE_MB = 128  # Estimated memory of a worker without frames
+RENDER_WORKER_MIN_CACHE_MB = 64  # Minimum frame cache for a worker
+RENDER_CHUNKS_PER_WORKER = 3  # More chunks balance the load between workers
 SUMMARY_SUFFIX = f"summary_pct{int(MIN_CONFIDENCE*100):02}_fr{MIN_FRAMES:02}"
 ANIM_SUFFIX_FMT = "{index:03}_{entity}_pct{confidence}_fr{frames}"
 
+# Output formats (tuned encoder parameters), selected with RenderOptions
+# AVIF needs pillow-avif-plugin (see requirements.txt), other formats are built in
+STILL_FORMATS = {
+    "jpeg": ImageFormat("jpeg", dict(quality=80, optimize=True, progressive=True)),
+    "webp": ImageFormat("webp", dict(quality=80, method=4)),
+    "png": ImageFormat("png", dict(compress_level=6)),
+    "avif": ImageFormat("avif", dict(quality=60, speed=8)),
+}
+ANIMATED_FORMATS = {
+    "gif": ImageFormat("gif", dict()),
+    "webp": ImageFormat("webp", dict(quality=75, method=4)),  # Animated WebP
+    "png": ImageFormat("png", dict(compress_level=6)),  # APNG
+}
+DEFAULT_STILL_FORMATS = ("jpeg",)
+DEFAULT_ANIMATED_FORMATS = ("gif",)
+
+
+class RenderOptions(NamedTuple):
+    animated: bool = False
+    # Render animations in parallel worker processes
+    parallel: bool = False
+    # Read the video with ranged requests instead of downloading it
+    streamed: bool = False
+    # Output formats (keys of STILL_FORMATS|ANIMATED_FORMATS), empty for defaults
+    output_formats: tuple[str, ...] = ()
+    # Animations cropped around the objects, with frames sampled over the track
+    cropped: bool = False
+    # Decode the frames in worker processes (if > 1 and not parallel rendering)
+    decode_workers: int = 0
+    decode_worker_mb: int = 256  # Memory for the decoded frames of a worker
+    # Combined mode: also render the shot summary of the video (if annotated),
+    # from the frames decoded for the objects, as gcf_video_summary would
+    shot_annotation_bucket: str = ""
+    summary_bucket: str = ""
+
+
+class RenderedImage(NamedTuple):
+    image_data: BytesIO  # Uploaded as is, without a copy
+    image_type: str
+    filename_suffix: str
+
 
 class VideoProcessor:
     storage: StorageHelper
-    animated: bool
-    annotations: vi.AnnotateVideoResponse
+    options: RenderOptions
+    tracks: TrackIndex
     object_count: int
     video: Optional[cv.VideoCapture] = None
-    cell_size: ImageSize
+    frame_cache: FrameCache[PilImage]
+    parallel_extractor: Optional[ParallelFrameExtractor] = None
+    shot_summary: Optional[ShotSummary] = None
+    tapped_extractor: Optional[TappedFrameExtractor] = None
+    frame_size: ImageSize  # Size of decoded frames
+    cell_size: ImageSize  # Size of rendered frames
     grid_size: ImageSize
     font: ImageFont.FreeTypeFont
     font_height: int
+    caption_sprites: dict[int, PilImage]
+    image_formats: list[ImageFormat]
 
     @staticmethod
-    def render_objects(annot_uri: str, output_bucket: str, animated: bool):
-        """Render objects from video annotations"""
-        with StorageHelper(annot_uri, output_bucket) as storage:
-            with VideoProcessor(storage, animated) as video_proc:
-                print(f"Objects to render: {video_proc.object_count}")
-                if animated:
-                    video_proc.render_object_animations()
-                else:
-                    video_proc.render_object_summary()
+    def render_objects(annot_uri: str, output_bucket: str, options: RenderOptions):
+        """Render objects from video annotations (traced in a "render" span)
+
+        - Combined mode (options.shot_annotation_bucket): the shot summary is
+          rendered in the same decoding passes (video read once)
+        """
+        with Span("render", uri=annot_uri, animated=options.animated) as span:
+            with StorageHelper(annot_uri, output_bucket, options.streamed) as storage:
+                with VideoProcessor(storage, options) as video_proc:
+                    print(f"Objects to render: {video_proc.object_count}")
+                    span.set(objects=video_proc.object_count)
+                    if options.animated:
+                        video_proc.render_object_animations()
+                    else:
+                        video_proc.render_object_summary()
+                    if options.shot_annotation_bucket:
+                        video_proc.render_shot_summary()
+                        span.set(shots=len(storage.video_shots))
 
-    def __init__(self, storage: StorageHelper, animated: bool):
+    def __init__(self, storage: StorageHelper, options: RenderOptions):
         self.storage = storage
-        self.animated = animated
+        self.options = options
+        self.caption_sprites = {}
+        self.image_formats = self.select_image_formats()
 
     def __enter__(self):
-        self.annotations = self.storage.annotations
-        self.object_count = len(list(self.gen_video_objects_filtered()))
-        if self.object_count == 0:
+        tracks = self.storage.get_object_tracks(MIN_CONFIDENCE, MIN_FRAMES)
+        self.tracks = TrackIndex(tracks)
+        self.object_count = len(self.tracks)
+        if self.object_count == 0 and not self.options.shot_annotation_bucket:
             return self
-        video_path = self.storage.video_local_path
-        self.video = cv.VideoCapture(str(video_path))
-        if not self.video.isOpened():
-            raise RuntimeError(f"Could not open video <{video_path}>")
+        self.open_video(FRAME_CACHE_MAX_MB)
         self.compute_dimensions()
+        if self.options.shot_annotation_bucket:
+            self.shot_summary = self.create_shot_summary()
+        if 1 < self.options.decode_workers and not self.options.parallel:
+            self.start_decode_workers()
+        if self.shot_summary is not None:
+            self.tap_shot_summary()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.parallel_extractor is not None:
+            self.parallel_extractor.__exit__(exc_type, exc_value, traceback)
         if self.video is not None:
             self.video.release()
 
-    def gen_video_objects_filtered(self) -> Iterator[vi.ObjectTrackingAnnotation]:
-        for obj in self.annotations.annotation_results[0].object_annotations:
-            if all([MIN_CONFIDENCE <= obj.confidence, MIN_FRAMES <= len(obj.frames)]):
-                yield obj
+    def open_video(self, frame_cache_mb: int):
+        video_uri = self.storage.video_source.uri
+        self.video = cv.VideoCapture(video_uri)
+        if not self.video.isOpened():
+            raise RuntimeError(f"Could not open video <{video_uri}>")
+        extractor = FrameExtractor(self.video)
+        cache_frames = self.cache_frames(frame_cache_mb)
+        self.frame_cache = FrameCache(extractor, self.cell_image, cache_frames)
+
+    def start_decode_workers(self):
+        """Frames decoded by segments in worker processes, downscaled there
+        (to the frame size, or the shot summary cell size if wider)"""
+        worker_mb = self.options.decode_worker_mb
+        worker_count = decode_worker_count(self.options.decode_workers, worker_mb)
+        if worker_count < 2:
+            return
+        self.parallel_extractor = ParallelFrameExtractor(
+            self.video,
+            self.storage.video_source.uri,
+            worker_count,
+            worker_mb,
+            self.decoded_size(),
+        )
+        self.frame_cache.extractor = self.parallel_extractor
+
+    def decoded_size(self) -> ImageSize:
+        if self.shot_summary is None:
+            return self.frame_size
+        cell_size = ImageSize(*self.shot_summary.cell_size)
+        return max(self.frame_size, cell_size)  # Compared by width
+
+    def create_shot_summary(self) -> Optional[ShotSummary]:
+        """Shot summary to render (combined mode), if annotated and not up to date"""
+        video_shots = self.storage.get_video_shots(self.options.shot_annotation_bucket)
+        if not video_shots:
+            logging.warning("No video shots: skipping the shot summary")
+            return None
+        summary_bucket = self.options.summary_bucket
+        if self.storage.is_shot_summary_up_to_date(summary_bucket, SUMMARY_FORMATS):
+            print("Skipping up-to-date shot summary")
+            return None
+        print(f"Shots to summarize: {len(video_shots)}")
+        frame_w = int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))
+        frame_h = int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))
+        frame_index = self.frame_cache.extractor.frame_index
+        return ShotSummary(video_shots, (frame_w, frame_h), frame_index)
+
+    def tap_shot_summary(self):
+        """Shot summary frames decoded in the object rendering passes"""
+        self.tapped_extractor = TappedFrameExtractor(
+            self.frame_cache.extractor,
+            self.shot_summary.frame_indexes,
+            self.shot_summary.add_frame,
+        )
+        self.frame_cache.extractor = self.tapped_extractor
+
+    def cache_frames(self, frame_cache_mb: int) -> int:
+        """Number of decoded frames fitting in the cache (cell size at most)"""
+        frame_w = int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))
+        frame_h = int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))
+        frame_w = min(frame_w, IMAGE_MAX_SIZE.w)
+        frame_h = min(frame_h, IMAGE_MAX_SIZE.h)
+        return frame_cache_mb * 2 ** 20 // max(3 * frame_w * frame_h, 1)
 
     def compute_dimensions(self):
         cell_w = int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))
         cell_h = int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))
-        if self.animated:
+        if self.options.animated:
             cols = rows = 1
         else:
             # Grid trying to preserve the video aspect ratio
@@ -106,6 +259,9 @@ class VideoProcessor:
             scale = IMAGE_MAX_SIZE.w / (cell_w * cols)
             cell_w = int(scale * cell_w)
             cell_h = int(scale * cell_h)
+        self.frame_size = ImageSize(cell_w, cell_h)
+        if self.options.animated and self.options.cropped:
+            cell_w, cell_h = CROP_TILE_SIZE
         self.cell_size = ImageSize(cell_w, cell_h)
         self.grid_size = ImageSize(cell_w * cols, cell_h * rows)
 
@@ -119,99 +275,367 @@ class VideoProcessor:
             return
         grid_img = Image.new("RGB", self.grid_size, BACKGROUND_COLOR)
 
-        img_and_pos_iter = zip(self.gen_cell_img(), self.gen_cell_pos())
-        for cell_img, cell_pos in img_and_pos_iter:
-            grid_img.paste(cell_img, cell_pos)
+        cell_positions = list(self.gen_cell_pos(self.object_count))
+        for obj_idx, cell_img in self.gen_cell_img():
+            grid_img.paste(cell_img, cell_positions[obj_idx])
 
         self.upload_image(grid_img, SUMMARY_SUFFIX)
 
-    def gen_cell_img(self) -> Iterator[PilImage]:
-        for obj in self.gen_video_objects_filtered():
-            first_frame = obj.frames[0]
-            yield self.get_frame_with_overlay(obj, first_frame)
+    def gen_cell_img(self) -> Iterator[tuple[int, PilImage]]:
+        decode_span, compose_span = Span("decode"), Span("compose")
+        first_frames = [obj.times_ms[:1] for obj in self.tracks]
+        frame_sets = self.frame_cache.gen_frame_sets(first_frames)
+        for obj_idx, [image] in decode_span.timed(frame_sets):
+            if image is None:
+                continue
+            decode_span.add(frames=1)
+            with compose_span.measure():
+                cell_img = self.get_frame_with_overlay(obj_idx, 0, image)
+            yield obj_idx, cell_img
+        decode_span.end()
+        compose_span.end()
 
-    def gen_cell_pos(self) -> Iterator[tuple[int, int]]:
+    def gen_cell_pos(self, cell_count: int) -> Iterator[tuple[int, int]]:
         cell_x, cell_y = 0, 0
-        while True:
+        for _ in range(cell_count):
             yield cell_x, cell_y
             cell_x += self.cell_size.w
             if self.grid_size.w <= cell_x:  # Move to next row?
                 cell_x, cell_y = 0, cell_y + self.cell_size.h
 
     def render_object_animations(self):
-        for obj_idx, obj in enumerate(self.gen_video_objects_filtered()):
-            image_gen = (
-                self.get_frame_with_overlay(obj, frame)
-                for frame_idx, frame in enumerate(obj.frames)
-                if frame_idx < ANIM_MAX_FRAMES
-            )
+        worker_count = self.compute_worker_count() if self.options.parallel else 1
+        if 1 < worker_count:
+            rendered_images = self.gen_animations_parallel(worker_count)
+        else:
+            rendered_images = self.gen_animations(range(self.object_count))
+        for rendered_image in rendered_images:
+            self.storage.upload_image(*rendered_image)
+
+    def select_image_formats(self) -> list[ImageFormat]:
+        animated = self.options.animated
+        if animated:
+            formats, default_formats = ANIMATED_FORMATS, DEFAULT_ANIMATED_FORMATS
+        else:
+            formats, default_formats = STILL_FORMATS, DEFAULT_STILL_FORMATS
+        image_formats = []
+        for image_type in self.options.output_formats or default_formats:
+            image_format = formats.get(image_type)
+            if image_format is None or not is_format_supported(image_type, animated):
+                logging.warning("Skipping unsupported output format <%s>", image_type)
+                continue
+            image_formats.append(image_format)
+        if not image_formats:
+            raise RuntimeError("No supported output format")
+        return image_formats
+
+    def gen_animations(self, obj_indexes: Sequence[int]) -> Iterator[RenderedImage]:
+        """Renders the animations of the objects
+
+        Decoding (frame sets, converted frames included) and composition are
+        traced separately (also in worker processes, with their own memory use).
+        """
+        decode_span, compose_span = Span("decode"), Span("compose")
+        anim_rows = [self.anim_frame_rows(self.tracks[i]) for i in obj_indexes]
+        anim_frames = [
+            self.tracks[obj_idx].times_ms[rows]
+            for obj_idx, rows in zip(obj_indexes, anim_rows)
+        ]
+        frame_sets = self.frame_cache.gen_frame_sets(anim_frames)
+        for set_idx, images in decode_span.timed(frame_sets):
+            if all(image is None for image in images):
+                continue
+            decode_span.add(frames=sum(image is not None for image in images))
+            obj_idx, rows = obj_indexes[set_idx], anim_rows[set_idx]
+            obj = self.tracks[obj_idx]
+            with compose_span.measure():
+                if self.options.cropped:
+                    crops = self.crop_windows(obj, rows)
+                else:
+                    crops = [None] * len(rows)
+                anim_images = [
+                    self.get_frame_with_overlay(obj_idx, frame_idx, image, crop)
+                    for frame_idx, image, crop in zip(rows, images, crops)
+                    if image is not None
+                ]
+            compose_span.add(frames=len(anim_images))
             filename_suffix = ANIM_SUFFIX_FMT.format(
                 index=obj_idx,
-                entity=obj.entity.description,
+                entity=obj.entity,
                 confidence=int(obj.confidence * 100 + 0.5),
-                frames=len(obj.frames),
+                frames=obj.frame_count,
             )
-            self.upload_image(image_gen, filename_suffix)
+            yield from self.encode_images(anim_images, filename_suffix)
+        decode_span.end()
+        compose_span.end()
+
+    def anim_frame_rows(self, obj: ObjectTrack) -> np.ndarray:
+        """Track rows to animate: first frames, or evenly sampled when cropped"""
+        frame_count = min(obj.frame_count, ANIM_MAX_FRAMES)
+        if not self.options.cropped:
+            return np.arange(frame_count)
+        rows = np.linspace(0, obj.frame_count - 1, frame_count)
+        return np.unique(rows.round().astype(int))
+
+    def crop_windows(self, obj: ObjectTrack, rows: np.ndarray) -> np.ndarray:
+        """Stabilized crop windows around the object (left, top, right, bottom)
+
+        - Same window size for all frames (no zoom in/out), tile aspect ratio
+        - Window centers smoothed with a moving average (less shaky framing)
+        - No upscaling unless the frame is smaller than the tile
+        """
+        frame_w, frame_h = self.frame_size
+        tile_w, tile_h = self.cell_size
+        boxes = obj.boxes[rows] * (frame_w, frame_h, frame_w, frame_h)
+        pad = CROP_SMOOTHING_FRAMES // 2
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        centers = np.pad(centers, ((pad, pad), (0, 0)), "edge")
+        kernel = np.ones(CROP_SMOOTHING_FRAMES) / CROP_SMOOTHING_FRAMES
+        center_x = np.convolve(centers[:, 0], kernel, "valid")
+        center_y = np.convolve(centers[:, 1], kernel, "valid")
+
+        box_w, box_h = (boxes[:, 2:] - boxes[:, :2]).max(axis=0)
+        win_w = max(box_w, box_h * tile_w / tile_h, tile_w) * (1 + CROP_MARGIN_RATIO)
+        win_w = min(win_w, frame_w, frame_h * tile_w / tile_h)
+        win_h = win_w * tile_h / tile_w
+        left = np.clip(center_x - win_w / 2, 0, frame_w - win_w)
+        top = np.clip(center_y - win_h / 2, 0, frame_h - win_h)
+        return np.stack([left, top, left + win_w, top + win_h], axis=1)
+
+    def gen_animations_parallel(self, worker_count: int) -> Iterator[RenderedImage]:
+        """Renders chunks of objects in worker processes, uploads them as they come
+
+        - Each worker decodes its chunks with its own capture handle
+        - Shot summary frames (combined mode) are decoded by the workers along
+          with the chunks (see summary_chunks), only their cells are sent back
+        - Uploads (in this process) overlap with decoding and encoding (in workers)
+        """
+        chunks = self.object_chunks(worker_count * RENDER_CHUNKS_PER_WORKER)
+        summary_chunks = self.summary_chunks(chunks)
+        cache_mb = available_memory() // 2 ** 20 // worker_count - RENDER_WORKER_BASE_MB
+        cache_mb = min(max(cache_mb, RENDER_WORKER_MIN_CACHE_MB), FRAME_CACHE_MAX_MB)
+        print(f"Rendering {len(chunks)} chunks with {worker_count} workers")
+        # Forked workers inherit the annotations (nothing to serialize)
+        self.video.release()
+        self.video = None
+        mp_context = multiprocessing.get_context("fork")
+        init_args = (self, cache_mb)
+        with ProcessPoolExecutor(
+            worker_count, mp_context, init_render_worker, init_args
+        ) as executor:
+            futures = [
+                executor.submit(render_animation_chunk, chunk, summary_chunk)
+                for chunk, summary_chunk in zip(chunks, summary_chunks)
+            ]
+            for future in as_completed(futures):
+                rendered_images, summary_cells = future.result()
+                for frame_index, rgb_cell in summary_cells:
+                    self.shot_summary.add_cell(frame_index, rgb_cell)
+                yield from rendered_images
+
+    def object_chunks(self, chunk_count: int) -> list[list[int]]:
+        """Splits objects into chunks of neighbor objects (in time)"""
+
+        by_time = self.tracks.by_time.tolist()
+        chunk_size = -(-self.object_count // chunk_count)  # Rounded up
+        return [
+            by_time[i : i + chunk_size] for i in range(0, self.object_count, chunk_size)
+        ]
+
+    def summary_chunks(self, chunks: list[list[int]]) -> list[list[int]]:
+        """Shot summary frames decoded with each chunk of objects (by time)
+
+        - A frame goes with the last chunk starting before it, decoded in the
+          passes of the chunk or right after them (same worker)
+        - The tap of this process is emptied (its frames are decoded by workers)
+        """
+        summary_chunks: list[list[int]] = [[] for _ in chunks]
+        if self.tapped_extractor is None:
+            return summary_chunks
+        frame_index = self.tapped_extractor.frame_index
+        chunk_starts = [
+            frame_index(self.tracks[chunk[0]].times_ms[0]) for chunk in chunks
+        ]
+        for index in sorted(self.tapped_extractor.tap_indexes):
+            chunk_idx = max(bisect.bisect_right(chunk_starts, index) - 1, 0)
+            summary_chunks[chunk_idx].append(index)
+        self.tapped_extractor = None
+        return summary_chunks
+
+    def compute_worker_count(self) -> int:
+        """Adapts the number of workers to the available CPUs and memory"""
+        cpu_count = len(os.sched_getaffinity(0))
+        worker_mb = RENDER_WORKER_BASE_MB + RENDER_WORKER_MIN_CACHE_MB
+        memory_count = available_memory() // 2 ** 20 // worker_mb
+        return max(1, min(cpu_count, memory_count, self.object_count))
+
+    def decode_shot_summary(self):
+        """Decodes the shot summary frames not decoded for the objects"""
+        if self.tapped_extractor is None:
+            return
+        frame_count = len(self.tapped_extractor.tap_indexes)
+        with Span("decode", output="shot_summary", frames=frame_count):
+            self.tapped_extractor.flush()
+
+    def render_shot_summary(self):
+        if self.shot_summary is None:
+            return
+        self.decode_shot_summary()
+        summary_bucket = self.options.summary_bucket
+        for image_type in SUMMARY_FORMATS:
+            image_data = self.shot_summary.encode(image_type)
+            self.storage.upload_shot_summary(image_data, image_type, summary_bucket)
+
+    def render_chunk(
+        self, obj_indexes: Sequence[int], summary_indexes: Sequence[int]
+    ) -> tuple[list[RenderedImage], list[tuple[int, np.ndarray]]]:
+        """Animations of a chunk of objects (worker process), with the shot summary
+        cells planned with the chunk (decoded in the same passes)"""
+        summary_cells: list[tuple[int, np.ndarray]] = []
+        if not summary_indexes:
+            return list(self.gen_animations(obj_indexes)), summary_cells
+
+        def add_summary_frame(frame_index: int, cv_frame: CvFrame):
+            self.shot_summary.add_frame(frame_index, cv_frame)
+            summary_cells.append((frame_index, self.shot_summary.cell(frame_index)))
+
+        extractor = self.frame_cache.extractor
+        self.tapped_extractor = TappedFrameExtractor(
+            extractor, summary_indexes, add_summary_frame
+        )
+        self.frame_cache.extractor = self.tapped_extractor
+        try:
+            rendered_images = list(self.gen_animations(obj_indexes))
+            self.decode_shot_summary()
+        finally:
+            self.frame_cache.extractor = extractor
+            self.tapped_extractor = None
+        return rendered_images, summary_cells
+
+    def cell_image(self, cv_frame: CvFrame) -> PilImage:
+        image = Image.fromarray(cv.cvtColor(cv_frame, cv.COLOR_BGR2RGB))
+        image.thumbnail(self.frame_size)  # Makes it smaller if needed
+        return image
 
     def get_frame_with_overlay(
-        self, obj: vi.ObjectTrackingAnnotation, frame: vi.ObjectTrackingFrame
+        self,
+        obj_idx: int,
+        frame_idx: int,
+        image: PilImage,
+        crop: Optional[Sequence[float]] = None,
     ) -> PilImage:
-        def get_video_frame() -> PilImage:
-            pos_ms = frame.time_offset.total_seconds() * 1000
-            self.video.set(cv.CAP_PROP_POS_MSEC, pos_ms)
-            _, cv_frame = self.video.read()
-            image = Image.fromarray(cv.cvtColor(cv_frame, cv.COLOR_BGR2RGB))
-            image.thumbnail(self.cell_size)  # Makes it smaller if needed
-            return image
-
-        def add_caption(image: PilImage) -> PilImage:
-            description = obj.entity.description
-            confidence = obj.confidence
-            frames = len(obj.frames)
-            sep = "·"
-            text = f"{description} {sep} {confidence:.0%} {sep} {frames} fr."
-            padding_w, _ = self.font.getsize(sep)
-            text_w, _ = self.font.getsize(text)
-            w = text_w + 2 * padding_w
-            h = self.font_height
-            overlay = Image.new("RGBA", image.size, "#FFF0")
-            draw = ImageDraw.Draw(overlay)
-            draw.rectangle((0, 0, w, h), FONT_BG_COLOR)
-            draw.text((padding_w, 0), text, BBOX_COLOR, self.font)
-            return Image.alpha_composite(image.convert("RGBA"), overlay).convert("RGB")
-
-        def add_bounding_box(image: PilImage) -> PilImage:
-            image_w, image_h = image.size
-            bb = frame.normalized_bounding_box
+        """Returns a copy of the frame image with the object caption and bounding box
+
+        - Only the caption and bounding box regions are drawn/composited
+        - With a crop window, the copy is the window resized to the cell size
+        """
+        obj = self.tracks[obj_idx]
+        image_w, image_h = image.size
+        box_scale = (image_w, image_h, image_w, image_h)
+        left, top, right, bottom = obj.boxes[frame_idx] * box_scale
+        if crop is None:
+            image = image.copy()  # Cached frame images can be shared between objects
+        else:
+            crop_l, crop_t, crop_r, crop_b = crop
+            image = image.resize(self.cell_size, Image.BILINEAR, box=tuple(crop))
+            scale_x = self.cell_size.w / (crop_r - crop_l)
+            scale_y = self.cell_size.h / (crop_b - crop_t)
+            left, right = (left - crop_l) * scale_x, (right - crop_l) * scale_x
+            top, bottom = (top - crop_t) * scale_y, (bottom - crop_t) * scale_y
+
+        def add_caption():
+            caption = self.caption_sprite(obj_idx)
+            image.paste(caption, (0, 0), caption)  # Alpha blending in caption box
+
+        def add_bounding_box():
             r = (
-                int(image_w * bb.left + 0.5),
-                int(image_h * bb.top + 0.5),
-                int(image_w * bb.right + 1.5),
-                int(image_h * bb.bottom + 1.5),
+                int(left + 0.5),
+                int(top + 0.5),
+                int(right + 1.5),
+                int(bottom + 1.5),
             )
             draw = ImageDraw.Draw(image)
             draw.rectangle(r, outline=BBOX_COLOR, width=BBOX_WIDTH_PX)
-            return image
 
-        return add_bounding_box(add_caption(get_video_frame()))
+        add_caption()
+        add_bounding_box()
+        return image
+
+    def caption_sprite(self, obj_idx: int) -> PilImage:
+        """Returns the object caption (RGBA), rendered once per object"""
+        if (sprite := self.caption_sprites.get(obj_idx)) is not None:
+            return sprite
+        obj = self.tracks[obj_idx]
+        sep = "·"
+        text = f"{obj.entity} {sep} {obj.confidence:.0%} {sep} {obj.frame_count} fr."
+        padding_w, _ = self.font.getsize(sep)
+        text_w, _ = self.font.getsize(text)
+        w = text_w + 2 * padding_w
+        h = self.font_height
+        sprite_w = min(w + 1, self.cell_size.w)
+        sprite_h = min(h + 1, self.cell_size.h)
+        sprite = Image.new("RGBA", (sprite_w, sprite_h), "#FFF0")
+        draw = ImageDraw.Draw(sprite)
+        draw.rectangle((0, 0, w, h), FONT_BG_COLOR)
+        draw.text((padding_w, 0), text, BBOX_COLOR, self.font)
+        self.caption_sprites[obj_idx] = sprite
+        return sprite
 
     def upload_image(self, frames: PilFrames, filename_suffix: str):
-        mem_file = BytesIO()
+        for rendered_image in self.encode_images(frames, filename_suffix):
+            self.storage.upload_image(*rendered_image)
 
+    def encode_images(
+        self, frames: PilFrames, filename_suffix: str
+    ) -> list[RenderedImage]:
+        """Encodes the same rendered frames in every output format"""
         if isinstance(frames, PilImage):
-            image_type = "jpeg"  # webp soon ;)
-            first_frame = frames
-            save_parameters = dict()
+            first_frame, next_frames = frames, []
         else:
-            image_type = "gif"  # webp if you can (faster and x15 smaller)
-            first_frame = next(frames)
-            save_parameters = dict(
-                save_all=True,
-                append_images=frames,
-                duration=ANIM_FIXED_DURATION_MS,
-                loop=0,  # Infinite loop
-            )
-        first_frame.save(mem_file, format=image_type, **save_parameters)
+            first_frame, *next_frames = frames  # Rendered once for all formats
+
+        rendered_images = []
+        frame_count = 1 + len(next_frames)
+        for image_format in self.image_formats:
+            image_type = image_format.type
+            with Span("encode", format=image_type, frames=frame_count) as span:
+                mem_file = BytesIO()
+                save_parameters = image_format.save_parameters.copy()
+                if self.options.animated:
+                    save_parameters |= dict(
+                        save_all=True,
+                        append_images=next_frames,
+                        duration=ANIM_FIXED_DURATION_MS,
+                        loop=0,  # Infinite loop
+                    )
+                first_frame.save(mem_file, format=image_type, **save_parameters)
+                span.add(bytes=len(mem_file.getbuffer()))  # No copy
+            rendered_image = RenderedImage(mem_file, image_type, filename_suffix)
+            rendered_images.append(rendered_image)
+        return rendered_images
+
+
+def is_format_supported(image_type: str, animated: bool) -> bool:
+    Image.init()  # Registers the available plugins
+    format_id = image_type.upper()
+    if not animated:
+        return format_id in Image.SAVE
+    if format_id == "WEBP" and not features.check("webp_anim"):
+        return False
+    return format_id in Image.SAVE_ALL
+
+
+# Worker process state, inherited from the parent process (forked)
+worker_proc: Optional[VideoProcessor] = None
+
+
+def init_render_worker(video_proc: VideoProcessor, frame_cache_mb: int):
+    global worker_proc
+    worker_proc = video_proc
+    worker_proc.open_video(frame_cache_mb)  # Capture handle owned by the worker
+
 
-        image_bytes = mem_file.getvalue()
-        self.storage.upload_image(image_bytes, image_type, filename_suffix)
+def render_animation_chunk(
+    obj_indexes: list[int], summary_indexes: list[int]
+) -> tuple[list[RenderedImage], list[tuple[int, np.ndarray]]]:
+    return worker_proc.render_chunk(obj_indexes, summary_indexes)
@@ -0,0 +1,281 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Optional
+from urllib.parse import quote
+
+from storage_backend import ObjectInfo, get_backend, split_uri
+from tracing import Span
+
+ReadRange = Callable[[int, int], bytes]  # (start, end) -> bytes, end included
+
+STREAM_CHUNK_SIZE = 2 * 2 ** 20
+STREAM_READ_AHEAD_CHUNKS = 3  # Extra chunks fetched with each missing chunk
+STREAM_CACHE_MAX_CHUNKS = 32  # Bounded local cache (64 MB)
+assert STREAM_READ_AHEAD_CHUNKS < STREAM_CACHE_MAX_CHUNKS
+
+
+class VideoSource:
+    """Video readable by OpenCV with cv.VideoCapture(uri)
+
+    - read_range/size give direct access to the bytes (e.g. container indexes)
+    """
+
+    uri: str
+    size: int
+    read_range: ReadRange
+
+    def __enter__(self) -> "VideoSource":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class DownloadedVideo(VideoSource):
+    """Video fully downloaded to a local file"""
+
+    video_uri: str
+    generation: Optional[int]
+    local_path: Path
+
+    def __init__(
+        self, video_uri: str, local_path: Path, generation: Optional[int] = None
+    ):
+        self.video_uri = video_uri
+        self.generation = generation
+        self.local_path = local_path
+        self.uri = str(local_path)
+
+    def __enter__(self) -> "DownloadedVideo":
+        print(f"Downloading -> {self.local_path}")
+        with Span("download", uri=self.video_uri) as span:
+            backend = get_backend()
+            backend.download_to_file(self.video_uri, self.local_path, self.generation)
+            span.add(bytes=self.size)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.local_path.unlink()
+
+    @property
+    def size(self) -> int:
+        return self.local_path.stat().st_size
+
+    def read_range(self, start: int, end: int) -> bytes:
+        with open(self.local_path, "rb") as file:
+            file.seek(start)
+            return file.read(end - start + 1)
+
+
+class StreamedVideo(VideoSource):
+    """Video streamed to OpenCV from byte-range reads (nothing stored in /tmp)
+
+    - A local HTTP server exposes the video to OpenCV (FFmpeg http protocol)
+    - FFmpeg seeks with "Range" requests, served from a bounded chunk cache
+    - Missing chunks are fetched with ranged reads, including some read-ahead
+    - read_range/size can come from any source (e.g. the storage backend with
+      from_object, or a local file for tests)
+    - Fetched bytes are traced when the stream ends
+    """
+
+    name: str
+    size: int
+    read_range: ReadRange
+    server: Optional[ThreadingHTTPServer] = None
+    span: Span
+
+    def __init__(self, name: str, size: int, read_range: ReadRange):
+        self.name = name
+        self.size = size
+        self.read_range = read_range
+
+    @classmethod
+    def from_object(cls, video: ObjectInfo) -> "StreamedVideo":
+        """Video read from the storage backend (at the same generation)"""
+        backend = get_backend()
+
+        def read_range(start: int, end: int) -> bytes:
+            return backend.read_bytes(video.uri, start, end, video.generation)
+
+        _, name = split_uri(video.uri)
+        return cls(name, video.size, read_range)
+
+    def __enter__(self) -> "StreamedVideo":
+        self.span = Span("stream", video=self.name)
+        self.span.__enter__()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        self.server.cache = ChunkCache(self.read_range, self.size)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.uri = f"http://{host}:{port}/{quote(self.name)}"
+        print(f"Streaming -> {self.uri}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            cache: ChunkCache = self.server.cache
+            self.span.add(bytes=cache.fetched_bytes, reads=cache.read_count)
+            self.span.__exit__(exc_type, exc_value, traceback)
+
+
+class ChunkCache:
+    """Bounded LRU cache of fixed-size chunks (thread-safe)
+
+    - Missing chunks are fetched outside the lock (cached chunks are served
+      meanwhile), with read-ahead up to the next cached or fetched chunk
+    - Requests for chunks being fetched wait for that fetch (no duplicate read)
+    """
+
+    read_range: ReadRange
+    size: int
+    chunks: OrderedDict[int, bytes]
+    fetching: dict[int, Future]  # Chunks being fetched
+    fetched_bytes: int = 0
+    read_count: int = 0
+
+    def __init__(self, read_range: ReadRange, size: int):
+        self.read_range = read_range
+        self.size = size
+        self.chunk_count = -(-size // STREAM_CHUNK_SIZE)  # Rounded up
+        self.chunks = OrderedDict()
+        self.fetching = {}
+        self.lock = threading.Lock()
+
+    def chunk(self, index: int) -> bytes:
+        with self.lock:
+            if (data := self.chunks.get(index)) is not None:
+                self.chunks.move_to_end(index)
+                return data
+            if (future := self.fetching.get(index)) is None:
+                futures = self.plan_fetch(index)
+        if future is not None:
+            return future.result()  # Fetched by another request
+        self.fetch(futures)
+        return futures[index].result()
+
+    def plan_fetch(self, index: int) -> dict[int, Future]:
+        """Chunks to fetch from a missing chunk, marked as being fetched (lock held)"""
+        last = index
+        max_last = min(index + STREAM_READ_AHEAD_CHUNKS, self.chunk_count - 1)
+        while last < max_last and last + 1 not in self.chunks:
+            if last + 1 in self.fetching:
+                break
+            last += 1
+        futures = {i: Future() for i in range(index, last + 1)}
+        self.fetching.update(futures)
+        return futures
+
+    def fetch(self, futures: dict[int, Future]):
+        """Reads consecutive chunks (lock released), then caches them"""
+        first, last = min(futures), max(futures)
+        start = first * STREAM_CHUNK_SIZE
+        end = min((last + 1) * STREAM_CHUNK_SIZE, self.size) - 1
+        try:
+            data = self.read_range(start, end)
+        except Exception as error:
+            with self.lock:
+                for i, future in futures.items():
+                    del self.fetching[i]
+                    future.set_exception(error)
+            raise
+        with self.lock:
+            self.fetched_bytes += len(data)
+            self.read_count += 1
+            for i, future in futures.items():
+                offset = (i - first) * STREAM_CHUNK_SIZE
+                chunk = data[offset : offset + STREAM_CHUNK_SIZE]
+                self.chunks[i] = chunk
+                self.chunks.move_to_end(i)
+                del self.fetching[i]
+                future.set_result(chunk)
+            while STREAM_CACHE_MAX_CHUNKS < len(self.chunks):
+                self.chunks.popitem(last=False)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves the cached video with support for "Range: bytes=..." requests"""
+
+    protocol_version = "HTTP/1.1"
+    range_pattern = re.compile(r"bytes=(\d*)-(\d*)$")
+
+    def do_HEAD(self):
+        self.send_content(body=False)
+
+    def do_GET(self):
+        self.send_content(body=True)
+
+    def send_content(self, body: bool):
+        cache: ChunkCache = self.server.cache
+        size = cache.size
+        start, end = 0, size - 1
+        if (range_header := self.headers.get("Range")) is not None:
+            match = self.range_pattern.match(range_header.strip())
+            if match is None or not any(match.groups()):
+                return self.send_unsatisfiable(size)
+            first, last = match.groups()
+            if first:
+                start, end = int(first), min(int(last or end), end)
+            else:  # Suffix range: last N bytes
+                start = max(size - int(last), 0)
+            if end < start:
+                return self.send_unsatisfiable(size)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if body:
+            self.write_range(cache, start, end)
+
+    def write_range(self, cache: ChunkCache, start: int, end: int):
+        pos = start
+        try:
+            while pos <= end:
+                index, offset = divmod(pos, STREAM_CHUNK_SIZE)
+                data = cache.chunk(index)[offset : offset + end - pos + 1]
+                if not data:  # Object shorter than its size: truncated response
+                    self.close_connection = True
+                    break
+                self.wfile.write(data)
+                pos += len(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # FFmpeg closes the connection when seeking elsewhere
+
+    def end_headers(self):
+        if self.close_connection:  # Requested by the client ("Connection: close")
+            # Stated in the response: FFmpeg reuses connections otherwise
+            self.send_header("Connection", "close")
+        super().end_headers()
+
+    def send_unsatisfiable(self, size: int):
+        self.send_response(416)
+        self.send_header("Content-Range", f"bytes */{size}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass  # One line per range request would flood the logs
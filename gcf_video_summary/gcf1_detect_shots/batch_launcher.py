@@ -0,0 +1,181 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import logging
+import time
+from io import BytesIO
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from google.cloud import videointelligence
+
+from storage_backend import ObjectInfo, StorageBackend, get_backend, split_uri
+from tracing import Span
+
+LAUNCHES_PER_MINUTE = 20  # Keeps bursts of launches within the API quota
+# Rate-limit waits of a batch, well within the HTTP function timeout (60 s by
+# default): the remaining videos are deferred (to be sent again)
+BATCH_MAX_WAIT_S = 30.0
+# Annotation metadata identifying the annotated video content
+SOURCE_GENERATION_KEY = "source_generation"
+SOURCE_HASH_KEY = "source_hash"
+
+STATUS_LAUNCHED = "launched"
+STATUS_ANNOTATED = "annotated"  # Annotated locally, without the API
+STATUS_UP_TO_DATE = "up-to-date"
+STATUS_DEFERRED = "deferred"  # Not launched: batch wait budget exhausted
+
+# Local alternative to the API: video object -> results (same JSON structure)
+LocalAnnotator = Callable[[ObjectInfo], dict]
+
+
+class LaunchResult(NamedTuple):
+    video_uri: str
+    status: str
+
+
+class BatchLauncher:
+    """Launches annotate_video requests, skipping videos already annotated
+
+    - Storage backend and Video Intelligence client are shared by all launches
+    - An annotation is up to date if it was generated from the same content
+    - Launches are rate-limited (LAUNCHES_PER_MINUTE): a batch waits up to
+      BATCH_MAX_WAIT_S in total, then defers the launches it can't make
+    - Each launch is traced with its status (see tracing)
+    - Videos up to local_max_size bytes can be annotated locally (if a local
+      annotator is provided), saving the API round-trip
+
+    Naming convention:
+    - video_uri: gs://video_bucket/path/to/video.ext
+    - annot_uri: gs://annot_bucket/video_bucket/path/to/video.ext.json
+    """
+
+    feature: videointelligence.Feature
+    backend: StorageBackend
+    video_client: videointelligence.VideoIntelligenceServiceClient
+    local_annotator: Optional[LocalAnnotator]
+    local_max_size: Optional[int]
+    last_launch_time: Optional[float] = None
+
+    def __init__(
+        self,
+        feature: videointelligence.Feature,
+        local_annotator: Optional[LocalAnnotator] = None,
+        local_max_size: Optional[int] = None,
+    ):
+        self.feature = feature
+        self.backend = get_backend()
+        self.video_client = videointelligence.VideoIntelligenceServiceClient()
+        self.local_annotator = local_annotator
+        self.local_max_size = local_max_size
+
+    def launch_batch(
+        self, video_uris: Iterable[str], annot_bucket: str
+    ) -> list[LaunchResult]:
+        results = []
+        deadline = time.monotonic() + BATCH_MAX_WAIT_S
+        for video_uri in dict.fromkeys(video_uris):  # Unique URIs, same order
+            try:
+                status = self.launch(video_uri, annot_bucket, deadline)
+            except Exception as error:
+                logging.exception("Could not launch annotation of <%s>", video_uri)
+                status = f"error: {error}"
+            results.append(LaunchResult(video_uri, status))
+        return results
+
+    def launch(
+        self, video_uri: str, annot_bucket: str, deadline: Optional[float] = None
+    ) -> str:
+        """Launch status (deferred if the rate limit can't be met by the deadline,
+        a time.monotonic() value)"""
+        with Span("launch", uri=video_uri) as span:
+            status = self.launch_or_skip(video_uri, annot_bucket, deadline)
+            span.set(status=status)
+        return status
+
+    def launch_or_skip(
+        self, video_uri: str, annot_bucket: str, deadline: Optional[float] = None
+    ) -> str:
+        video = self.backend.get_info(video_uri)  # Generation and hash
+        if video is None:
+            raise RuntimeError(f"Video not found <{video_uri}>")
+        video_bucket, path_to_video = split_uri(video_uri)
+        annot_uri = f"gs://{annot_bucket}/{video_bucket}/{path_to_video}.json"
+        annotation = self.backend.get_info(annot_uri)
+        if is_up_to_date(video, annotation):
+            if SOURCE_HASH_KEY not in annotation.metadata:
+                # Annotated after the upload: record the source for future checks
+                self.backend.update_metadata(annot_uri, source_metadata(video))
+            print(f"Skipping up-to-date annotation <{annot_uri}>")
+            return STATUS_UP_TO_DATE
+        if self.is_local(video):
+            self.annotate_locally(video, annot_uri)
+            return STATUS_ANNOTATED
+
+        feature_name = self.feature.name.lower().replace("_", " ")
+        print(f"Launching {feature_name} for <{video_uri}>...")
+        features = [self.feature]
+        request = dict(features=features, input_uri=video_uri, output_uri=annot_uri)
+        if not self.wait_for_rate_limit(deadline):
+            print(f"Deferring {feature_name} for <{video_uri}> (rate limit)")
+            return STATUS_DEFERRED
+        self.video_client.annotate_video(request)
+        return STATUS_LAUNCHED
+
+    def is_local(self, video: ObjectInfo) -> bool:
+        if self.local_annotator is None or self.local_max_size is None:
+            return False
+        return video.size <= self.local_max_size
+
+    def annotate_locally(self, video: ObjectInfo, annot_uri: str):
+        feature_name = self.feature.name.lower().replace("_", " ")
+        print(f"Local {feature_name} for <{annot_uri}>...")
+        with Span("local_annotation", uri=video.uri, video_bytes=video.size) as span:
+            results = self.local_annotator(video)
+            json_data = BytesIO(json.dumps(results).encode())
+            metadata = source_metadata(video)
+            self.backend.upload(annot_uri, json_data, "application/json", metadata)
+            span.add(bytes=len(json_data.getbuffer()))
+
+    def wait_for_rate_limit(self, deadline: Optional[float] = None) -> bool:
+        """Waits for the next launch slot, unless it comes after the deadline"""
+        wait_s = 0.0
+        if self.last_launch_time is not None:
+            next_launch_time = self.last_launch_time + 60 / LAUNCHES_PER_MINUTE
+            wait_s = max(next_launch_time - time.monotonic(), 0.0)
+        if deadline is not None and deadline < time.monotonic() + wait_s:
+            return False
+        time.sleep(wait_s)
+        self.last_launch_time = time.monotonic()
+        return True
+
+
+def is_up_to_date(video: ObjectInfo, annotation: Optional[ObjectInfo]) -> bool:
+    """Whether the annotation was generated from the current video content"""
+    if annotation is None:
+        return False
+    metadata = annotation.metadata
+    if SOURCE_HASH_KEY in metadata:
+        return metadata[SOURCE_HASH_KEY] == video.content_hash  # Same content
+    # Generations are creation timestamps (microseconds): annotated after the
+    # current video upload?
+    return video.generation <= annotation.generation
+
+
+def source_metadata(video: ObjectInfo) -> dict[str, str]:
+    return {
+        SOURCE_GENERATION_KEY: str(video.generation),
+        SOURCE_HASH_KEY: video.content_hash,
+    }
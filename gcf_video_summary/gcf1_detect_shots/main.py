@@ -14,34 +14,61 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import os
+import tempfile
+from pathlib import Path
+from typing import Optional
 
-from google.cloud import storage, videointelligence
+from google.cloud import videointelligence
+
+import tracing
+from batch_launcher import BatchLauncher
+from shot_detector import detect_shot_annotations
+from storage_backend import ObjectInfo, split_uri
+from video_source import DownloadedVideo
 
 ANNOTATION_BUCKET = os.getenv("ANNOTATION_BUCKET", "")
 assert ANNOTATION_BUCKET, "Undefined ANNOTATION_BUCKET environment variable"
+EXECUTION_ID_HEADER = "Function-Execution-Id"  # Correlates the traces of a request
+# Videos up to this size are analyzed locally (0: always use the API)
+LOCAL_DETECTION_MAX_MB = int(os.getenv("LOCAL_DETECTION_MAX_MB", "0"))
+
+launcher: Optional[BatchLauncher] = None  # Reused by warm invocations
+
+
+def get_launcher() -> BatchLauncher:
+    global launcher
+    if launcher is None:
+        local_max_size = LOCAL_DETECTION_MAX_MB * 2 ** 20 or None
+        launcher = BatchLauncher(
+            videointelligence.Feature.SHOT_CHANGE_DETECTION,
+            detect_shots_locally,
+            local_max_size,
+        )
+    return launcher
 
 
-def launch_shot_detection(video_uri: str, annot_bucket: str):
+def detect_shots_locally(video: ObjectInfo) -> dict:
+    """Detect video shots in the function (no API call, CPU only)"""
+    local_path = Path(tempfile.gettempdir(), *split_uri(video.uri))
+    with DownloadedVideo(video.uri, local_path, video.generation) as local_video:
+        return detect_shot_annotations(local_video.uri, video.uri)
+
+
+def launch_shot_detection(video_uri: str, annot_bucket: str) -> str:
     """Detect video shots (asynchronous operation)
 
     Results will be stored in <annot_uri> with this naming convention:
     - video_uri: gs://video_bucket/path/to/video.ext
     - annot_uri: gs://annot_bucket/video_bucket/path/to/video.ext.json
-    """
-    print(f"Launching shot detection for <{video_uri}>...")
-    features = [videointelligence.Feature.SHOT_CHANGE_DETECTION]
-    video_blob = storage.Blob.from_string(video_uri)
-    video_bucket = video_blob.bucket.name
-    path_to_video = video_blob.name
-    annot_uri = f"gs://{annot_bucket}/{video_bucket}/{path_to_video}.json"
-    request = dict(features=features, input_uri=video_uri, output_uri=annot_uri)
 
-    video_client = videointelligence.VideoIntelligenceServiceClient()
-    video_client.annotate_video(request)
+    Videos with an up-to-date annotation are skipped (status returned).
+    """
+    return get_launcher().launch(video_uri, annot_bucket)
 
 
 def gcf_detect_shots(data, context):
     """Cloud Function triggered by a new Cloud Storage object"""
+    tracing.start_invocation(context.event_id)
     video_bucket = data["bucket"]
     path_to_video = data["name"]
     video_uri = f"gs://{video_bucket}/{path_to_video}"
@@ -50,13 +77,34 @@ def gcf_detect_shots(data, context):
 
 def gcf_detect_shots_http(request):
     """Cloud Function triggered by an HTTP GET request"""
+    tracing.start_invocation(request.headers.get(EXECUTION_ID_HEADER, ""))
     if request.method != "GET":
         return ("Please use a GET request", 403)
     if not request.args or "video_uri" not in request.args:
         return ('Please specify a "video_uri" parameter', 400)
     video_uri = request.args["video_uri"]
-    launch_shot_detection(video_uri, ANNOTATION_BUCKET)
-    return f"Launched shot detection for <{video_uri}>"
+    status = launch_shot_detection(video_uri, ANNOTATION_BUCKET)
+    return f"Shot detection for <{video_uri}>: {status}"
+
+
+def gcf_detect_shots_batch_http(request):
+    """Cloud Function triggered by an HTTP request with multiple videos
+
+    - GET: one or more "video_uri" parameters
+    - POST: JSON body {"video_uris": [...]}
+    """
+    tracing.start_invocation(request.headers.get(EXECUTION_ID_HEADER, ""))
+    if request.method == "GET":
+        video_uris = request.args.getlist("video_uri")
+    elif request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        video_uris = body.get("video_uris", [])
+    else:
+        return ("Please use a GET or POST request", 403)
+    if not video_uris:
+        return ('Please specify "video_uri" parameters or "video_uris"', 400)
+    results = get_launcher().launch_batch(video_uris, ANNOTATION_BUCKET)
+    return dict(results=[result._asdict() for result in results])
 
 
 if __name__ == "__main__":
@@ -65,7 +113,8 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "video_uri", type=str, help="gs://video_bucket/path/to/video.ext"
+        "video_uris", type=str, nargs="+", help="gs://video_bucket/path/to/video.ext"
     )
     args = parser.parse_args()
-    launch_shot_detection(args.video_uri, ANNOTATION_BUCKET)
+    for result in get_launcher().launch_batch(args.video_uris, ANNOTATION_BUCKET):
+        print(f"{result.status:>10} <{result.video_uri}>")
@@ -0,0 +1,161 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import math
+from typing import Iterable, Iterator
+
+import cv2 as cv
+import numpy as np
+
+DETECTION_WIDTH = 128  # Frames are analyzed at this reduced width
+BATCH_FRAMES = 256  # Frames scored together (vectorized)
+HISTOGRAM_BITS = 3  # Color histograms with 2**3 bins per channel (512 bins)
+HISTOGRAM_WEIGHT = 0.7  # Cut score: histogram distance + pixel difference
+MIN_CUT_SCORE = 0.25  # Lower scores are never cuts
+ADAPTIVE_WINDOW_S = 1.0  # Neighbors (on each side) giving the local score level
+ADAPTIVE_STD_FACTOR = 4.0  # Cuts stand out from the local score level
+MIN_SHOT_S = 0.5  # Cuts closer than this are ignored (flashes, fast motion)
+
+
+def detect_shot_annotations(video_uri: str, input_uri: str) -> dict:
+    """Detects the video shots locally (CPU only)
+
+    - Same JSON structure as the Video Intelligence API output (shot_annotations)
+    - The video is decoded once, frames are only kept at reduced resolution
+    """
+    video = cv.VideoCapture(video_uri)
+    if not video.isOpened():
+        raise RuntimeError(f"Could not open video <{video_uri}>")
+    try:
+        fps = video.get(cv.CAP_PROP_FPS)
+        if not 0 < fps:
+            raise RuntimeError(f"Unknown frame rate for <{video_uri}>")
+        scores = cut_scores(gen_frame_batches(video))
+    finally:
+        video.release()
+    frame_count = len(scores)
+    if frame_count == 0:
+        raise RuntimeError(f"No decodable frames in <{video_uri}>")
+
+    shot_starts = [0, *detect_cuts(scores, fps)]
+    shot_ends = [start - 1 for start in shot_starts[1:]] + [frame_count - 1]
+    print(f"Detected shots: {len(shot_starts)} ({frame_count} frames)")
+
+    def time_offset(frame: int) -> dict:
+        # Rounded up: the frame position maps back to the same frame index
+        total_nanos = math.ceil(frame * 10 ** 9 / fps)
+        seconds, nanos = divmod(total_nanos, 10 ** 9)
+        return dict(seconds=seconds, nanos=nanos)
+
+    def segment(first_frame: int, last_frame: int) -> dict:
+        return dict(
+            start_time_offset=time_offset(first_frame),
+            end_time_offset=time_offset(last_frame),
+        )
+
+    shot_annotations = [segment(*shot) for shot in zip(shot_starts, shot_ends)]
+    results = dict(
+        input_uri=input_uri,
+        segment=segment(0, frame_count - 1),
+        shot_annotations=shot_annotations,
+    )
+    return dict(annotation_results=[results])
+
+
+def gen_frame_batches(video: cv.VideoCapture) -> Iterator[np.ndarray]:
+    """Yields batches of consecutive frames at reduced resolution (BGR)"""
+    frame_w = int(video.get(cv.CAP_PROP_FRAME_WIDTH))
+    frame_h = int(video.get(cv.CAP_PROP_FRAME_HEIGHT))
+    width = min(DETECTION_WIDTH, frame_w)
+    size = (width, max(frame_h * width // max(frame_w, 1), 1))
+    batch = []
+    while True:
+        ok, frame = video.read()
+        if not ok:
+            break
+        batch.append(cv.resize(frame, size, interpolation=cv.INTER_AREA))
+        if len(batch) == BATCH_FRAMES:
+            yield np.stack(batch)
+            batch = []
+    if batch:
+        yield np.stack(batch)
+
+
+def cut_scores(frame_batches: Iterable[np.ndarray]) -> np.ndarray:
+    """Score of each frame in [0, 1], compared to the previous frame (0 for the 1st)
+
+    - Color histogram distance: robust to motion within a shot
+    - Mean pixel difference: catches cuts between similar color distributions
+    """
+    scores = []
+    last_histogram = last_gray = None
+    for frames in frame_batches:
+        histograms = color_histograms(frames)
+        grays = frames.mean(axis=3, dtype=np.float32)
+        if last_histogram is None:  # First frame: compared to itself
+            last_histogram, last_gray = histograms[0], grays[0]
+        previous_histograms = np.concatenate([last_histogram[None], histograms[:-1]])
+        previous_grays = np.concatenate([last_gray[None], grays[:-1]])
+        histogram_distances = 0.5 * np.abs(histograms - previous_histograms).sum(axis=1)
+        pixel_differences = np.abs(grays - previous_grays).mean(axis=(1, 2)) / 255
+        scores.append(
+            HISTOGRAM_WEIGHT * histogram_distances
+            + (1 - HISTOGRAM_WEIGHT) * pixel_differences
+        )
+        last_histogram, last_gray = histograms[-1], grays[-1]
+    return np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+
+
+def color_histograms(frames: np.ndarray) -> np.ndarray:
+    """Normalized 3D color histograms (one row per frame)"""
+    frame_count = len(frames)
+    bins = 1 << HISTOGRAM_BITS
+    bin_count = bins ** 3
+    quantized = (frames >> (8 - HISTOGRAM_BITS)).astype(np.int32)
+    bin_indexes = (quantized[..., 0] * bins + quantized[..., 1]) * bins
+    bin_indexes += quantized[..., 2]
+    bin_indexes = bin_indexes.reshape(frame_count, -1)
+    pixel_count = bin_indexes.shape[1]
+    bin_indexes += np.arange(frame_count, dtype=np.int32)[:, None] * bin_count
+    counts = np.bincount(bin_indexes.ravel(), minlength=frame_count * bin_count)
+    return counts.reshape(frame_count, bin_count) / pixel_count
+
+
+def detect_cuts(scores: np.ndarray, fps: float) -> list[int]:
+    """Indexes of the frames starting a new shot
+
+    A cut score must exceed an adaptive threshold: the mean of the neighbor
+    scores plus a multiple of their standard deviation (fast motion raises it).
+    """
+    window = max(int(ADAPTIVE_WINDOW_S * fps), 1)
+    kernel_size = 2 * window + 1
+    padded = np.pad(scores.astype(np.float64), window, mode="edge")
+    sums = np.concatenate([[0.0], np.cumsum(padded)])
+    square_sums = np.concatenate([[0.0], np.cumsum(padded ** 2)])
+    # Neighbor sums (sliding window without the frame itself)
+    neighbor_sums = sums[kernel_size:] - sums[:-kernel_size] - scores
+    neighbor_square_sums = square_sums[kernel_size:] - square_sums[:-kernel_size]
+    neighbor_square_sums -= scores.astype(np.float64) ** 2
+    means = neighbor_sums / (kernel_size - 1)
+    variances = np.maximum(neighbor_square_sums / (kernel_size - 1) - means ** 2, 0)
+    thresholds = means + ADAPTIVE_STD_FACTOR * np.sqrt(variances)
+    thresholds = np.maximum(thresholds, MIN_CUT_SCORE)
+
+    min_shot_frames = max(int(MIN_SHOT_S * fps), 1)
+    cuts: list[int] = []
+    for frame in np.flatnonzero(thresholds < scores).tolist():
+        if min_shot_frames <= frame - (cuts[-1] if cuts else 0):
+            cuts.append(frame)
+    return cuts
@@ -0,0 +1,126 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional, TypeVar
+
+# Span records are logged as JSON lines (structured logs in Cloud Logging)
+TRACING = os.getenv("TRACING", "1") == "1"
+T = TypeVar("T")
+
+invocation_id = ""  # Correlates the records of an invocation (one at a time)
+
+
+class Span:
+    """Timed phase of an invocation, logged as a structured record when ended
+
+    - Used as a context manager (a single interval), or measured over several
+      intervals with measure/timed for interleaved phases (e.g. decode/compose)
+      and ended explicitly
+    - Counters (bytes, frames...) are added along the way
+    - Records include the memory use: current and peak RSS of the process (and
+      peak RSS of the ended worker processes)
+    """
+
+    name: str
+    fields: dict
+    duration_s: float = 0.0
+    start: float = 0.0
+
+    def __init__(self, name: str, **fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration_s += time.perf_counter() - self.start
+        self.end(exc_value)
+
+    @contextmanager
+    def measure(self) -> Iterator["Span"]:
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.duration_s += time.perf_counter() - start
+
+    def timed(self, items: Iterable[T]) -> Iterator[T]:
+        """Yields the items, only measuring the time spent producing them"""
+        iterator, done = iter(items), object()
+        while True:
+            with self.measure():
+                item = next(iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def add(self, **counts: int):
+        for key, count in counts.items():
+            self.fields[key] = self.fields.get(key, 0) + count
+
+    def end(self, error: Optional[BaseException] = None):
+        if not TRACING:
+            return
+        duration_ms = self.duration_s * 1000
+        message = f"{self.name}: {duration_ms:.0f} ms"
+        if self.fields:
+            details = ", ".join(f"{key}={value}" for key, value in self.fields.items())
+            message = f"{message} ({details})"
+        record = dict(
+            severity="INFO" if error is None else "ERROR",
+            message=message,
+            span=self.name,
+            invocation=invocation_id,
+            duration_ms=round(duration_ms, 1),
+        )
+        record |= self.fields | memory_fields()
+        if error is not None:
+            record["error"] = repr(error)
+        # Single write: records of concurrent threads don't interleave
+        sys.stdout.write(json.dumps(record, default=str) + "\n")
+        sys.stdout.flush()
+
+
+def start_invocation(new_invocation_id: str):
+    global invocation_id
+    invocation_id = new_invocation_id
+
+
+def memory_fields() -> dict[str, float]:
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    try:
+        with open("/proc/self/statm") as statm:
+            rss = int(statm.read().split()[1]) * page_size
+    except (OSError, IndexError, ValueError):
+        rss = 0
+    # Peak RSS in KiB (Linux), lagging a bit behind the current RSS
+    peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = max(peak_kib * 2 ** 10, rss)
+    worker_peak_kib = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    fields = dict(rss_mb=round(rss / 2 ** 20, 1), peak_rss_mb=round(peak / 2 ** 20, 1))
+    if worker_peak_kib:
+        fields["worker_peak_rss_mb"] = round(worker_peak_kib / 2 ** 10, 1)
+    return fields
@@ -0,0 +1,211 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import struct
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+
+from video_source import ReadRange
+
+BOX_HEADER_SIZE = 8  # 32-bit size + type (a 64-bit size can follow)
+TOP_LEVEL_MAX_BOXES = 64  # Gives up on files which don't look like MP4/MOV
+VIDEO_HANDLER = b"vide"
+# Edit list entries by box version: segment duration, media time, rate
+EDIT_DTYPES = {
+    0: np.dtype([("duration", ">u4"), ("media_time", ">i4"), ("rate", ">i4")]),
+    1: np.dtype([("duration", ">u8"), ("media_time", ">i8"), ("rate", ">i4")]),
+}
+NORMAL_RATE = 1 << 16  # 16.16 fixed point
+
+
+def read_keyframe_indexes(read_range: ReadRange, size: int) -> Optional[Sequence[int]]:
+    """Keyframe indexes of the 1st video track of an MP4/MOV file (sorted)
+
+    - Read from the sync sample table (stss) of the moov box, wherever it is
+    - Sync samples (decode order) are mapped to presentation frame indexes:
+      composition offsets (ctts, B-frames) and edit list start (elst)
+    - Every frame is a keyframe if the track has no sync sample table
+    - None if unavailable (other containers, fragmented MP4, edit lists with
+      several edits...)
+    """
+    moov = read_top_level_box(read_range, size, b"moov")
+    if moov is None:
+        return None
+    for trak in gen_boxes(moov, b"trak"):
+        hdlr = find_box(trak, b"mdia", b"hdlr")
+        if hdlr is None or bytes(hdlr[8:12]) != VIDEO_HANDLER:
+            continue
+        stbl = find_box(trak, b"mdia", b"minf", b"stbl")
+        if stbl is None:
+            return None
+        stsz = find_box(stbl, b"stsz") or find_box(stbl, b"stz2")
+        sample_count = struct.unpack_from(">I", stsz, 8)[0] if stsz else 0
+        if sample_count == 0:
+            return None  # Fragmented MP4: samples are described in moof boxes
+        stss = find_box(stbl, b"stss")
+        if stss is None:
+            return range(sample_count)
+        sample_numbers = read_entries(stss, np.dtype(">u4"))
+        if sample_numbers is None:
+            return None
+        samples = sample_numbers.astype(np.int64) - 1  # Sample numbers start at 1
+        samples = samples[(0 <= samples) & (samples < sample_count)]
+        elst = find_box(trak, b"edts", b"elst")
+        keyframes = presentation_indexes(stbl, elst, sample_count, samples)
+        if keyframes is None:
+            return None
+        return np.unique(keyframes[0 <= keyframes]).tolist()  # Sorted
+    return None
+
+
+def presentation_indexes(
+    stbl: memoryview,
+    elst: Optional[memoryview],
+    sample_count: int,
+    samples: np.ndarray,
+) -> Optional[np.ndarray]:
+    """Presentation frame indexes of samples (decode order indexes)
+
+    - Samples are ordered by composition time: decode time (stts) + offset (ctts)
+    - Samples composed before the start of the edit list get negative indexes
+    - None if the tables are inconsistent or the edit list is not supported
+    """
+    media_time = read_media_time(elst) if elst is not None else 0
+    if media_time is None:
+        return None
+    ctts = find_box(stbl, b"ctts")
+    if ctts is None and media_time == 0:
+        return samples  # Presented in decode order
+    stts = find_box(stbl, b"stts")
+    if stts is None:
+        return None
+    time_deltas = read_sample_values(stts, np.dtype(">u4"), sample_count)
+    offsets = np.zeros(sample_count, np.int64)
+    if ctts is not None:
+        # Signed offsets (version 1), also found in version 0 tables
+        offsets = read_sample_values(ctts, np.dtype(">i4"), sample_count)
+    if time_deltas is None or offsets is None:
+        return None
+    decode_times = np.cumsum(time_deltas) - time_deltas
+    composition_times = decode_times + offsets
+    order = np.argsort(composition_times, kind="stable")
+    frame_indexes = np.empty(sample_count, np.int64)
+    frame_indexes[order] = np.arange(sample_count)
+    frame_indexes -= np.count_nonzero(composition_times < media_time)
+    return frame_indexes[samples]
+
+
+def read_media_time(elst: memoryview) -> Optional[int]:
+    """Media time where the presentation starts (single edit at normal rate)"""
+    if not elst or elst[0] not in EDIT_DTYPES:  # Box version
+        return None
+    edits = read_entries(elst, EDIT_DTYPES[elst[0]])
+    # Empty edits (-1) delay the presentation, other rates change the timing
+    if edits is None or len(edits) != 1:
+        return None
+    [(_, media_time, rate)] = edits
+    if media_time < 0 or rate != NORMAL_RATE:
+        return None
+    return int(media_time)
+
+
+def read_sample_values(
+    box: memoryview, value_dtype: np.dtype, sample_count: int
+) -> Optional[np.ndarray]:
+    """Per-sample values of a run-length table (stts, ctts): (count, value) runs"""
+    entries = read_entries(box, np.dtype([("count", ">u4"), ("value", value_dtype)]))
+    if entries is None:
+        return None
+    values = np.repeat(entries["value"].astype(np.int64), entries["count"])
+    if len(values) < sample_count:
+        return None
+    return values[:sample_count]
+
+
+def read_entries(box: memoryview, entry_dtype: np.dtype) -> Optional[np.ndarray]:
+    """Entries of a full box with an entry count (after the version and flags)"""
+    if len(box) < 8:
+        return None
+    [entry_count] = struct.unpack_from(">I", box, 4)
+    if len(box) < 8 + entry_count * entry_dtype.itemsize:
+        return None
+    return np.frombuffer(box, entry_dtype, entry_count, 8)
+
+
+def read_top_level_box(
+    read_range: ReadRange, size: int, box_type: bytes
+) -> Optional[memoryview]:
+    """Payload of a top-level box, only reading the headers of the other boxes"""
+    pos = 0
+    for _ in range(TOP_LEVEL_MAX_BOXES):
+        if size < pos + BOX_HEADER_SIZE:
+            return None
+        header = read_range(pos, min(pos + 2 * BOX_HEADER_SIZE, size) - 1)
+        box = parse_box_header(memoryview(header), 0, size - pos)
+        if box is None or not is_box_type(box[2]):
+            return None
+        header_size, box_size, current_type = box
+        if current_type == box_type:
+            payload = read_range(pos + header_size, pos + box_size - 1)
+            return memoryview(payload)
+        pos += box_size
+    return None
+
+
+def parse_box_header(
+    data: memoryview, offset: int, available: int
+) -> Optional[tuple[int, int, bytes]]:
+    """(header_size, box_size, box_type) or None if not a valid box"""
+    if len(data) < offset + BOX_HEADER_SIZE:
+        return None
+    box_size, box_type = struct.unpack_from(">I4s", data, offset)
+    header_size = BOX_HEADER_SIZE
+    if box_size == 1:  # 64-bit size
+        if len(data) < offset + 2 * BOX_HEADER_SIZE:
+            return None
+        [box_size] = struct.unpack_from(">Q", data, offset + BOX_HEADER_SIZE)
+        header_size += 8
+    elif box_size == 0:  # Box extending to the end
+        box_size = available
+    if box_size < header_size or available < box_size:
+        return None
+    return header_size, box_size, box_type
+
+
+def is_box_type(box_type: bytes) -> bool:
+    return all(0x20 <= char < 0x7F for char in box_type)  # Printable ASCII
+
+
+def gen_boxes(data: memoryview, box_type: bytes) -> Iterator[memoryview]:
+    """Payloads of the child boxes of a given type"""
+    offset = 0
+    while offset < len(data):
+        box = parse_box_header(data, offset, len(data) - offset)
+        if box is None:
+            return
+        header_size, box_size, current_type = box
+        if current_type == box_type:
+            yield data[offset + header_size : offset + box_size]
+        offset += box_size
+
+
+def find_box(data: memoryview, *box_path: bytes) -> Optional[memoryview]:
+    """Payload of the 1st box matching a path of nested box types"""
+    for box_type in box_path:
+        data = next(gen_boxes(data, box_type), None)
+        if data is None:
+            return None
+    return data
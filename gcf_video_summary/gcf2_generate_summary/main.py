@@ -15,19 +15,52 @@ limitations under the License.
 """
 import os
 
+import tracing
 from video_processor import VideoProcessor
 
 SUMMARY_BUCKET = os.getenv("SUMMARY_BUCKET", "")
 assert SUMMARY_BUCKET, "Undefined SUMMARY_BUCKET environment variable"
 ANIMATED = os.getenv("ANIMATED", "0") == "1"
+STREAMED = os.getenv("STREAMED", "0") == "1"
+# Thumbnails can be the nearest fast-seek frame within this tolerance (0: exact)
+SEEK_TOLERANCE_MS = int(os.getenv("SEEK_TOLERANCE_MS", "0"))
+# Encoding time limits, e.g. "png=30,gif=45" (formats over budget are skipped)
+ENCODER_BUDGETS_S = {
+    image_type: float(budget_s)
+    for image_type, budget_s in (
+        item.split("=") for item in os.getenv("ENCODER_BUDGETS", "").split(",") if item
+    )
+}
+# Summaries split into pages for videos with many shots
+PAGINATED = os.getenv("PAGINATED", "0") == "1"
+# Shot thumbnails cached in gs://cache_bucket or a local directory (none if empty)
+THUMBNAIL_CACHE = os.getenv("THUMBNAIL_CACHE", "")
+# Frames decoded by segments in worker processes (0: in the function process)
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "0"))
+DECODE_WORKER_MB = int(os.getenv("DECODE_WORKER_MB", "256"))
+# Storyboard thumbnails at shot starts and at this interval (0: no storyboard)
+STORYBOARD_INTERVAL_S = float(os.getenv("STORYBOARD_INTERVAL_S", "0"))
 
 
 def gcf_generate_summary(data, context):
     """Cloud Function triggered by a new Cloud Storage object"""
+    tracing.start_invocation(context.event_id)
     annotation_bucket = data["bucket"]
     path_to_annotation = data["name"]
     annot_uri = f"gs://{annotation_bucket}/{path_to_annotation}"
-    VideoProcessor.generate_summary(annot_uri, SUMMARY_BUCKET, ANIMATED)
+    VideoProcessor.generate_summary(
+        annot_uri,
+        SUMMARY_BUCKET,
+        ANIMATED,
+        STREAMED,
+        SEEK_TOLERANCE_MS,
+        ENCODER_BUDGETS_S,
+        PAGINATED,
+        THUMBNAIL_CACHE,
+        DECODE_WORKERS,
+        DECODE_WORKER_MB,
+        STORYBOARD_INTERVAL_S,
+    )
 
 
 if __name__ == "__main__":
@@ -39,4 +72,16 @@ if __name__ == "__main__":
         "annot_uri", type=str, help="gs://annotation_bucket/path/to/video.ext.json"
     )
     args = parser.parse_args()
-    VideoProcessor.generate_summary(args.annot_uri, SUMMARY_BUCKET, ANIMATED)
+    VideoProcessor.generate_summary(
+        args.annot_uri,
+        SUMMARY_BUCKET,
+        ANIMATED,
+        STREAMED,
+        SEEK_TOLERANCE_MS,
+        ENCODER_BUDGETS_S,
+        PAGINATED,
+        THUMBNAIL_CACHE,
+        DECODE_WORKERS,
+        DECODE_WORKER_MB,
+        STORYBOARD_INTERVAL_S,
+    )
@@ -0,0 +1,284 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import io
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import IO, Iterator, NamedTuple, Optional
+
+import google.auth
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
+from requests.adapters import HTTPAdapter
+
+# Objects are stored in a local directory instead of Cloud Storage if defined
+# gs://bucket/path/to/object -> LOCAL_STORAGE_ROOT/bucket/path/to/object
+LOCAL_STORAGE_ROOT = os.getenv("LOCAL_STORAGE_ROOT", "")
+# Fake storage server (tests), also used by the storage client (no credentials)
+STORAGE_EMULATOR_HOST = os.getenv("STORAGE_EMULATOR_HOST", "")
+POOL_MAX_CONNECTIONS = 16  # Connections shared by concurrent requests
+UPLOAD_RESUMABLE_MIN_SIZE = 4 * 2 ** 20  # Resumable uploads for bigger objects
+UPLOAD_CHUNK_SIZE = 16 * 256 * 2 ** 10  # Multiple of 256 KiB (API requirement)
+# Retries with exponential backoff (0.5s, 1s, 2s... up to 16s) for 2 minutes
+# Results are overwritten with the same content: uploads are safe to retry
+UPLOAD_RETRY = DEFAULT_RETRY.with_delay(initial=0.5, maximum=16.0).with_deadline(120)
+LOCAL_METADATA_DIR = ".metadata"  # Local backend: metadata of root/bucket/path
+
+
+class ObjectInfo(NamedTuple):
+    uri: str
+    size: int
+    generation: int
+    content_hash: str  # MD5 (CRC32C for composite objects), size+time if local
+    metadata: dict[str, str]
+
+
+class StorageBackend:
+    """Object storage shared by all the functions (Cloud Storage)
+
+    - Objects are identified by URI: gs://bucket/path/to/object
+    - The client is created on first use (nothing done at import time) and
+      reused by warm invocations, with a connection pool shared by threads
+    - Uploads read in-memory buffers in place (no copy to bytes), by chunks
+      for bigger buffers (resumable uploads)
+    - Missing objects raise NotFound (or get None for metadata)
+    """
+
+    _client: Optional[storage.Client] = None
+    _client_lock: threading.Lock
+
+    def __init__(self):
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self) -> storage.Client:
+        with self._client_lock:
+            if self._client is None:
+                self._client = create_client()
+        return self._client
+
+    def blob(self, uri: str, generation: Optional[int] = None) -> storage.Blob:
+        bucket_name, name = split_uri(uri)
+        bucket = self.client.bucket(bucket_name)
+        return bucket.blob(name, generation=generation)
+
+    def get_info(self, uri: str) -> Optional[ObjectInfo]:
+        bucket_name, name = split_uri(uri)
+        blob = self.client.bucket(bucket_name).get_blob(name)
+        return None if blob is None else blob_info(blob)
+
+    def list_infos(self, prefix_uri: str) -> Iterator[ObjectInfo]:
+        bucket_name, prefix = split_uri(prefix_uri)
+        for blob in self.client.list_blobs(bucket_name, prefix=prefix):
+            yield blob_info(blob)
+
+    def read_bytes(
+        self,
+        uri: str,
+        start: Optional[int] = None,
+        end: Optional[int] = None,  # Included
+        generation: Optional[int] = None,
+    ) -> bytes:
+        return self.blob(uri, generation).download_as_bytes(start=start, end=end)
+
+    def read_text(self, uri: str, generation: Optional[int] = None) -> str:
+        return self.blob(uri, generation).download_as_text(encoding="utf-8")
+
+    def open_text(self, uri: str) -> IO[str]:
+        """Text stream, downloaded by chunks"""
+        return self.blob(uri).open("rt", encoding="utf-8")
+
+    def download_to_file(
+        self, uri: str, local_path: Path, generation: Optional[int] = None
+    ):
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        self.blob(uri, generation).download_to_filename(local_path)
+
+    def upload(
+        self,
+        uri: str,
+        data: io.BytesIO,
+        content_type: str,
+        metadata: Optional[dict[str, str]] = None,
+    ):
+        blob = self.blob(uri)
+        if metadata is not None:
+            blob.metadata = metadata
+        size = data.seek(0, io.SEEK_END)
+        data.seek(0)
+        if UPLOAD_RESUMABLE_MIN_SIZE <= size:
+            # Resumable upload: a failed chunk is retried without restarting
+            blob.chunk_size = UPLOAD_CHUNK_SIZE
+        blob.upload_from_file(
+            data, size=size, content_type=content_type, retry=UPLOAD_RETRY
+        )
+
+    def update_metadata(self, uri: str, metadata: dict[str, str]):
+        blob = self.blob(uri)
+        blob.metadata = metadata
+        blob.patch()
+
+
+class LocalBackend(StorageBackend):
+    """Local filesystem stand-in (local runs, benchmarks, no credentials)
+
+    - gs://bucket/path/to/object -> root/bucket/path/to/object
+    - Generations are modification times (ns), metadata are JSON files
+      (root/.metadata/bucket/path/to/object.json)
+    """
+
+    root: Path
+
+    def __init__(self, root: Path):
+        super().__init__()
+        self.root = Path(root)
+
+    def path(self, uri: str) -> Path:
+        return self.root.joinpath(*split_uri(uri))
+
+    def metadata_path(self, uri: str) -> Path:
+        bucket_name, name = split_uri(uri)
+        return self.root.joinpath(LOCAL_METADATA_DIR, bucket_name, f"{name}.json")
+
+    def get_info(self, uri: str) -> Optional[ObjectInfo]:
+        path = self.path(uri)
+        if not path.is_file():
+            return None
+        stat = path.stat()
+        metadata_path = self.metadata_path(uri)
+        metadata = {}
+        if metadata_path.is_file():
+            metadata = json.loads(metadata_path.read_text())
+        content_hash = f"{stat.st_size}-{stat.st_mtime_ns}"
+        return ObjectInfo(uri, stat.st_size, stat.st_mtime_ns, content_hash, metadata)
+
+    def list_infos(self, prefix_uri: str) -> Iterator[ObjectInfo]:
+        """Objects whose names start with the prefix, in name order (as listed by
+        Cloud Storage: subdirectories included, prefix ending with "/" or not)"""
+        bucket_name, prefix = split_uri(prefix_uri)
+        bucket_path = self.root / bucket_name
+        prefix_dir, _, _ = prefix.rpartition("/")
+        names = [
+            path.relative_to(bucket_path).as_posix()
+            for path in bucket_path.joinpath(prefix_dir).rglob("*")
+            if path.is_file()
+        ]
+        for name in sorted(name for name in names if name.startswith(prefix)):
+            if info := self.get_info(f"gs://{bucket_name}/{name}"):
+                yield info
+
+    def read_bytes(
+        self,
+        uri: str,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        generation: Optional[int] = None,
+    ) -> bytes:
+        with self.open_binary(uri) as file:
+            file.seek(start or 0)
+            return file.read() if end is None else file.read(end - file.tell() + 1)
+
+    def read_text(self, uri: str, generation: Optional[int] = None) -> str:
+        with self.open_text(uri) as file:
+            return file.read()
+
+    def open_text(self, uri: str) -> IO[str]:
+        return io.TextIOWrapper(self.open_binary(uri), encoding="utf-8")
+
+    def open_binary(self, uri: str) -> IO[bytes]:
+        try:
+            return open(self.path(uri), "rb")
+        except FileNotFoundError as error:
+            raise NotFound(f"Object not found <{uri}>") from error
+
+    def download_to_file(
+        self, uri: str, local_path: Path, generation: Optional[int] = None
+    ):
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.open_binary(uri) as file, open(local_path, "wb") as local_file:
+            shutil.copyfileobj(file, local_file)
+
+    def upload(
+        self,
+        uri: str,
+        data: io.BytesIO,
+        content_type: str,
+        metadata: Optional[dict[str, str]] = None,
+    ):
+        path = self.path(uri)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data.getbuffer())  # No copy
+        self.write_metadata(uri, metadata)
+
+    def update_metadata(self, uri: str, metadata: dict[str, str]):
+        if not self.path(uri).is_file():
+            raise NotFound(f"Object not found <{uri}>")
+        self.write_metadata(uri, metadata)
+
+    def write_metadata(self, uri: str, metadata: Optional[dict[str, str]]):
+        metadata_path = self.metadata_path(uri)
+        if not metadata:
+            metadata_path.unlink(missing_ok=True)
+            return
+        metadata_path.parent.mkdir(parents=True, exist_ok=True)
+        metadata_path.write_text(json.dumps(metadata))
+
+
+backend: Optional[StorageBackend] = None  # Reused by warm invocations
+backend_lock = threading.Lock()
+
+
+def get_backend() -> StorageBackend:
+    global backend
+    with backend_lock:
+        if backend is None:
+            if LOCAL_STORAGE_ROOT:
+                backend = LocalBackend(Path(LOCAL_STORAGE_ROOT))
+            else:
+                backend = StorageBackend()
+    return backend
+
+
+def create_client() -> storage.Client:
+    """Client whose HTTP session has a connection pool for concurrent requests"""
+    if STORAGE_EMULATOR_HOST:
+        credentials, project = AnonymousCredentials(), None
+    else:
+        credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAX_CONNECTIONS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)  # Fake storage servers
+    return storage.Client(project, credentials, _http=session)
+
+
+def split_uri(uri: str) -> tuple[str, str]:
+    """gs://bucket/path/to/object -> (bucket, path/to/object)"""
+    bucket_name, _, name = uri.removeprefix("gs://").partition("/")
+    return bucket_name, name
+
+
+def blob_info(blob: storage.Blob) -> ObjectInfo:
+    uri = f"gs://{blob.bucket.name}/{blob.name}"
+    content_hash = blob.md5_hash or blob.crc32c  # Composite objects have no MD5
+    metadata = blob.metadata or {}
+    return ObjectInfo(uri, blob.size, blob.generation, content_hash, metadata)
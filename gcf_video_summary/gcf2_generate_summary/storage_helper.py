@@ -15,12 +15,21 @@ limitations under the License.
 """
 import json
 import tempfile
+from io import BytesIO
 from pathlib import Path
-from typing import NamedTuple
+from typing import Iterable, NamedTuple, Optional
 
-from google.cloud import storage
+from storage_backend import StorageBackend, get_backend, split_uri
+from tracing import Span
+from upload_pipeline import UploadPipeline
+from video_source import DownloadedVideo, StreamedVideo, VideoSource
 
 ANNOT_EXT = ".json"
+# Summary metadata: a summary is up to date if rendered from the same inputs
+SOURCE_GENERATION_KEY = "source_generation"
+ANNOTATION_GENERATION_KEY = "annotation_generation"
+RENDER_OPTIONS_KEY = "render_options"
+PAGE_COUNT_KEY = "page_count"
 
 
 class VideoShot(NamedTuple):
@@ -45,69 +54,210 @@ class VideoShot(NamedTuple):
 class StorageHelper:
     """Local+Cloud storage helper
 
-    - Uses a temp dir for local processing (e.g. video frame extraction)
-    - Paths are relative to this temp dir (named after the output bucket)
+    - Objects are read/written with the shared storage backend (storage_backend)
+    - Gives OpenCV access to the video (downloaded or streamed, see video_source)
+    - Downloads use a temp dir (named after the output bucket)
+    - Uploads run in the background and are awaited on exit
+    - Summaries store the video/annotation generations and the render options
+      in their metadata (see is_up_to_date)
 
     Naming convention:
     - video_uri:                 gs://video_bucket/path/to/video.ext
     - annot_uri:    gs://annot_bucket/video_bucket/path/to/video.ext.json
     - video_path:                     video_bucket/path/to/video.ext
     - summary_path:                   video_bucket/path/to/video.ext.SUFFIX
+      (SUFFIX ending with a page number for paginated summaries)
     - summary_uri: gs://output_bucket/video_bucket/path/to/video.ext.SUFFIX
+    - storyboard_track_path:          video_bucket/path/to/video.ext.storyboard.vtt
+    - storyboard_sheet_path:          video_bucket/path/to/video.ext.storyboard_NNN.EXT
+      (sheets referenced by the track with relative URLs: same directory)
     """
 
-    client = storage.Client()
+    backend: StorageBackend
     video_shots: list[VideoShot]
+    annotation_generation: Optional[int] = None
     video_path: Path
-    video_local_path: Path
-    upload_bucket: storage.Bucket
+    video_generation: Optional[int] = None
+    video_source: VideoSource
+    output_bucket: str
+    upload_pipeline: UploadPipeline
 
-    def __init__(self, annot_uri: str, output_bucket: str):
+    def __init__(
+        self,
+        annot_uri: str,
+        output_bucket: str,
+        streamed=False,
+        render_options="",
+    ):
         if not annot_uri.endswith(ANNOT_EXT):
             raise RuntimeError(f"annot_uri must end with <{ANNOT_EXT}>")
+        self.backend = get_backend()
         self.video_shots = self.get_video_shots(annot_uri)
         self.video_path = self.video_path_from_uri(annot_uri)
-        temp_root = Path(tempfile.gettempdir(), output_bucket)
-        temp_root.mkdir(parents=True, exist_ok=True)
-        self.video_local_path = temp_root.joinpath(self.video_path)
-        self.upload_bucket = self.client.bucket(output_bucket)
+        video_uri = f"gs://{self.video_path.as_posix()}"
+        video = self.backend.get_info(video_uri)  # Before any download
+        if video is None:
+            raise RuntimeError(f"Video not found <{video_uri}>")
+        self.video_generation = video.generation
+        if streamed:
+            self.video_source = StreamedVideo.from_object(video)
+        else:
+            temp_root = Path(tempfile.gettempdir(), output_bucket)
+            video_local_path = temp_root.joinpath(self.video_path)
+            self.video_source = DownloadedVideo(
+                video_uri, video_local_path, video.generation
+            )
+        self.render_options = render_options
+        self.output_bucket = output_bucket
+        self.upload_pipeline = UploadPipeline()
 
     def __enter__(self):
-        self.download_video()
+        self.video_source.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.video_local_path.unlink()
+        self.video_source.__exit__(exc_type, exc_value, traceback)
+        failures = self.upload_pipeline.join()
+        if failures and exc_type is None:
+            raise RuntimeError(f"Could not upload {len(failures)} image(s)")
 
     def get_video_shots(self, annot_uri: str) -> list[VideoShot]:
-        json_blob = storage.Blob.from_string(annot_uri, self.client)
-        api_response: dict = json.loads(json_blob.download_as_text())
-        single_video_results: dict = api_response["annotation_results"][0]
-        annotations: list = single_video_results["shot_annotations"]
-        return [VideoShot.from_dict(annotation) for annotation in annotations]
+        with Span("annotation", uri=annot_uri) as span:
+            annotation = self.backend.get_info(annot_uri)
+            if annotation is None:
+                raise RuntimeError(f"Annotation not found <{annot_uri}>")
+            self.annotation_generation = annotation.generation
+            # Downloaded at the same generation
+            json_text = self.backend.read_text(annot_uri, annotation.generation)
+            api_response: dict = json.loads(json_text)
+            single_video_results: dict = api_response["annotation_results"][0]
+            annotations: list = single_video_results["shot_annotations"]
+            video_shots = [VideoShot.from_dict(a) for a in annotations]
+            span.add(bytes=annotation.size, shots=len(video_shots))
+        return video_shots
 
     def video_path_from_uri(self, annot_uri: str) -> Path:
-        annot_blob = storage.Blob.from_string(annot_uri)
-        return Path(annot_blob.name[: -len(ANNOT_EXT)])
+        _, annot_name = split_uri(annot_uri)
+        return Path(annot_name[: -len(ANNOT_EXT)])
 
-    def download_video(self):
-        video_uri = f"gs://{self.video_path.as_posix()}"
-        blob = storage.Blob.from_string(video_uri, self.client)
-        print(f"Downloading -> {self.video_local_path}")
-        self.video_local_path.parent.mkdir(parents=True, exist_ok=True)
-        blob.download_to_filename(self.video_local_path)
-
-    def upload_summary(self, image_bytes: bytes, image_type: str, animated=False):
-        path = self.summary_path(image_type, animated)
-        blob = self.upload_bucket.blob(path.as_posix())
+    def upload_summary(
+        self,
+        image_data: BytesIO,
+        image_type: str,
+        animated=False,
+        page: Optional[int] = None,
+        page_count=1,
+    ):
+        path = self.summary_path(image_type, animated, page)
+        summary_uri = self.output_uri(path)
+        content_type = f"image/{image_type}"
+        metadata = self.summary_metadata(page_count)
+        self.upload_pipeline.submit(summary_uri, image_data, content_type, metadata)
+
+    def upload_storyboard_sheet(
+        self, image_data: BytesIO, image_type: str, sheet: int, sheet_count: int
+    ):
+        path = self.storyboard_sheet_path(image_type, sheet)
+        sheet_uri = self.output_uri(path)
         content_type = f"image/{image_type}"
-        print(f"Uploading -> {blob.name}")
-        blob.upload_from_string(image_bytes, content_type)
+        metadata = self.summary_metadata(sheet_count)
+        self.upload_pipeline.submit(sheet_uri, image_data, content_type, metadata)
+
+    def upload_storyboard_track(self, vtt_text: str, sheet_count: int):
+        path = self.storyboard_track_path()
+        vtt_data = BytesIO(vtt_text.encode())
+        metadata = self.summary_metadata(sheet_count)
+        track_uri = self.output_uri(path)
+        self.upload_pipeline.submit(track_uri, vtt_data, "text/vtt", metadata)
+
+    def summary_metadata(self, page_count: int) -> dict[str, str]:
+        return {
+            SOURCE_GENERATION_KEY: str(self.video_generation),
+            ANNOTATION_GENERATION_KEY: str(self.annotation_generation),
+            RENDER_OPTIONS_KEY: self.render_options,
+            PAGE_COUNT_KEY: str(page_count),
+        }
+
+    def is_up_to_date(
+        self,
+        image_types: Iterable[str],
+        animated=False,
+        optional_types: Iterable[str] = (),
+    ) -> bool:
+        """Whether the summaries exist in all formats and pages, rendered from
+        the same video/annotation generations with the same render options
+
+        Optional formats (e.g. skipped when over their encoding budget) can be
+        missing, but existing ones must be up to date.
+        """
+        prefix_uri = self.output_uri(self.summary_prefix(animated))
+        summaries = {info.uri: info for info in self.backend.list_infos(prefix_uri)}
+        if not summaries:
+            return False
+        first_metadata = next(iter(summaries.values())).metadata
+        page_count = int(first_metadata.get(PAGE_COUNT_KEY, "0"))
+        if page_count < 1:
+            return False
+        pages = [None] if page_count == 1 else range(1, page_count + 1)
+        expected_metadata = self.summary_metadata(page_count)
+        for image_type in image_types:
+            for page in pages:
+                path = self.summary_path(image_type, animated, page)
+                summary = summaries.get(self.output_uri(path))
+                if summary is None or summary.metadata != expected_metadata:
+                    return False
+        for image_type in optional_types:
+            for page in pages:
+                path = self.summary_path(image_type, animated, page)
+                summary = summaries.get(self.output_uri(path))
+                if summary is not None and summary.metadata != expected_metadata:
+                    return False
+        return True
 
-    def summary_path(self, image_type: str, animated=False) -> Path:
+    def is_storyboard_up_to_date(self, image_type: str) -> bool:
+        """Whether the track and all its sheets are up to date (see is_up_to_date)"""
+        prefix_uri = self.output_uri(self.storyboard_prefix())
+        outputs = {info.uri: info for info in self.backend.list_infos(prefix_uri)}
+        track = outputs.get(self.output_uri(self.storyboard_track_path()))
+        if track is None:
+            return False
+        sheet_count = int(track.metadata.get(PAGE_COUNT_KEY, "0"))
+        expected_metadata = self.summary_metadata(sheet_count)
+        paths = [self.storyboard_track_path()] + [
+            self.storyboard_sheet_path(image_type, sheet)
+            for sheet in range(1, sheet_count + 1)
+        ]
+        for path in paths:
+            output = outputs.get(self.output_uri(path))
+            if output is None or output.metadata != expected_metadata:
+                return False
+        return True
+
+    def output_uri(self, path: Path) -> str:
+        return f"gs://{self.output_bucket}/{path.as_posix()}"
+
+    def summary_prefix(self, animated=False) -> Path:
         video_name = self.video_path.name
         shot_count = len(self.video_shots)
         still_or_anim = "anim" if animated else "still"
-        suffix = f"summary{shot_count:03d}_{still_or_anim}.{image_type}"
-        summary_name = f"{video_name}.{suffix}"
-        return Path(self.video_path.parent, summary_name)
+        summary_prefix = f"{video_name}.summary{shot_count:03d}_{still_or_anim}"
+        return Path(self.video_path.parent, summary_prefix)
+
+    def summary_path(
+        self, image_type: str, animated=False, page: Optional[int] = None
+    ) -> Path:
+        prefix = self.summary_prefix(animated)
+        page_suffix = "" if page is None else f"_p{page:02d}"
+        return prefix.with_name(f"{prefix.name}{page_suffix}.{image_type}")
+
+    def storyboard_prefix(self) -> Path:
+        video_name = self.video_path.name
+        return Path(self.video_path.parent, f"{video_name}.storyboard")
+
+    def storyboard_track_path(self) -> Path:
+        prefix = self.storyboard_prefix()
+        return prefix.with_name(f"{prefix.name}.vtt")
+
+    def storyboard_sheet_path(self, image_type: str, sheet: int) -> Path:
+        prefix = self.storyboard_prefix()
+        return prefix.with_name(f"{prefix.name}_{sheet:03d}.{image_type}")
@@ -0,0 +1,177 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from typing import Callable, Iterator, NamedTuple, Sequence
+
+import numpy as np
+
+STORYBOARD_TILE_W = 160  # Tile height from the video aspect ratio
+STORYBOARD_COLS = 10
+STORYBOARD_ROWS = 10  # Sheets of 10x10 tiles (1600x900 for 16:9 videos)
+STORYBOARD_MIN_GAP_MS = 1000  # Cue starts closer than this are merged
+STORYBOARD_BACKGROUND = (0x80, 0x80, 0x80)  # Undecoded tiles, end of last sheet
+
+# (cue start ms, cue end ms) -> frame index of the cue thumbnail
+CueFrameIndex = Callable[[float, float], int]
+
+
+class StoryboardCue(NamedTuple):
+    start_ms: float
+    end_ms: float
+    frame_index: int
+
+
+class Storyboard:
+    """Seek-preview thumbnails: fixed-size tiles in sprite sheets + WebVTT track
+
+    - Cues start at shot boundaries and at regular intervals within the shots
+    - Tiles are planned with other frames (decoded in the same pass), in time
+      order: plan(end_ms) routes the cues starting up to end_ms
+    - Sheets are allocated on first use and released once complete
+    - The WebVTT track maps each cue to its tile (sheet#xywh=x,y,w,h)
+    """
+
+    cues: list[StoryboardCue]
+    tile_size: tuple[int, int]
+    tiles_per_sheet: int
+    sheets: dict[int, np.ndarray]  # Sheet index -> sheet being filled (RGB)
+    planned_count: int = 0  # Cues already planned (in time order)
+    released_count: int = 0  # Sheets already released
+
+    def __init__(self, cues: list[StoryboardCue], tile_size: tuple[int, int]):
+        self.cues = cues
+        self.tile_size = tile_size
+        self.tiles_per_sheet = STORYBOARD_COLS * STORYBOARD_ROWS
+        self.sheets = {}
+
+    @classmethod
+    def from_shots(
+        cls,
+        shot_starts_ms: Sequence[float],
+        end_ms: float,
+        interval_ms: float,
+        frame_size: tuple[int, int],
+        cue_frame_index: CueFrameIndex,
+    ) -> "Storyboard":
+        cue_starts = plan_cue_starts(shot_starts_ms, end_ms, interval_ms)
+        cue_ends = [*cue_starts[1:], end_ms]
+        cues = [
+            StoryboardCue(start_ms, end_ms, cue_frame_index(start_ms, end_ms))
+            for start_ms, end_ms in zip(cue_starts, cue_ends)
+        ]
+        return cls(cues, storyboard_tile_size(*frame_size))
+
+    @property
+    def sheet_count(self) -> int:
+        return -(-len(self.cues) // self.tiles_per_sheet)  # Rounded up
+
+    def plan(self, end_ms: float) -> dict[int, list[np.ndarray]]:
+        """Tile buffers of the next cues starting up to end_ms, by frame index"""
+        tile_routes: dict[int, list[np.ndarray]] = {}
+        cue_count = len(self.cues)
+        while self.planned_count < cue_count:
+            cue_idx = self.planned_count
+            cue = self.cues[cue_idx]
+            if end_ms < cue.start_ms:
+                break
+            tile_routes.setdefault(cue.frame_index, []).append(self.tile(cue_idx))
+            self.planned_count += 1
+        return tile_routes
+
+    def tile(self, cue_idx: int) -> np.ndarray:
+        """Tile buffer (view of its sheet)"""
+        sheet_idx, tile_idx = divmod(cue_idx, self.tiles_per_sheet)
+        if (sheet := self.sheets.get(sheet_idx)) is None:
+            sheet = self.new_sheet(sheet_idx)
+            self.sheets[sheet_idx] = sheet
+        x, y = self.tile_position(tile_idx)
+        tile_w, tile_h = self.tile_size
+        return sheet[y : y + tile_h, x : x + tile_w]
+
+    def new_sheet(self, sheet_idx: int) -> np.ndarray:
+        """Last sheet: only the rows needed"""
+        first_cue_idx = sheet_idx * self.tiles_per_sheet
+        tile_count = min(len(self.cues) - first_cue_idx, self.tiles_per_sheet)
+        rows = -(-tile_count // STORYBOARD_COLS)
+        tile_w, tile_h = self.tile_size
+        sheet = np.empty((rows * tile_h, STORYBOARD_COLS * tile_w, 3), dtype=np.uint8)
+        sheet[:] = STORYBOARD_BACKGROUND
+        return sheet
+
+    def tile_position(self, tile_idx: int) -> tuple[int, int]:
+        row, col = divmod(tile_idx, STORYBOARD_COLS)
+        tile_w, tile_h = self.tile_size
+        return col * tile_w, row * tile_h
+
+    def pop_complete_sheets(self) -> Iterator[tuple[int, np.ndarray]]:
+        """Yields (sheet number, sheet) for the sheets whose cues are all planned
+
+        To be called once the planned tiles are decoded.
+        """
+        complete_count = self.planned_count // self.tiles_per_sheet
+        if self.planned_count == len(self.cues):
+            complete_count = self.sheet_count
+        for sheet_idx in range(self.released_count, complete_count):
+            sheet = self.sheets.pop(sheet_idx, None)
+            if sheet is not None:
+                yield sheet_idx + 1, sheet
+        self.released_count = max(self.released_count, complete_count)
+
+    def webvtt(self, sheet_name: Callable[[int], str]) -> str:
+        """WebVTT track (sheet_name: sheet number -> URL relative to the track)"""
+        tile_w, tile_h = self.tile_size
+        lines = ["WEBVTT", ""]
+        for cue_idx, cue in enumerate(self.cues):
+            sheet_idx, tile_idx = divmod(cue_idx, self.tiles_per_sheet)
+            x, y = self.tile_position(tile_idx)
+            start, end = vtt_timestamp(cue.start_ms), vtt_timestamp(cue.end_ms)
+            lines.append(f"{start} --> {end}")
+            lines.append(f"{sheet_name(sheet_idx + 1)}#xywh={x},{y},{tile_w},{tile_h}")
+            lines.append("")
+        return "\n".join(lines)
+
+
+def plan_cue_starts(
+    shot_starts_ms: Sequence[float], end_ms: float, interval_ms: float
+) -> list[float]:
+    """Cue starts: shot starts + regular ticks within the shots, at least
+    STORYBOARD_MIN_GAP_MS apart (shot starts win over nearby ticks)"""
+    assert 0 < interval_ms
+    shot_starts = sorted(shot_starts_ms)
+    shot_ends = [*shot_starts[1:], end_ms]
+    cue_starts: list[float] = []
+    for shot_start, shot_end in zip(shot_starts, shot_ends):
+        if cue_starts and shot_start - cue_starts[-1] < STORYBOARD_MIN_GAP_MS:
+            cue_starts.pop()  # Tick or shot start too close to this shot start
+        cue_starts.append(shot_start)
+        tick = shot_start + interval_ms
+        while tick <= shot_end - STORYBOARD_MIN_GAP_MS:
+            cue_starts.append(tick)
+            tick += interval_ms
+    return cue_starts
+
+
+def storyboard_tile_size(frame_w: int, frame_h: int) -> tuple[int, int]:
+    tile_w = STORYBOARD_TILE_W
+    return tile_w, max(frame_h * tile_w // max(frame_w, 1), 1)
+
+
+def vtt_timestamp(pos_ms: float) -> str:
+    """HH:MM:SS.mmm"""
+    total_ms = int(pos_ms + 0.5)
+    seconds, ms = divmod(total_ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{ms:03d}"
@@ -0,0 +1,132 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from google.api_core.exceptions import NotFound
+
+from storage_backend import get_backend
+
+THUMBNAIL_CACHE_MAX_MB = 256  # Cached thumbnails of a video (older ones dropped)
+
+
+class ThumbnailCache:
+    """Shot thumbnails (RGB cells) persisted between renderings of the same video
+
+    - One NPZ file per video generation and cell size, one array per frame index
+    - Stored in a bucket (gs://cache_bucket, with the storage backend) or in a
+      local directory (e.g. in /tmp, kept by warm instances)
+    - Cached arrays are read on demand, new thumbnails are saved on exit
+    - Saved thumbnails are bounded by THUMBNAIL_CACHE_MAX_MB: the ones used by
+      this rendering first, then the previously cached ones in their order
+      (recently used first), the older ones being dropped
+
+    Naming convention:
+    - video_path:                          video_bucket/path/to/video.ext
+    - cache_uri:    gs://cache_bucket/video_bucket/path/to/video.ext.GEN.WxH.npz
+    """
+
+    cache_uri: str
+    cached: dict[str, np.ndarray]  # Or a lazy np.lib.npyio.NpzFile
+    new: dict[str, np.ndarray]
+    used: dict[str, None]  # Cached keys read by this rendering (ordered set)
+    new_bytes: int = 0
+
+    def __init__(
+        self,
+        cache_root: str,
+        video_path: Path,
+        generation: int,
+        cell_size: tuple[int, int],
+    ):
+        cell_w, cell_h = cell_size
+        cache_name = f"{video_path.as_posix()}.{generation}.{cell_w}x{cell_h}.npz"
+        self.cache_uri = f"{cache_root.rstrip('/')}/{cache_name}"
+        self.cached = {}
+        self.new = {}
+        self.used = {}
+
+    def __enter__(self) -> "ThumbnailCache":
+        try:
+            data = self.read()
+        except Exception:
+            logging.exception("Could not read thumbnail cache <%s>", self.cache_uri)
+            data = None
+        if data is not None:
+            self.cached = np.load(BytesIO(data))
+            print(f"Cached thumbnails: {len(self.cached.files)}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or not self.new:
+            return
+        thumbnails = self.bounded_thumbnails()
+        mem_file = BytesIO()
+        np.savez(mem_file, **thumbnails)  # Uncompressed: faster, cells are small
+        try:
+            self.write(mem_file)
+            print(f"Thumbnails cached -> {self.cache_uri} ({len(thumbnails)})")
+        except Exception:
+            logging.exception("Could not write thumbnail cache <%s>", self.cache_uri)
+
+    def bounded_thumbnails(self) -> dict[str, np.ndarray]:
+        """Thumbnails to save, most recently used first, within the size limit"""
+        max_bytes = THUMBNAIL_CACHE_MAX_MB * 2 ** 20
+        thumbnails = self.new.copy()
+        total_bytes = self.new_bytes
+        older_keys = [key for key in self.cached.keys() if key not in self.used]
+        for key in [*self.used, *older_keys]:
+            if key in thumbnails:
+                continue
+            thumbnail = self.cached[key]
+            if max_bytes < total_bytes + thumbnail.nbytes:
+                break
+            thumbnails[key] = thumbnail
+            total_bytes += thumbnail.nbytes
+        return thumbnails
+
+    def get(self, frame_index: int) -> Optional[np.ndarray]:
+        key = str(frame_index)
+        if key not in self.cached:
+            return None
+        self.used[key] = None
+        return self.cached[key]
+
+    def add(self, frame_index: int, thumbnail: np.ndarray):
+        if THUMBNAIL_CACHE_MAX_MB * 2 ** 20 < self.new_bytes + thumbnail.nbytes:
+            return
+        self.new[str(frame_index)] = thumbnail.copy()
+        self.new_bytes += thumbnail.nbytes
+
+    def read(self) -> Optional[bytes]:
+        if self.cache_uri.startswith("gs://"):
+            try:
+                return get_backend().read_bytes(self.cache_uri)
+            except NotFound:
+                return None
+        path = Path(self.cache_uri)
+        return path.read_bytes() if path.exists() else None
+
+    def write(self, data: BytesIO):
+        if self.cache_uri.startswith("gs://"):
+            get_backend().upload(self.cache_uri, data, "application/octet-stream")
+            return
+        path = Path(self.cache_uri)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data.getbuffer())
@@ -0,0 +1,90 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import NamedTuple, Optional
+
+from storage_backend import StorageBackend, get_backend
+from tracing import Span
+
+UPLOAD_WORKERS = 8
+UPLOAD_MAX_PENDING = 2 * UPLOAD_WORKERS  # Bounds the memory used by pending buffers
+
+
+class UploadFailure(NamedTuple):
+    uri: str
+    error: Exception
+
+
+class UploadPipeline:
+    """Uploads in-memory buffers in the background
+
+    - Bounded thread pool: submit() blocks when too many uploads are pending
+    - Connections are pooled by the storage backend (shared client)
+    - Failed requests are retried with exponential backoff (see storage_backend)
+    - Each upload is traced (duration including retries, bytes)
+    - join() waits for all uploads and reports the failures
+    """
+
+    backend: StorageBackend
+    executor: ThreadPoolExecutor
+    pending: threading.BoundedSemaphore
+    futures: dict[Future, str]
+
+    def __init__(self):
+        self.backend = get_backend()
+        self.executor = ThreadPoolExecutor(UPLOAD_WORKERS, "upload")
+        self.pending = threading.BoundedSemaphore(UPLOAD_MAX_PENDING)
+        self.futures = {}
+
+    def submit(
+        self,
+        uri: str,
+        data: BytesIO,
+        content_type: str,
+        metadata: Optional[dict[str, str]] = None,
+    ):
+        print(f"Uploading -> {uri}")
+        self.pending.acquire()
+        future = self.executor.submit(self.upload, uri, data, content_type, metadata)
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures[future] = uri
+
+    def upload(
+        self,
+        uri: str,
+        data: BytesIO,
+        content_type: str,
+        metadata: Optional[dict[str, str]],
+    ):
+        with Span("upload", uri=uri, bytes=len(data.getbuffer())):
+            self.backend.upload(uri, data, content_type, metadata)
+
+    def join(self) -> list[UploadFailure]:
+        with Span("upload_wait", uploads=len(self.futures)):
+            wait(self.futures)  # Uploads still pending after the rendering
+        self.executor.shutdown()
+        failures = [
+            UploadFailure(uri, future.exception())
+            for future, uri in self.futures.items()
+            if future.exception() is not None
+        ]
+        for failure in failures:
+            logging.error("Could not upload <%s>: %s", *failure)
+        print(f"Uploaded: {len(self.futures) - len(failures)}/{len(self.futures)}")
+        return failures
@@ -14,19 +14,38 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import logging
+import multiprocessing
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from io import BytesIO
-from typing import Iterator, NamedTuple
+from multiprocessing.connection import Connection
+from typing import Iterator, NamedTuple, Optional, Sequence
 
 import cv2 as cv
+import numpy as np
 from PIL import Image
 
-from storage_helper import StorageHelper
+from frame_extractor import (
+    SEEK_PREROLL_FRAMES,
+    CvFrame,
+    FrameExtractor,
+    ParallelFrameExtractor,
+    decode_worker_count,
+)
+from keyframes import read_keyframe_indexes
+from storage_helper import StorageHelper, VideoShot
+from storyboard import Storyboard, storyboard_tile_size
+from thumbnail_cache import ThumbnailCache
+from tracing import Span
 
 PilImage = Image.Image
 ImageSize = NamedTuple("ImageSize", [("w", int), ("h", int)])
 ImageFormat = NamedTuple("ImageFormat", [("type", str), ("save_parameters", dict)])
 
 SUMMARY_MAX_SIZE = ImageSize(1920, 1080)
+SUMMARY_MIN_CELL_W = 240  # Paginated summaries: more pages rather than smaller cells
 RGB_BACKGROUND = (0x80, 0x80, 0x80)
 ANIMATION_FRAME_DURATION_MS = 333
 ANIMATION_FRAMES = 6
@@ -36,43 +55,212 @@ IMAGE_JPEG = ImageFormat("jpeg", dict(optimize=True, progressive=True))
 IMAGE_GIF = ImageFormat("gif", dict(optimize=True))
 IMAGE_PNG = ImageFormat("png", dict(optimize=True))
 IMAGE_WEBP = ImageFormat("webp", dict(lossless=False, quality=80, method=1))
+IMAGE_STORYBOARD = ImageFormat("jpeg", dict(quality=70, optimize=True))
+# Also rendered by gcf2_render_objects (combined mode, shot_summary.py): keep
+# the still formats and default render options in sync (tests/test_combined_summary.py)
 SUMMARY_STILL_FORMATS = (IMAGE_JPEG, IMAGE_PNG, IMAGE_WEBP)
 SUMMARY_ANIMATED_FORMATS = (IMAGE_GIF, IMAGE_PNG, IMAGE_WEBP)
+# Encoding time limits in seconds by image type, e.g. {"png": 30.0} (no limit)
+# A format whose encoding exceeds its budget is skipped (encoder terminated)
+# and not required for the summary to be up to date
+ENCODER_BUDGETS_S: dict[str, float] = {}
 
 
 class VideoProcessor:
     storage: StorageHelper
+    seek_tolerance_ms: int
+    encoder_budgets_s: dict[str, float]
+    paginated: bool
+    thumbnail_cache_root: str
+    thumbnail_cache: Optional[ThumbnailCache] = None
+    decode_workers: int
+    decode_worker_mb: int
+    storyboard_interval_s: float
+    storyboard: Optional[Storyboard] = None
     video: cv.VideoCapture
+    keyframes: Optional[Sequence[int]] = None
+    extractor: FrameExtractor
     cell_size: ImageSize
-    grid_size: ImageSize
+    grid_size: ImageSize  # Size of a full page
+    page_shots: int  # Number of shots per page
+    page_count: int
 
     @staticmethod
-    def generate_summary(annot_uri: str, output_bucket: str, animated=False):
-        """Generate a video summary from video shot annotations"""
+    def generate_summary(
+        annot_uri: str,
+        output_bucket: str,
+        animated=False,
+        streamed=False,
+        seek_tolerance_ms=0,
+        encoder_budgets_s: Optional[dict[str, float]] = None,
+        paginated=False,
+        thumbnail_cache="",
+        decode_workers=0,
+        decode_worker_mb=256,
+        storyboard_interval_s=0.0,
+    ):
+        """Generate a video summary from video shot annotations
+
+        - seek_tolerance_ms: if > 0, thumbnails can be the nearest fast-seek
+          frame within this tolerance (approximate but faster seeks)
+        - encoder_budgets_s: encoding time limits (overriding ENCODER_BUDGETS_S)
+        - paginated: summaries split into pages if cells get too small
+        - thumbnail_cache: gs://cache_bucket or local directory for the shot
+          thumbnails (none if empty)
+        - decode_workers: if > 1, frames decoded by segments in worker processes
+          (with decode_worker_mb of frames per worker)
+        - storyboard_interval_s: if > 0, seek-preview thumbnails (sprite sheets
+          and WebVTT track) at shot starts and at this interval within shots,
+          decoded in the same pass as the summary frames
+        - Up-to-date summaries are skipped (e.g. retried storage events)
+        - Phases are traced (see tracing), the whole generation in a "summary" span
+        """
+        render_options = f"seek_tolerance_ms={seek_tolerance_ms},paginated={paginated}"
+        if 0 < storyboard_interval_s:
+            render_options += f",storyboard_interval_s={storyboard_interval_s}"
+        image_formats = SUMMARY_ANIMATED_FORMATS if animated else SUMMARY_STILL_FORMATS
+        budgeted_types = ENCODER_BUDGETS_S.keys() | (encoder_budgets_s or {}).keys()
+        image_types = [f.type for f in image_formats if f.type not in budgeted_types]
+        optional_types = [f.type for f in image_formats if f.type in budgeted_types]
         try:
-            with StorageHelper(annot_uri, output_bucket) as storage:
-                with VideoProcessor(storage) as video_proc:
-                    print("Generating summary...")
-                    if animated:
-                        video_proc.generate_summary_animations()
-                    else:
-                        video_proc.generate_summary_stills()
+            with Span("summary", uri=annot_uri, animated=animated) as span:
+                storage = StorageHelper(
+                    annot_uri, output_bucket, streamed, render_options
+                )
+                if storage.is_up_to_date(image_types, animated, optional_types) and (
+                    storyboard_interval_s <= 0
+                    or storage.is_storyboard_up_to_date(IMAGE_STORYBOARD.type)
+                ):
+                    print(f"Skipping up-to-date summary of <{annot_uri}>")
+                    span.set(status="up-to-date")
+                    return
+                with storage:
+                    with VideoProcessor(
+                        storage,
+                        seek_tolerance_ms,
+                        encoder_budgets_s,
+                        paginated,
+                        thumbnail_cache,
+                        decode_workers,
+                        decode_worker_mb,
+                        storyboard_interval_s,
+                    ) as video_proc:
+                        print("Generating summary...")
+                        if animated:
+                            video_proc.generate_summary_animations()
+                        else:
+                            video_proc.generate_summary_stills()
+                span.set(status="rendered", shots=len(storage.video_shots))
         except Exception:
             logging.exception("Could not generate summary from <%s>", annot_uri)
 
-    def __init__(self, storage: StorageHelper):
+    def __init__(
+        self,
+        storage: StorageHelper,
+        seek_tolerance_ms=0,
+        encoder_budgets_s: Optional[dict[str, float]] = None,
+        paginated=False,
+        thumbnail_cache="",
+        decode_workers=0,
+        decode_worker_mb=256,
+        storyboard_interval_s=0.0,
+    ):
         self.storage = storage
+        self.seek_tolerance_ms = seek_tolerance_ms
+        self.encoder_budgets_s = ENCODER_BUDGETS_S | (encoder_budgets_s or {})
+        self.paginated = paginated
+        self.thumbnail_cache_root = thumbnail_cache
+        self.decode_workers = decode_workers
+        self.decode_worker_mb = decode_worker_mb
+        self.storyboard_interval_s = storyboard_interval_s
 
     def __enter__(self):
-        video_path = self.storage.video_local_path
-        self.video = cv.VideoCapture(str(video_path))
+        video_uri = self.storage.video_source.uri
+        self.video = cv.VideoCapture(video_uri)
         if not self.video.isOpened():
-            raise RuntimeError(f"Could not open video <{video_path}>")
+            raise RuntimeError(f"Could not open video <{video_uri}>")
+        if 0 < self.seek_tolerance_ms:
+            self.keyframes = self.read_keyframes()
         self.compute_grid_dimensions()
+        self.extractor = self.create_extractor()
+        if 0 < self.storyboard_interval_s:
+            self.storyboard = self.create_storyboard()
+        if self.thumbnail_cache_root:
+            self.thumbnail_cache = ThumbnailCache(
+                self.thumbnail_cache_root,
+                self.storage.video_path,
+                self.storage.video_generation,
+                self.cell_size,
+            )
+            self.thumbnail_cache.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.extractor.__exit__(exc_type, exc_value, traceback)
         self.video.release()
+        if self.thumbnail_cache is not None:
+            self.thumbnail_cache.__exit__(exc_type, exc_value, traceback)
+
+    def create_extractor(self) -> FrameExtractor:
+        """Frames decoded in this process or by segments in worker processes
+        (downscaled there to the cell size, or the storyboard tile size if wider)"""
+        worker_count = 1
+        if 1 < self.decode_workers:
+            worker_mb = self.decode_worker_mb
+            worker_count = decode_worker_count(self.decode_workers, worker_mb)
+        if worker_count < 2:
+            return FrameExtractor(self.video, self.keyframes)
+        return ParallelFrameExtractor(
+            self.video,
+            self.storage.video_source.uri,
+            worker_count,
+            self.decode_worker_mb,
+            self.decoded_size(),
+            self.keyframes,
+        )
+
+    def decoded_size(self) -> ImageSize:
+        if self.storyboard_interval_s <= 0:
+            return self.cell_size
+        frame_w = int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))
+        frame_h = int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))
+        tile_size = ImageSize(*storyboard_tile_size(frame_w, frame_h))
+        return max(self.cell_size, tile_size)  # Compared by width
+
+    def create_storyboard(self) -> Storyboard:
+        MS_IN_NS = 10 ** 6
+        video_shots = self.storage.video_shots
+        shot_starts_ms = [shot.pos1_ns / MS_IN_NS for shot in video_shots]
+        end_ms = video_shots[-1].pos2_ns / MS_IN_NS
+        frame_w = int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))
+        frame_h = int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))
+        storyboard = Storyboard.from_shots(
+            shot_starts_ms,
+            end_ms,
+            self.storyboard_interval_s * 1000,
+            (frame_w, frame_h),
+            self.cue_frame_index,
+        )
+        print(f"Storyboard cues: {len(storyboard.cues)}")
+        return storyboard
+
+    def cue_frame_index(self, start_ms: float, end_ms: float) -> int:
+        """Frame in the middle of a storyboard cue (or the nearest fast-seek frame)"""
+        index = self.extractor.frame_index((start_ms + end_ms) / 2)
+        if self.keyframes is not None:
+            first = self.extractor.frame_index(start_ms)
+            last = max(self.extractor.frame_index(end_ms) - 1, first)
+            index = self.nearest_seek_frame(index, first, last)
+        return index
+
+    def read_keyframes(self) -> Optional[Sequence[int]]:
+        video_source = self.storage.video_source
+        keyframes = read_keyframe_indexes(video_source.read_range, video_source.size)
+        if keyframes is None:
+            logging.warning("No keyframe index in the container: exact seeks")
+        else:
+            print(f"Keyframes: {len(keyframes)}")
+        return keyframes
 
     def compute_grid_dimensions(self):
         shot_count = len(self.storage.video_shots)
@@ -83,76 +271,295 @@ class VideoProcessor:
         cols = rows = int(shot_count ** 0.5 + 0.5)
         if cols * rows < shot_count:
             cols += 1
-        cell_w = int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))
-        cell_h = int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))
+        frame_w = int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))
+        frame_h = int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))
+        cell_w, cell_h = frame_w, frame_h
         if SUMMARY_MAX_SIZE.w < cell_w * cols:
             scale = SUMMARY_MAX_SIZE.w / (cell_w * cols)
             cell_w = int(scale * cell_w)
             cell_h = int(scale * cell_h)
+        if self.paginated and cell_w < SUMMARY_MIN_CELL_W:
+            # Pages of the max summary size, filled with the min cell size
+            cols = max(SUMMARY_MAX_SIZE.w // SUMMARY_MIN_CELL_W, 1)
+            scale = min(SUMMARY_MAX_SIZE.w / (frame_w * cols), 1.0)
+            cell_w = int(scale * frame_w)
+            cell_h = max(int(scale * frame_h), 1)
+            rows = max(SUMMARY_MAX_SIZE.h // cell_h, 1)
         self.cell_size = ImageSize(cell_w, cell_h)
         self.grid_size = ImageSize(cell_w * cols, cell_h * rows)
+        self.page_shots = cols * rows
+        self.page_count = -(-shot_count // self.page_shots)  # Rounded up
 
     def generate_summary_stills(self):
-        image = self.render_summary()
-        for image_format in SUMMARY_STILL_FORMATS:
-            self.upload_summary([image], image_format)
+        for page, video_shots in self.gen_pages():
+            images = self.render_summaries([0.5], video_shots)
+            self.upload_summaries(images, SUMMARY_STILL_FORMATS, page)
+            self.upload_storyboard_sheets()
+        self.upload_storyboard_track()
 
     def generate_summary_animations(self):
         frame_count = ANIMATION_FRAMES
-        images = []
-        for frame_index in range(frame_count):
-            shot_ratio = (frame_index + 1) / (frame_count + 1)
-            print(f"shot_ratio: {shot_ratio:.0%}")
-            image = self.render_summary(shot_ratio)
-            images.append(image)
-        for image_format in SUMMARY_ANIMATED_FORMATS:
-            self.upload_summary(images, image_format)
-
-    def render_summary(self, shot_ratio: float = 0.5) -> PilImage:
-        grid_img = Image.new("RGB", self.grid_size, RGB_BACKGROUND)
-
-        img_and_pos_iter = zip(self.gen_cell_img(shot_ratio), self.gen_cell_pos())
-        for cell_img, cell_pos in img_and_pos_iter:
-            cell_img.thumbnail(self.cell_size)  # Makes it smaller if needed
-            grid_img.paste(cell_img, cell_pos)
-
-        return grid_img
-
-    def gen_cell_img(self, shot_ratio: float) -> Iterator[PilImage]:
+        shot_ratios = [(i + 1) / (frame_count + 1) for i in range(frame_count)]
+        for page, video_shots in self.gen_pages():
+            images = self.render_summaries(shot_ratios, video_shots)
+            self.upload_summaries(images, SUMMARY_ANIMATED_FORMATS, page)
+            self.upload_storyboard_sheets()
+        self.upload_storyboard_track()
+
+    def gen_pages(self) -> Iterator[tuple[Optional[int], list[VideoShot]]]:
+        """Yields (page number or None if single page, shots of the page)
+
+        Pages are rendered, encoded and uploaded one after the other: memory
+        use depends on the page size, not on the number of shots.
+        """
+        video_shots = self.storage.video_shots
+        n = self.page_shots
+        for page_idx in range(self.page_count):
+            page = page_idx + 1 if 1 < self.page_count else None
+            yield page, video_shots[page_idx * n : (page_idx + 1) * n]
+
+    def render_summaries(
+        self, shot_ratios: Sequence[float], video_shots: Sequence[VideoShot]
+    ) -> list[PilImage]:
+        """Renders one summary per shot ratio, decoding the video in a single pass
+
+        - Frame indexes of all (shot, ratio) pairs are planned up front
+        - Grids are NumPy buffers, converted to images once complete
+        - Each decoded frame is resized once, directly into a cell of a grid
+          (other cells needing the same frame get a copy of the cell)
+        - Frames with a cached thumbnail are not decoded
+        - Storyboard tiles up to the end of the shots are decoded in the same pass
+        - Decoding (waiting for frames) and composition are traced separately
+        """
+        decode_span = Span("decode")
+        compose_span = Span("compose", cells=len(shot_ratios) * len(video_shots))
+        with compose_span.measure():
+            cols = self.grid_size.w // self.cell_size.w
+            rows = -(-len(video_shots) // cols)  # Last page can have fewer rows
+            grid_w, grid_h = self.grid_size.w, rows * self.cell_size.h
+            grids = np.empty((len(shot_ratios), grid_h, grid_w, 3), dtype=np.uint8)
+            grids[:] = RGB_BACKGROUND
+            cell_routes = defaultdict(list)  # frame_index -> [cell buffer]
+            for grid, shot_ratio in zip(grids, shot_ratios):
+                frame_indexes = self.gen_frame_index(shot_ratio, video_shots)
+                for frame_index, cell in zip(frame_indexes, self.gen_cells(grid)):
+                    cell_routes[frame_index].append(cell)
+            if self.thumbnail_cache is not None:
+                self.fill_cached_cells(cell_routes)
+            tile_routes = {}  # frame_index -> [storyboard tile buffer]
+            if self.storyboard is not None:
+                tile_routes = self.storyboard.plan(video_shots[-1].pos2_ns / 10 ** 6)
+                compose_span.set(tiles=sum(len(t) for t in tile_routes.values()))
+            frame_indexes = cell_routes.keys() | tile_routes.keys()
+
+        print(f"Frames to decode: {len(frame_indexes)}")
+        frames = decode_span.timed(self.extractor.gen_frames(frame_indexes))
+        for frame_index, cv_frame in frames:
+            decode_span.add(frames=1)
+            with compose_span.measure():
+                if cells := cell_routes.get(frame_index):
+                    cell, *other_cells = cells
+                    self.resize_into(cv_frame, cell)
+                    if self.thumbnail_cache is not None:
+                        self.thumbnail_cache.add(frame_index, cell)
+                    for other_cell in other_cells:
+                        np.copyto(other_cell, cell)
+                if tiles := tile_routes.get(frame_index):
+                    tile, *other_tiles = tiles
+                    self.resize_into(cv_frame, tile)
+                    for other_tile in other_tiles:
+                        np.copyto(other_tile, tile)
+
+        with compose_span.measure():
+            images = [Image.fromarray(grid) for grid in grids]
+        decode_span.end()
+        compose_span.end()
+        return images
+
+    def fill_cached_cells(self, cell_routes: dict[int, list[np.ndarray]]):
+        """Copies the cached thumbnails into their cells (removed from the routes)"""
+        cached_count = 0
+        for frame_index in list(cell_routes):
+            thumbnail = self.thumbnail_cache.get(frame_index)
+            cells = cell_routes[frame_index]
+            if thumbnail is None or thumbnail.shape != cells[0].shape:
+                continue
+            for cell in cells:
+                np.copyto(cell, thumbnail)
+            del cell_routes[frame_index]
+            cached_count += 1
+        print(f"Frames from the thumbnail cache: {cached_count}")
+
+    def gen_frame_index(
+        self, shot_ratio: float, video_shots: Sequence[VideoShot]
+    ) -> Iterator[int]:
         assert 0.0 <= shot_ratio <= 1.0
         MS_IN_NS = 10 ** 6
-        for video_shot in self.storage.video_shots:
+        for video_shot in video_shots:
             pos1_ns, pos2_ns = video_shot
             pos_ms = (pos1_ns + shot_ratio * (pos2_ns - pos1_ns)) / MS_IN_NS
-            yield self.frame_at_position(pos_ms)
-
-    def gen_cell_pos(self) -> Iterator[tuple[int, int]]:
-        cell_x, cell_y = 0, 0
-        while True:
-            yield cell_x, cell_y
-            cell_x += self.cell_size.w
-            if self.grid_size.w <= cell_x:  # Move to next row?
-                cell_x, cell_y = 0, cell_y + self.cell_size.h
-
-    def frame_at_position(self, pos_ms: float) -> PilImage:
-        self.video.set(cv.CAP_PROP_POS_MSEC, pos_ms)
-        _, cv_frame = self.video.read()
-        return Image.fromarray(cv.cvtColor(cv_frame, cv.COLOR_BGR2RGB))
-
-    def upload_summary(self, images: list[PilImage], image_format: ImageFormat):
+            index = self.extractor.frame_index(pos_ms)
+            if self.keyframes is not None:
+                first = self.extractor.frame_index(pos1_ns / MS_IN_NS)
+                last = self.extractor.frame_index(pos2_ns / MS_IN_NS)
+                index = self.nearest_seek_frame(index, first, last)
+            yield index
+
+    def nearest_seek_frame(self, index: int, first: int, last: int) -> int:
+        """Nearest fast-seek frame within the seek tolerance and the shot (or index)
+
+        A seek to the frame SEEK_PREROLL_FRAMES after a keyframe decodes from
+        that keyframe: the fewest frames a seek decodes (a seek to the keyframe
+        itself decodes from the previous one).
+        """
+        tolerance = int(self.seek_tolerance_ms * self.extractor.fps / 1000)
+        low, high = max(index - tolerance, first), min(index + tolerance, last)
+        low, high = low - SEEK_PREROLL_FRAMES, high - SEEK_PREROLL_FRAMES
+        keyframes = self.keyframes
+        start, end = bisect_left(keyframes, low), bisect_right(keyframes, high)
+        candidates = [k + SEEK_PREROLL_FRAMES for k in keyframes[start:end]]
+        return min(candidates, key=lambda k: abs(k - index), default=index)
+
+    def gen_cells(self, grid: np.ndarray) -> Iterator[np.ndarray]:
+        """Cell buffers (views of the grid), row by row"""
+        cell_w, cell_h = self.cell_size
+        grid_h, grid_w, _ = grid.shape
+        for y in range(0, grid_h, cell_h):
+            for x in range(0, grid_w, cell_w):
+                yield grid[y : y + cell_h, x : x + cell_w]
+
+    def resize_into(self, cv_frame: CvFrame, cell: np.ndarray):
+        """Resizes a BGR frame into an RGB cell buffer (no full-size copy)"""
+        cell_h, cell_w, _ = cell.shape
+        size = (cell_w, cell_h)
+        resized = cv.resize(cv_frame, size, cell, interpolation=cv.INTER_AREA)
+        if resized is not cell:  # Output not written in place
+            np.copyto(cell, resized)
+        cv.cvtColor(cell, cv.COLOR_BGR2RGB, cell)  # Channels swapped in the cell only
+
+    def upload_summaries(
+        self,
+        images: list[PilImage],
+        image_formats: Sequence[ImageFormat],
+        page: Optional[int] = None,
+    ):
+        """Encodes the images in every format concurrently, uploads them as they come
+
+        - Encoders share the same read-only frames (Pillow encoders release the GIL)
+        - Formats with an encoder budget are encoded in separate processes (frames
+          sent through a pipe), terminated when over budget: the format is
+          skipped, without using CPU or memory afterwards
+        """
         if not images:
             raise RuntimeError("Empty image list")
-        mem_file = BytesIO()
-        image_type = image_format.type
-        save_parameters = image_format.save_parameters.copy()
-        if animated := 1 < len(images):
-            save_parameters |= dict(
-                save_all=True,
-                append_images=images[1:],
-                duration=ANIMATION_FRAME_DURATION_MS,
-                loop=0,  # Infinite loop
+        animated = 1 < len(images)
+        start = time.perf_counter()
+        futures: dict[Future, ImageFormat] = {}
+        with ThreadPoolExecutor(len(image_formats), "encode") as executor:
+            for image_format in image_formats:
+                budget_s = self.encoder_budgets_s.get(image_format.type)
+                if budget_s is None:
+                    encode, args = self.encode_summary, ()
+                else:
+                    encode, args = self.encode_summary_in_process, (budget_s,)
+                future = executor.submit(encode, images, image_format, *args)
+                futures[future] = image_format
+            for future in as_completed(futures):
+                image_type = futures[future].type
+                image_data = future.result()
+                if image_data is None:
+                    budget_s = self.encoder_budgets_s[image_type]
+                    logging.warning("Skipping %s (%.1f s budget)", image_type, budget_s)
+                    continue
+                self.storage.upload_summary(
+                    image_data, image_type, animated, page, self.page_count
+                )
+        wall_ms = (time.perf_counter() - start) * 1000
+        print(f"Encoding wall time: {wall_ms:.0f} ms")
+
+    def upload_storyboard_sheets(self):
+        """Encodes and uploads the complete sheets (released from memory)"""
+        if self.storyboard is None:
+            return
+        sheet_count = self.storyboard.sheet_count
+        for sheet, sheet_array in self.storyboard.pop_complete_sheets():
+            image = Image.fromarray(sheet_array)
+            image_data = self.encode_summary([image], IMAGE_STORYBOARD)
+            self.storage.upload_storyboard_sheet(
+                image_data, IMAGE_STORYBOARD.type, sheet, sheet_count
             )
-        images[0].save(mem_file, format=image_type, **save_parameters)
 
-        image_bytes = mem_file.getvalue()
-        self.storage.upload_summary(image_bytes, image_type, animated)
+    def upload_storyboard_track(self):
+        if self.storyboard is None:
+            return
+        image_type = IMAGE_STORYBOARD.type
+
+        def sheet_name(sheet: int) -> str:
+            return self.storage.storyboard_sheet_path(image_type, sheet).name
+
+        vtt_text = self.storyboard.webvtt(sheet_name)
+        sheet_count = self.storyboard.sheet_count
+        self.storage.upload_storyboard_track(vtt_text, sheet_count)
+
+    def encode_summary(
+        self, images: list[PilImage], image_format: ImageFormat
+    ) -> BytesIO:
+        """Encoded image in a memory buffer (uploaded as is, without a copy)"""
+        image_type = image_format.type
+        with Span("encode", format=image_type, frames=len(images)) as span:
+            mem_file = encode_image(images, image_format)
+            span.add(bytes=len(mem_file.getbuffer()))  # No copy
+        return mem_file
+
+    def encode_summary_in_process(
+        self, images: list[PilImage], image_format: ImageFormat, budget_s: float
+    ) -> Optional[BytesIO]:
+        """Encoded image, or None if the encoding process exceeded its budget"""
+        image_type = image_format.type
+        # Started from an encoder thread: forking could copy locks held by the
+        # other threads (deadlock), processes come from a single-threaded server
+        mp_context = multiprocessing.get_context("forkserver")
+        receiver, sender = mp_context.Pipe(duplex=False)
+        process = mp_context.Process(
+            target=send_encoded_image, args=(images, image_format, sender), daemon=True
+        )
+        with Span("encode", format=image_type, frames=len(images)) as span:
+            process.start()
+            sender.close()  # Only in the encoding process: EOF if it fails
+            try:
+                if not receiver.poll(budget_s):
+                    span.set(status="over-budget")
+                    return None
+                mem_file = BytesIO(receiver.recv_bytes())
+            except EOFError:
+                raise RuntimeError(f"Could not encode {image_type} summary") from None
+            finally:
+                process.terminate()  # No-op if completed
+                process.join()
+                receiver.close()
+            span.add(bytes=len(mem_file.getbuffer()))
+        return mem_file
+
+
+def encode_image(images: list[PilImage], image_format: ImageFormat) -> BytesIO:
+    """Single or animated image (several frames) encoded in a memory buffer"""
+    mem_file = BytesIO()
+    save_parameters = image_format.save_parameters.copy()
+    if 1 < len(images):
+        save_parameters |= dict(
+            save_all=True,
+            append_images=images[1:],
+            duration=ANIMATION_FRAME_DURATION_MS,
+            loop=0,  # Infinite loop
+        )
+    # save() stores the parameters in the image: each encoder gets its copy
+    first_image = images[0].copy()
+    first_image.save(mem_file, format=image_format.type, **save_parameters)
+    return mem_file
+
+
+def send_encoded_image(
+    images: list[PilImage], image_format: ImageFormat, connection: Connection
+):
+    """Encoding process: sends the encoded image through a pipe"""
+    connection.send_bytes(encode_image(images, image_format).getbuffer())
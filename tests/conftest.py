@@ -0,0 +1,23 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+# Function modules are imported by name, as in their deployed directory (shared
+# modules are identical in all directories, see test_shared_modules.py).
+sys.path.insert(0, str(REPO_ROOT / "gcf_video_summary" / "gcf2_generate_summary"))
+sys.path.append(str(REPO_ROOT / "gcf_video_summary" / "gcf1_detect_shots"))
@@ -0,0 +1,131 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from typing import Optional
+
+import pytest
+
+pytest.importorskip("google.cloud.videointelligence")
+
+import batch_launcher  # noqa: E402
+from batch_launcher import (  # noqa: E402
+    SOURCE_HASH_KEY,
+    STATUS_DEFERRED,
+    STATUS_LAUNCHED,
+    STATUS_UP_TO_DATE,
+    BatchLauncher,
+)
+from storage_backend import ObjectInfo  # noqa: E402
+
+VIDEO_GENERATION = 1000
+
+
+class FakeClock:
+    """time.monotonic/time.sleep without waiting"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+        self.slept += seconds
+
+
+class FakeBackend:
+    def __init__(self, infos: dict[str, ObjectInfo]):
+        self.infos = infos
+        self.metadata_updates: list[str] = []
+
+    def get_info(self, uri: str) -> Optional[ObjectInfo]:
+        return self.infos.get(uri)
+
+    def update_metadata(self, uri: str, metadata: dict[str, str]):
+        self.metadata_updates.append(uri)
+
+
+class FakeVideoClient:
+    def __init__(self):
+        self.requests: list[dict] = []
+
+    def annotate_video(self, request: dict):
+        self.requests.append(request)
+
+
+def video_info(uri: str) -> ObjectInfo:
+    return ObjectInfo(uri, 100, VIDEO_GENERATION, "hash", {})
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(batch_launcher, "time", fake_clock)
+    return fake_clock
+
+
+def make_launcher(monkeypatch, infos: dict[str, ObjectInfo]) -> BatchLauncher:
+    monkeypatch.setattr(batch_launcher, "get_backend", lambda: FakeBackend(infos))
+    videointelligence = batch_launcher.videointelligence
+    monkeypatch.setattr(
+        videointelligence, "VideoIntelligenceServiceClient", FakeVideoClient
+    )
+    return BatchLauncher(videointelligence.Feature.SHOT_CHANGE_DETECTION)
+
+
+def test_batch_defers_launches_beyond_wait_budget(monkeypatch, clock):
+    video_uris = [f"gs://videos/video{i:02}.mp4" for i in range(20)]
+    infos = {uri: video_info(uri) for uri in video_uris}
+    launcher = make_launcher(monkeypatch, infos)
+    results = launcher.launch_batch(video_uris, "annotations")
+
+    interval_s = 60 / batch_launcher.LAUNCHES_PER_MINUTE
+    launched = int(batch_launcher.BATCH_MAX_WAIT_S // interval_s) + 1
+    statuses = [result.status for result in results]
+    assert statuses == [STATUS_LAUNCHED] * launched + [STATUS_DEFERRED] * (
+        len(video_uris) - launched
+    )
+    assert clock.slept <= batch_launcher.BATCH_MAX_WAIT_S
+    assert len(launcher.video_client.requests) == launched
+
+    # Next request: deferred videos launched (rate limit still applied)
+    deferred = [r.video_uri for r in results if r.status == STATUS_DEFERRED]
+    results = launcher.launch_batch(deferred, "annotations")
+    assert results[0].status == STATUS_LAUNCHED
+    assert launched + 1 <= len(launcher.video_client.requests)
+
+
+@pytest.mark.parametrize(
+    "annot_generation, annot_metadata, status, recorded",
+    [
+        (VIDEO_GENERATION + 1, {}, STATUS_UP_TO_DATE, True),  # Source recorded
+        (VIDEO_GENERATION - 1, {SOURCE_HASH_KEY: "hash"}, STATUS_UP_TO_DATE, False),
+        (VIDEO_GENERATION + 1, {SOURCE_HASH_KEY: "other"}, STATUS_LAUNCHED, False),
+        (VIDEO_GENERATION - 1, {}, STATUS_LAUNCHED, False),
+    ],
+)
+def test_up_to_date_annotations(
+    monkeypatch, clock, annot_generation, annot_metadata, status, recorded
+):
+    video_uri = "gs://videos/video.mp4"
+    annot_uri = "gs://annotations/videos/video.mp4.json"
+    annotation = ObjectInfo(annot_uri, 10, annot_generation, "", annot_metadata)
+    infos = {video_uri: video_info(video_uri), annot_uri: annotation}
+    launcher = make_launcher(monkeypatch, infos)
+    assert launcher.launch(video_uri, "annotations") == status
+    assert launcher.backend.metadata_updates == ([annot_uri] if recorded else [])
+    assert not batch_launcher.is_up_to_date(video_info(video_uri), None)
@@ -0,0 +1,84 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import ast
+from pathlib import Path
+
+from conftest import REPO_ROOT
+
+# Both functions deploy modules with the same names: constants read from sources
+SUMMARY_DIR = REPO_ROOT / "gcf_video_summary" / "gcf2_generate_summary"
+OBJECTS_DIR = REPO_ROOT / "gcf_object_tracking" / "gcf2_render_objects"
+
+
+def module_nodes(path: Path) -> dict[str, ast.AST]:
+    """Top-level assigned values and functions/classes of a module, by name"""
+    nodes: dict[str, ast.AST] = {}
+    for node in ast.walk(ast.parse(path.read_text())):
+        if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            nodes.setdefault(node.targets[0].id, node.value)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            nodes.setdefault(node.name, node)
+    return nodes
+
+
+def call_keywords(call: ast.Call) -> dict:
+    """Keyword arguments of a call, e.g. dict(quality=80), from their literals"""
+    return {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+
+
+def test_summary_formats_match():
+    summary = module_nodes(SUMMARY_DIR / "video_processor.py")
+    objects = module_nodes(OBJECTS_DIR / "shot_summary.py")
+    still_formats = {}
+    for name in summary["SUMMARY_STILL_FORMATS"].elts:
+        image_type, save_parameters = summary[name.id].args  # ImageFormat(...)
+        still_formats[ast.literal_eval(image_type)] = call_keywords(save_parameters)
+    summary_formats = objects["SUMMARY_FORMATS"]
+    assert still_formats == {
+        ast.literal_eval(image_type): call_keywords(save_parameters)
+        for image_type, save_parameters in zip(
+            summary_formats.keys, summary_formats.values
+        )
+    }
+    assert list(still_formats) == [ast.literal_eval(k) for k in summary_formats.keys]
+    max_w = ast.literal_eval(summary["SUMMARY_MAX_SIZE"].args[0])
+    assert ast.literal_eval(objects["SUMMARY_MAX_W"]) == max_w
+
+
+def test_summary_render_options_match():
+    summary = module_nodes(SUMMARY_DIR / "video_processor.py")
+    objects = module_nodes(OBJECTS_DIR / "storage_helper.py")
+    generate_summary = summary["generate_summary"]
+    arguments = generate_summary.args
+    defaults = {
+        arg.arg: ast.literal_eval(default)
+        for arg, default in zip(
+            arguments.args[-len(arguments.defaults) :], arguments.defaults
+        )
+    }
+    [options_node] = [
+        node.value
+        for node in ast.walk(generate_summary)
+        if isinstance(node, ast.Assign)
+        and isinstance(node.targets[0], ast.Name)
+        and node.targets[0].id == "render_options"
+    ]
+    render_options = eval(
+        compile(ast.Expression(options_node), "<ast>", "eval"), defaults
+    )
+    assert ast.literal_eval(objects["SUMMARY_RENDER_OPTIONS"]) == render_options
+    # Options appended to the default ones are off by default
+    assert not defaults["storyboard_interval_s"]
@@ -0,0 +1,209 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from concurrent.futures import Future
+from typing import Iterable, Optional, Sequence
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+import frame_extractor
+from frame_extractor import (
+    DECODE_PENDING_SEGMENTS_PER_WORKER,
+    DECODE_SEGMENT_COPIES,
+    DECODE_SEGMENTS_PER_WORKER,
+    GRAB_MAX_GAP_FRAMES,
+    SEEK_PREROLL_FRAMES,
+    FrameExtractor,
+    FrameCache,
+    ParallelFrameExtractor,
+    decode_segment,
+)
+
+FRAME_W, FRAME_H = 640, 360
+FRAME_COUNT = 3000
+
+
+class FakeCapture:
+    properties = {
+        cv.CAP_PROP_FPS: 30.0,
+        cv.CAP_PROP_FRAME_COUNT: FRAME_COUNT,
+        cv.CAP_PROP_FRAME_WIDTH: FRAME_W,
+        cv.CAP_PROP_FRAME_HEIGHT: FRAME_H,
+    }
+
+    def get(self, prop_id: int) -> float:
+        return self.properties[prop_id]
+
+
+class DecodingCapture(FakeCapture):
+    """Capture whose frames hold their own index, with seeks and decoded frames
+    counted (a seek decodes from the keyframe preceding the target minus
+    SEEK_PREROLL_FRAMES, as OpenCV with FFmpeg)"""
+
+    def __init__(self, keyframes: Optional[Sequence[int]] = None):
+        self.keyframes = keyframes
+        self.pos = 0
+        self.seeks: list[int] = []
+        self.decoded = 0
+
+    def get(self, prop_id: int) -> float:
+        if prop_id == cv.CAP_PROP_POS_FRAMES:
+            return self.pos
+        return super().get(prop_id)
+
+    def set(self, prop_id: int, value: float) -> bool:
+        assert prop_id == cv.CAP_PROP_POS_FRAMES
+        index = int(value)
+        start = max(index - SEEK_PREROLL_FRAMES, 0)
+        if self.keyframes:
+            start = max(k for k in self.keyframes if k <= start)
+        self.decoded += index - start
+        self.seeks.append(index)
+        self.pos = index
+        return True
+
+    def grab(self) -> bool:
+        if FRAME_COUNT <= self.pos:
+            return False
+        self.pos += 1
+        self.decoded += 1
+        return True
+
+    def read(self) -> tuple[bool, Optional[np.ndarray]]:
+        if FRAME_COUNT <= self.pos:
+            return False, None
+        frame = np.full((2, 2, 3), 0, dtype=np.int32)
+        frame[0, 0, 0] = self.pos  # Decoded frame index
+        self.pos += 1
+        self.decoded += 1
+        return True, frame
+
+
+def decoded_indexes(frames: Iterable[tuple[int, np.ndarray]]) -> list[int]:
+    """Requested indexes, checked against the frames actually decoded"""
+    indexes = []
+    for index, cv_frame in frames:
+        assert cv_frame[0, 0, 0] == index
+        indexes.append(index)
+    return indexes
+
+
+class FakeExecutor:
+    """Decodes segments on submit, tracks the segments not fully yielded yet"""
+
+    def __init__(self):
+        self.segments: list[list[int]] = []
+        self.last_yielded = -1
+        self.max_in_flight = 0
+
+    def submit(self, fn, segment: list[int]) -> Future:
+        self.segments.append(segment)
+        in_flight = sum(self.last_yielded < s[-1] for s in self.segments)
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+        future = Future()
+        future.set_result([(index, np.empty(0)) for index in segment])
+        return future
+
+
+def test_segments_in_flight_fit_worker_memory():
+    worker_mb, worker_count = 16, 3
+    extractor = ParallelFrameExtractor(
+        FakeCapture(), "video.mp4", worker_count, worker_mb
+    )
+    executor = extractor.executor = FakeExecutor()
+    indexes = []
+    for index, _ in extractor.gen_frames(range(0, FRAME_COUNT, 2)):
+        executor.last_yielded = index
+        indexes.append(index)
+    assert indexes == list(range(0, FRAME_COUNT, 2))
+    assert worker_count * DECODE_SEGMENTS_PER_WORKER < len(executor.segments)
+
+    frame_bytes = 3 * FRAME_W * FRAME_H
+    segment_bytes = extractor.segment_max_frames * frame_bytes
+    assert segment_bytes * DECODE_SEGMENT_COPIES <= worker_mb * 2 ** 20
+    max_in_flight = DECODE_PENDING_SEGMENTS_PER_WORKER * worker_count
+    assert executor.max_in_flight <= max_in_flight
+
+
+@pytest.mark.parametrize("keyframes", [None, list(range(0, FRAME_COUNT, 300))])
+def test_backward_requests_seek(keyframes):
+    video = DecodingCapture(keyframes)
+    extractor = FrameExtractor(video, keyframes)
+    assert decoded_indexes(extractor.gen_frames([510, 500])) == [500, 510]
+    assert decoded_indexes(extractor.gen_frames([20, 10])) == [10, 20]
+    assert decoded_indexes(extractor.gen_frames([15, 2999])) == [15, 2999]
+    assert video.seeks == [500, 10, 15, 2999]
+
+
+@pytest.mark.parametrize(
+    "keyframes, indexes, seeks, decoded",
+    [
+        # Unknown keyframes: gaps beyond GRAB_MAX_GAP_FRAMES seek
+        (None, [0, GRAB_MAX_GAP_FRAMES], [], GRAB_MAX_GAP_FRAMES + 1),
+        (
+            None,
+            [0, GRAB_MAX_GAP_FRAMES + 2],
+            [GRAB_MAX_GAP_FRAMES + 2],
+            1 + SEEK_PREROLL_FRAMES + 1,
+        ),
+        # Known keyframes: grabbing through the GOP is cheaper than a seek
+        ([0, 300, 600], [100, 280], [], 101 + 180),
+        # Target at keyframe + SEEK_PREROLL_FRAMES: its seek decodes few frames
+        ([0, 300, 600], [10, 316], [316], 11 + SEEK_PREROLL_FRAMES + 1),
+        # Keyframe target: its seek decodes the whole previous GOP, grabbing wins
+        ([0, 300, 600], [290, 300], [], 291 + 10),
+    ],
+)
+def test_forward_gaps_seek_when_cheaper(keyframes, indexes, seeks, decoded):
+    video = DecodingCapture(keyframes)
+    extractor = FrameExtractor(video, keyframes)
+    assert decoded_indexes(extractor.gen_frames(indexes)) == indexes
+    assert video.seeks == seeks
+    assert video.decoded == decoded
+
+
+def test_end_of_video():
+    extractor = FrameExtractor(DecodingCapture())
+    frames = extractor.gen_frames([FRAME_COUNT - 1, FRAME_COUNT, FRAME_COUNT + 5])
+    assert decoded_indexes(frames) == [FRAME_COUNT - 1]
+
+
+def test_worker_segments_in_any_order(monkeypatch):
+    # Workers reuse their capture for whichever segment comes next
+    video = DecodingCapture()
+    monkeypatch.setattr(frame_extractor, "worker_extractor", FrameExtractor(video))
+    monkeypatch.setattr(frame_extractor, "worker_frame_size", None)
+    segments = [[2000, 2010], [5, 7], [1500], [1500, 1501], [2999]]
+    for segment in segments:
+        assert decoded_indexes(decode_segment(segment)) == segment
+    assert video.seeks == [2000, 5, 1500, 1500, 2999]
+
+
+def test_frame_cache_overlapping_batches():
+    video = DecodingCapture()
+    cache = FrameCache(FrameExtractor(video), lambda f: int(f[0, 0, 0]), 4)
+    index_sets = [
+        list(range(100, 110)),  # Larger than the cache
+        list(range(105, 113)),  # Starts behind the previous batch
+        [100, 200],
+        [150, 160, 170],
+        [2999, 0],
+    ]
+    pos_ms_sets = [[(i + 0.5) * 1000 / 30 for i in s] for s in index_sets]
+    frame_sets = dict(cache.gen_frame_sets(pos_ms_sets))
+    assert frame_sets == dict(enumerate(index_sets))
+    assert list(cache.gen_batches(index_sets)) == [[4], [0], [2], [1], [3]]
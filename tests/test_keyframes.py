@@ -0,0 +1,118 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import struct
+from typing import Optional
+
+from keyframes import read_keyframe_indexes
+
+# Open GOP, 8 frames in presentation order: I0 B1 B2 P3 B4 B5 I6 P7
+# Decode order: I0 P3 B1 B2 I6 B4 B5 P7 (sync samples #1 and #5)
+SYNC_SAMPLES = [1, 5]
+DECODE_ORDER = [0, 3, 1, 2, 6, 4, 5, 7]  # Presentation index of each sample
+
+
+def box(box_type: bytes, *children: bytes) -> bytes:
+    payload = b"".join(children)
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, version: int, entries: list[tuple], fmt: str) -> bytes:
+    payload = struct.pack(">B3xI", version, len(entries))
+    payload += b"".join(struct.pack(fmt, *entry) for entry in entries)
+    return box(box_type, payload)
+
+
+def mp4_file(
+    sample_count=8,
+    sync_samples: Optional[list[int]] = SYNC_SAMPLES,
+    ctts: Optional[bytes] = None,
+    elst: Optional[bytes] = None,
+    handler=b"vide",
+) -> bytes:
+    """ftyp + mdat + moov (at the end), 1 video track with 1-tick frames"""
+    hdlr = box(b"hdlr", struct.pack(">4x4s4s12x", b"\0" * 4, handler))
+    stsz = box(b"stsz", struct.pack(">4xII", 1000, sample_count))
+    stts = full_box(b"stts", 0, [(sample_count, 1)], ">II")
+    stbl_boxes = [stsz, stts]
+    if sync_samples is not None:
+        stbl_boxes.append(full_box(b"stss", 0, [(n,) for n in sync_samples], ">I"))
+    if ctts is not None:
+        stbl_boxes.append(ctts)
+    stbl = box(b"stbl", *stbl_boxes)
+    mdia = box(b"mdia", hdlr, box(b"minf", stbl))
+    trak_boxes = [box(b"tkhd", bytes(84)), mdia]
+    if elst is not None:
+        trak_boxes.insert(1, box(b"edts", elst))
+    moov = box(b"moov", box(b"mvhd", bytes(100)), box(b"trak", *trak_boxes))
+    return box(b"ftyp", b"isom", bytes(4)) + box(b"mdat", bytes(64)) + moov
+
+
+def composition_offsets(shift: int) -> list[tuple[int, int]]:
+    """ctts runs: presentation index (+ shift) - decode index"""
+    return [(1, index + shift - sample) for sample, index in enumerate(DECODE_ORDER)]
+
+
+def keyframe_indexes(data: bytes) -> Optional[list[int]]:
+    def read_range(start: int, end: int) -> bytes:
+        return data[start : end + 1]
+
+    keyframes = read_keyframe_indexes(read_range, len(data))
+    return None if keyframes is None else list(keyframes)
+
+
+def test_sync_samples_without_reordering():
+    assert keyframe_indexes(mp4_file()) == [0, 4]
+
+
+def test_every_frame_is_a_keyframe_without_sync_sample_table():
+    assert keyframe_indexes(mp4_file(sync_samples=None)) == list(range(8))
+
+
+def test_signed_composition_offsets():
+    ctts = full_box(b"ctts", 1, composition_offsets(0), ">Ii")
+    assert keyframe_indexes(mp4_file(ctts=ctts)) == [0, 6]
+
+
+def test_composition_offsets_with_edit_list_start():
+    # Positive offsets (version 0), presentation starting at the 1st frame
+    ctts = full_box(b"ctts", 0, composition_offsets(2), ">II")
+    elst = full_box(b"elst", 0, [(8, 2, 1 << 16)], ">IiI")
+    assert keyframe_indexes(mp4_file(ctts=ctts, elst=elst)) == [0, 6]
+
+
+def test_edit_list_cutting_frames():
+    # The presentation starts at the 3rd frame: the 1st keyframe is cut
+    elst = full_box(b"elst", 1, [(6, 2, 1 << 16)], ">QqI")
+    assert keyframe_indexes(mp4_file(elst=elst)) == [2]
+
+
+def test_unsupported_edit_lists():
+    empty_edit = (2, -1, 1 << 16)
+    edit = (8, 0, 1 << 16)
+    for edits in [[empty_edit, edit], [edit, edit], [(8, 0, 2 << 16)]]:
+        elst = full_box(b"elst", 0, edits, ">IiI")
+        assert keyframe_indexes(mp4_file(elst=elst)) is None
+
+
+def test_truncated_composition_offsets():
+    ctts = full_box(b"ctts", 0, composition_offsets(0)[:4], ">Ii")
+    assert keyframe_indexes(mp4_file(ctts=ctts)) is None
+
+
+def test_fragmented_and_other_files():
+    assert keyframe_indexes(mp4_file(sample_count=0)) is None  # Samples in moof
+    assert keyframe_indexes(mp4_file(handler=b"soun")) is None  # No video track
+    assert keyframe_indexes(b"RIFF" + bytes(60)) is None  # Not MP4/MOV
@@ -0,0 +1,41 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import filecmp
+
+import pytest
+
+from conftest import REPO_ROOT
+
+# Modules copied in each function directory using them (deployed separately):
+# edit one copy, then copy it to the others
+SHARED_MODULES = [
+    "batch_launcher.py",
+    "frame_extractor.py",
+    "storage_backend.py",
+    "tracing.py",
+    "upload_pipeline.py",
+    "video_source.py",
+]
+FUNCTION_DIRS = sorted(REPO_ROOT.glob("gcf_*/gcf[0-9]_*/"))
+
+
+@pytest.mark.parametrize("module", SHARED_MODULES)
+def test_shared_module_copies_identical(module: str):
+    copies = [path / module for path in FUNCTION_DIRS if (path / module).exists()]
+    assert 2 <= len(copies)
+    for copy in copies[1:]:
+        relative_path = copy.relative_to(REPO_ROOT)
+        assert filecmp.cmp(copies[0], copy, shallow=False), f"{relative_path} differs"
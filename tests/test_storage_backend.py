@@ -0,0 +1,116 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+import storage_backend
+from storage_backend import POOL_MAX_CONNECTIONS, LocalBackend, StorageBackend
+
+OBJECT_NAMES = [
+    "videos/a.mp4",
+    "videos/a.mp4.summary_still.jpeg",
+    "videos/b/c.mp4",
+    "videos/b/d/e.mp4",
+    "videos2/f.mp4",
+    "g.mp4",
+]
+
+
+@pytest.fixture
+def local_backend(tmp_path: Path) -> LocalBackend:
+    backend = LocalBackend(tmp_path)
+    for name in OBJECT_NAMES:
+        backend.upload(f"gs://bucket/{name}", io.BytesIO(b"data"), "video/mp4")
+    backend.upload("gs://other/videos/h.mp4", io.BytesIO(b"data"), "video/mp4")
+    return backend
+
+
+@pytest.mark.parametrize(
+    "prefix, names",
+    [
+        ("videos/", OBJECT_NAMES[:4]),
+        ("videos", OBJECT_NAMES[:5]),
+        ("videos/a.mp4", OBJECT_NAMES[:2]),
+        ("videos/a.mp4.", OBJECT_NAMES[1:2]),
+        ("videos/b", OBJECT_NAMES[2:4]),
+        ("videos/b/d/", OBJECT_NAMES[3:4]),
+        ("", sorted(OBJECT_NAMES)),
+        ("missing/", []),
+        ("videos/x", []),
+    ],
+)
+def test_local_list_infos_like_cloud_storage(
+    local_backend: LocalBackend, prefix: str, names: list[str]
+):
+    infos = local_backend.list_infos(f"gs://bucket/{prefix}")
+    assert [info.uri for info in infos] == [f"gs://bucket/{name}" for name in names]
+
+
+class FakeStorageHandler(BaseHTTPRequestHandler):
+    """Object metadata requests of the JSON API (GET /storage/v1/b/B/o/O)"""
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        body = json.dumps(
+            dict(
+                bucket="bucket",
+                name="videos/a.mp4",
+                size="4",
+                generation="123",
+                md5Hash="hash",
+                metadata=dict(key="value"),
+            )
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_storage_server(monkeypatch) -> Iterator[ThreadingHTTPServer]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeStorageHandler)
+    server.paths = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    monkeypatch.setenv("STORAGE_EMULATOR_HOST", f"http://{host}:{port}")
+    monkeypatch.setattr(storage_backend, "STORAGE_EMULATOR_HOST", f"{host}:{port}")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_client_session_with_connection_pool(fake_storage_server):
+    backend = StorageBackend()
+    info = backend.get_info("gs://bucket/videos/a.mp4")
+    assert info.uri == "gs://bucket/videos/a.mp4"
+    assert (info.size, info.generation, info.content_hash) == (4, 123, "hash")
+    assert info.metadata == dict(key="value")
+    object_path = "/storage/v1/b/bucket/o/videos%2Fa.mp4"
+    assert any(path.startswith(object_path) for path in fake_storage_server.paths)
+    session = backend.client._http
+    for url in ("https://storage.googleapis.com", "http://127.0.0.1"):
+        assert session.get_adapter(url)._pool_maxsize == POOL_MAX_CONNECTIONS
@@ -0,0 +1,73 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import thumbnail_cache
+from thumbnail_cache import ThumbnailCache
+
+CELL_SIZE = (40, 30)
+CELL_BYTES = 40 * 30 * 3
+
+
+def cell(value: int) -> np.ndarray:
+    return np.full((CELL_SIZE[1], CELL_SIZE[0], 3), value, dtype=np.uint8)
+
+
+@pytest.fixture(autouse=True)
+def max_cells(monkeypatch):
+    monkeypatch.setattr(
+        thumbnail_cache, "THUMBNAIL_CACHE_MAX_MB", 4 * CELL_BYTES / 2 ** 20
+    )
+
+
+def render(cache_root: Path, used: list[int], added: list[int]) -> list[int]:
+    """Simulated rendering: cached thumbnails used, new ones added"""
+    with ThumbnailCache(
+        str(cache_root), Path("videos/video.mp4"), 1, CELL_SIZE
+    ) as cache:
+        for index in used:
+            thumbnail = cache.get(index)
+            assert thumbnail is not None and (thumbnail == index).all()
+        for index in added:
+            assert cache.get(index) is None
+            cache.add(index, cell(index))
+    with ThumbnailCache(
+        str(cache_root), Path("videos/video.mp4"), 1, CELL_SIZE
+    ) as cache:
+        return [int(key) for key in cache.cached.files]
+
+
+def test_cache_bounded_with_least_recently_used_dropped(tmp_path: Path):
+    assert render(tmp_path, [], [1, 2, 3]) == [1, 2, 3]
+    assert render(tmp_path, [2], [4]) == [4, 2, 1, 3]  # Full
+    # Cached thumbnails count in the limit: unused ones dropped, oldest first
+    assert render(tmp_path, [3], [5, 6]) == [5, 6, 3, 4]
+    assert render(tmp_path, [6, 3], [7]) == [7, 6, 3, 5]
+
+
+def test_cache_not_written_without_new_thumbnails(tmp_path: Path):
+    render(tmp_path, [], [1, 2])
+    [cache_file] = tmp_path.rglob("*.npz")
+    mtime_ns = cache_file.stat().st_mtime_ns
+    assert render(tmp_path, [1], []) == [1, 2]
+    assert cache_file.stat().st_mtime_ns == mtime_ns
+
+
+def test_new_thumbnails_beyond_limit_not_cached(tmp_path: Path):
+    assert render(tmp_path, [], [1, 2, 3, 4, 5, 6]) == [1, 2, 3, 4]
@@ -0,0 +1,174 @@
+"""
+Copyright 2020-2021 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import http.client
+import threading
+import urllib.error
+import urllib.request
+from typing import Optional
+
+import pytest
+
+import video_source
+from video_source import ChunkCache, StreamedVideo
+
+CHUNK_SIZE = 1024
+VIDEO_SIZE = 10 * CHUNK_SIZE + 300  # Partial last chunk
+VIDEO_DATA = bytes(i % 251 for i in range(VIDEO_SIZE))
+
+
+class FakeStorage:
+    """Ranged reads of an in-memory object, optionally held until released"""
+
+    def __init__(self):
+        self.reads: list[tuple[int, int]] = []
+        self.held_start: Optional[int] = None
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def read_range(self, start: int, end: int) -> bytes:
+        self.reads.append((start, end))
+        if start == self.held_start:
+            self.started.set()
+            assert self.released.wait(timeout=5)
+        return VIDEO_DATA[start : end + 1]
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(video_source, "STREAM_CHUNK_SIZE", CHUNK_SIZE)
+    monkeypatch.setattr(video_source, "STREAM_READ_AHEAD_CHUNKS", 1)
+    monkeypatch.setattr(video_source, "STREAM_CACHE_MAX_CHUNKS", 4)
+
+
+def get(uri: str, range_header: Optional[str] = None, method="GET"):
+    headers = {} if range_header is None else {"Range": range_header}
+    request = urllib.request.Request(uri, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers, error.read()
+
+
+@pytest.mark.parametrize(
+    "range_header, start, end",
+    [
+        (None, 0, VIDEO_SIZE - 1),
+        ("bytes=100-2999", 100, 2999),
+        ("bytes=10000-", 10000, VIDEO_SIZE - 1),
+        ("bytes=-300", VIDEO_SIZE - 300, VIDEO_SIZE - 1),
+        ("bytes=-99999", 0, VIDEO_SIZE - 1),
+        ("bytes=5-99999", 5, VIDEO_SIZE - 1),
+    ],
+)
+def test_range_requests(range_header: Optional[str], start: int, end: int):
+    storage = FakeStorage()
+    with StreamedVideo("video.mp4", VIDEO_SIZE, storage.read_range) as video:
+        status, headers, body = get(video.uri, range_header)
+        _, head_headers, head_body = get(video.uri, range_header, "HEAD")
+    assert status == (200 if range_header is None else 206)
+    assert body == VIDEO_DATA[start : end + 1]
+    assert headers["Accept-Ranges"] == "bytes"
+    assert headers["Connection"] == "close"  # As requested by urllib
+    if range_header is not None:
+        assert headers["Content-Range"] == f"bytes {start}-{end}/{VIDEO_SIZE}"
+    assert head_headers["Content-Length"] == str(end - start + 1)
+    assert head_body == b""
+
+
+@pytest.mark.parametrize(
+    "range_header",
+    ["bytes=-", "bytes=10-5", f"bytes={VIDEO_SIZE}-", "items=0-10", "bytes=0-1,5-6"],
+)
+def test_unsatisfiable_ranges(range_header: str):
+    storage = FakeStorage()
+    with StreamedVideo("video.mp4", VIDEO_SIZE, storage.read_range) as video:
+        status, headers, body = get(video.uri, range_header)
+    assert status == 416
+    assert headers["Content-Range"] == f"bytes */{VIDEO_SIZE}"
+    assert body == b""
+    assert not storage.reads
+
+
+def test_short_object_truncates_response():
+    storage = FakeStorage()
+    size = VIDEO_SIZE + CHUNK_SIZE  # Larger than the object
+    with StreamedVideo("video.mp4", size, storage.read_range) as video:
+        with pytest.raises(http.client.IncompleteRead) as exc_info:
+            get(video.uri, f"bytes=100-{size - 1}")
+    assert exc_info.value.partial == VIDEO_DATA[100:]
+
+
+def test_lru_eviction():
+    storage = FakeStorage()
+    cache = ChunkCache(storage.read_range, VIDEO_SIZE)
+    assert cache.chunk(0) == VIDEO_DATA[:CHUNK_SIZE]  # Chunks 0-1 (read-ahead)
+    cache.chunk(2)  # Chunks 2-3
+    cache.chunk(0)  # Most recently used
+    cache.chunk(4)  # Chunks 4-5: evicts 1 then 2
+    assert list(cache.chunks) == [3, 0, 4, 5]
+    last_chunk = cache.chunk(10)  # Partial chunk, no read-ahead past the end
+    assert last_chunk == VIDEO_DATA[10 * CHUNK_SIZE :]
+    cache.chunk(1)  # Evicted: fetched again, read-ahead stops at cached chunk 3
+    assert storage.reads == [
+        (0, 2 * CHUNK_SIZE - 1),
+        (2 * CHUNK_SIZE, 4 * CHUNK_SIZE - 1),
+        (4 * CHUNK_SIZE, 6 * CHUNK_SIZE - 1),
+        (10 * CHUNK_SIZE, VIDEO_SIZE - 1),
+        (CHUNK_SIZE, 3 * CHUNK_SIZE - 1),
+    ]
+    assert cache.read_count == len(storage.reads)
+    assert len(cache.chunks) == video_source.STREAM_CACHE_MAX_CHUNKS
+
+
+def test_fetch_outside_lock():
+    storage = FakeStorage()
+    storage.held_start = 4 * CHUNK_SIZE
+    cache = ChunkCache(storage.read_range, VIDEO_SIZE)
+    cache.chunk(0)
+    results = {}
+
+    def read_chunk(name: str, index: int):
+        results[name] = cache.chunk(index)
+
+    fetcher = threading.Thread(target=read_chunk, args=("fetcher", 4))
+    fetcher.start()
+    assert storage.started.wait(timeout=5)
+    assert cache.chunk(1) == VIDEO_DATA[CHUNK_SIZE : 2 * CHUNK_SIZE]  # Not blocked
+    waiter = threading.Thread(target=read_chunk, args=("waiter", 5))
+    waiter.start()
+    cache.chunk(3)  # Read-ahead stops before the chunk being fetched
+    storage.released.set()
+    fetcher.join(timeout=5)
+    waiter.join(timeout=5)
+    assert results["fetcher"] == VIDEO_DATA[4 * CHUNK_SIZE : 5 * CHUNK_SIZE]
+    assert results["waiter"] == VIDEO_DATA[5 * CHUNK_SIZE : 6 * CHUNK_SIZE]
+    assert storage.reads == [
+        (0, 2 * CHUNK_SIZE - 1),
+        (4 * CHUNK_SIZE, 6 * CHUNK_SIZE - 1),
+        (3 * CHUNK_SIZE, 4 * CHUNK_SIZE - 1),
+    ]
+    assert not cache.fetching
+
+
+def test_failed_fetch_is_retried():
+    cache = ChunkCache(FakeStorage().read_range, VIDEO_SIZE)
+    cache.read_range = lambda start, end: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        cache.chunk(2)
+    assert not cache.fetching
+    cache.read_range = FakeStorage().read_range
+    assert cache.chunk(2) == VIDEO_DATA[2 * CHUNK_SIZE : 3 * CHUNK_SIZE]